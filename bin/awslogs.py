@@ -4,94 +4,2083 @@
 # author: Michael Jay Lippert mike@rifflearning.com
 # Command line tool for viewing the logs from AWS Cloudwatch for a riff swarm
 
+import os
 import sys
-import boto3
+import gzip
 import json
+import uuid
+import hashlib
+import threading
 import re
-from datetime import datetime
+import time
+import math
+import heapq
+import itertools
+import functools
+import collections
+import random
+import fcntl
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+import click
+
+click_region_option = click.option('--region', type=click.Choice(['us-east-1',
+                                                                  'us-east-2',
+                                                                  'us-west-1',
+                                                                  'us-west-2',
+                                                                  'eu-west-1',
+                                                                  'eu-west-2']),
+                                   default='us-east-2', show_default=True,
+                                   help='The AWS region name where the docker swarm is deployed.')
+
+click_swarm_option = click.option('--swarm', default='staging', show_default=True,
+                                  help='The swarm env name (staging, beta, prod...) whose log group will be read.')
+
+# CloudWatch error codes which mean we are calling the api too fast and should back off and retry
+# (LimitExceededException is returned by start_query when too many Logs Insights queries are running)
+THROTTLING_ERROR_CODES = ('ThrottlingException', 'TooManyRequestsException', 'LimitExceededException')
+
+# Terminal CSI sequences (see https://en.wikipedia.org/wiki/ANSI_escape_code) including one cut off
+# at the end of the string, which are removed from text log messages
+TERM_CTRL_SEQ_RE = re.compile('\x1b\\[[\x30-\x3F]*[\x20-\x2F]*(?:[\x40-\x7E]|$)')
+
+# decodes a json document (json.loads checks the argument's type on every call, this doesn't)
+JSON_DECODE = json.JSONDecoder().decode
+
+# relative times on the commandline are a number followed by one of these units
+TIME_UNITS = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60}
+
+# The time window being fetched is split into slices of this many ms (15 min) which bounds
+# the number of events held in memory at once
+DEFAULT_SLICE_MS = 15 * 60 * 1000
+
+# The local cache of fetched log events is kept here, limited to this size
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'riff-awslogs')
+DEFAULT_CACHE_SIZE_MB = 512
+
+# Events newer than this (ms) may not have been ingested by CloudWatch yet, so
+# the time range they're in is never considered to be cached
+INGESTION_DELAY_MS = 2 * 60 * 1000
+
+# --follow polls for new events every FOLLOW_MIN_INTERVAL seconds while events are arriving,
+# backing off to every FOLLOW_MAX_INTERVAL seconds when idle. Each poll asks for events from
+# FOLLOW_OVERLAP_MS before the newest event seen so late ingested events are not missed.
+FOLLOW_MIN_INTERVAL = 0.25
+FOLLOW_MAX_INTERVAL = 2.0
+FOLLOW_OVERLAP_MS = 30 * 1000
+
+# The stack services whose log streams are usually read, and the short names they may be given by
+SERVICE_ALIASES = {'riff-rtc': 'pfm-riffrtc',
+                   'riffdata': 'pfm-riffdata',
+                   'signalmaster': 'pfm-signalmaster',
+                   'web': 'pfm-web',
+                  }
+
+# The log streams of a log group found by describe_log_streams are kept in the stream index
+# for this many seconds
+DEFAULT_STREAM_INDEX_TTL = 5 * 60
+
+# CloudWatch updates a log stream's lastEventTimestamp "typically within an hour", so a stream
+# is assumed to possibly have events up to this long (ms) after its last reported event
+LAST_EVENT_TIMESTAMP_LAG_MS = 60 * 60 * 1000
+
+# bunyan record fields which may hold a request's latency (ms), the first one present is used
+LATENCY_FIELDS = ('latency', 'responseTime', 'response-time', 'res.responseTime', 'duration')
+
+# the stats of at most this many distinct route handlers are kept, any others are combined
+MAX_STATS_ROUTES = 1000
+
+# The columns of an export: column name, the (dotted) bunyan record field and the column type.
+# Fields of the record not exported in a column are kept as JSON in the 'extra' column
+EXPORT_COLUMNS = [
+    ('level', 'level', 'int'),
+    ('name', 'name', 'string'),
+    ('hostname', 'hostname', 'string'),
+    ('pid', 'pid', 'int'),
+    ('route_handler', 'route_handler', 'string'),
+    ('req_method', 'req.method', 'string'),
+    ('req_url', 'req.url', 'string'),
+    ('status_code', 'res.statusCode', 'int'),
+    ('latency', 'latency', 'float'),
+    ('msg', 'msg', 'string'),
+]
+
+# The number of events written to an export file at a time (a parquet row group)
+EXPORT_ROW_GROUP_SIZE = 50000
+
+# A Logs Insights query returns at most this many rows, a time range with more matching
+# events is split in half and queried again
+INSIGHTS_MAX_ROWS = 10000
+
+# The time range of a Logs Insights events query (ms), a smaller range returns fewer rows
+INSIGHTS_SLICE_MS = 5 * 60 * 1000
+
+# Logs Insights query results are polled every INSIGHTS_MIN_POLL seconds growing to INSIGHTS_MAX_POLL
+INSIGHTS_MIN_POLL = 0.5
+INSIGHTS_MAX_POLL = 5.0
+
+# filter_log_events accepts at most this many log stream names in a single request
+MAX_FILTER_STREAMS = 100
 
-client = boto3.client('logs')
+# The bunyan record fields which are always logged as JSON numbers, so a numeric where comparison of
+# one of them can be evaluated by CloudWatch without missing records logging the number as a string
+WHERE_NUMERIC_FIELDS = ('level', 'pid', 'res.statusCode') + LATENCY_FIELDS
 
+# bunyan level names and their numeric values, so a where expression can use e.g. level >= warn
+BUNYAN_LEVELS = {'trace': 10, 'debug': 20, 'info': 30, 'warn': 40, 'error': 50, 'fatal': 60}
+
+# The tokens of a where expression
+WHERE_TOKEN_RE = re.compile(r"""\s*(?:(?P<paren>[()])
+                                 |(?P<op>==|!=|<=|>=|!~|=|<|>|~|&&|\|\||!)
+                                 |(?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+                                 |(?P<number>-?\d+(?:\.\d+)?(?![\w.:-]))
+                                 |(?P<word>[^\s()=!<>~"'&|]+))""", re.VERBOSE)
+
+WHERE_KEYWORDS = {'and': 'and', '&&': 'and', 'or': 'or', '||': 'or', 'not': 'not', '!': 'not'}
+
+
+def _highlight(x, fg='green', err=False):
+    """Write to the console, highlighting the text in green (by default)
+
+    _highlight will also convert any object not a string to a json string
+    and write that instead.
+    """
+    if not isinstance(x, str):
+        x = json.dumps(x, sort_keys=True, indent=2)
+    click.secho(x, fg=fg, err=err)
+
+
+def _log_group_name(swarm_name):
+    """Get the name of the CloudWatch log group of the named swarm
+
+    It looks like the docker swarm stack that we deploy has a standard
+    name for the log group, ie stack name + '-lg'
+    We are using a standard stack name of swarm env name (ie staging, beta, prod...)
+    + 'swarm'
+    """
+    return swarm_name + 'swarm-lg'
+
+
+def _parse_time(value):
+    """Convert a commandline time value to milliseconds since the epoch
+
+    The value may be 'now', a time relative to now (a number followed by
+    s, m, h or d e.g. '15m' is 15 minutes ago) or an ISO 8601 date/time
+    (e.g. '2021-04-19T13:30') which is interpreted as local time unless
+    it includes a utc offset.
+    """
+    if value == 'now':
+        return int(time.time() * 1000)
+
+    relative = re.fullmatch(r'(?P<count>\d+)(?P<unit>[smhd])', value)
+    if relative:
+        seconds_ago = int(relative.group('count')) * TIME_UNITS[relative.group('unit')]
+        return int((time.time() - seconds_ago) * 1000)
+
+    return int(datetime.fromisoformat(value).timestamp() * 1000)
+
+
+def _time_option_callback(ctx, param, value):
+    """click callback converting a time option value to milliseconds since the epoch
+    """
+    try:
+        return _parse_time(value)
+    except ValueError:
+        raise click.BadParameter('\'{}\' is not "now", a relative time (15m, 2h, 1d) or an ISO 8601 date/time'
+                                 .format(value))
+
+
+def _get_logs_client(region, max_workers=10):
+    """Create a CloudWatch Logs client which can be shared by max_workers threads
+
+    boto3 clients are thread safe, but each thread making a request concurrently
+    needs its own connection so the pool must be at least as large as the
+    number of workers.
+    """
+    return boto3.client('logs', region_name=region,
+                        config=Config(max_pool_connections=max_workers))
 
-# TODO get this from the commandline
-swarmName = 'staging'
 
-#response = client.describe_log_groups(#logGroupNamePrefix='string',
-#                                      #nextToken='string',
-#                                      limit=10)
+def _call_with_backoff(operation, max_attempts=8, base_delay=0.25, max_delay=10.0, **kwargs):
+    """Call a boto3 client operation, retrying with exponential backoff when throttled
+
+    Fetching many streams at once easily exceeds the CloudWatch Logs request rate
+    quotas, so throttling is expected and is retried using "full jitter" backoff
+    (see https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/).
+    Any other error is raised immediately.
+    """
+    attempt = 0
+    while True:
+        try:
+            return operation(**kwargs)
+        except ClientError as e:
+            attempt += 1
+            if e.response['Error']['Code'] not in THROTTLING_ERROR_CODES or attempt >= max_attempts:
+                raise
+            time.sleep(random.uniform(0, min(max_delay, base_delay * 2 ** attempt)))
+
+
+def _describe_log_streams(client, log_group_name, prefix):
+    """Get the name and time span of every log stream in the log group whose name starts with prefix
+
+    Returns a list of dicts: { 'name', 'first', 'last' } where first and last are the
+    timestamps of the first and (last known) last events in the stream or None if
+    the stream has no events.
+
+    Note: describe_log_streams can't order by LastEventTime when given a prefix,
+    so all pages of streams with the prefix must be read.
+    """
+    kwargs = {'logGroupName': log_group_name, 'logStreamNamePrefix': prefix}
+    streams = []
+    while True:
+        response = _call_with_backoff(client.describe_log_streams, **kwargs)
+        streams.extend({'name': ls['logStreamName'],
+                        'first': ls.get('firstEventTimestamp'),
+                        'last': max(ls.get('lastEventTimestamp', 0), ls.get('lastIngestionTime', 0)) or None,
+                       }
+                       for ls in response['logStreams'])
+        if 'nextToken' not in response:
+            return streams
+        kwargs['nextToken'] = response['nextToken']
+
+
+class StreamIndex:
+    """A local index of the log streams of log groups and the time span of their events
+
+    Docker for AWS creates a log stream for every task (container) so a log
+    group accumulates hundreds of streams for tasks which no longer exist.
+    The index lets a query open only the streams whose events may overlap its
+    time window without describing every stream of the group every time.
+
+    The streams with a prefix are described again when their entry in the
+    index is older than ttl seconds, or was described before the end of the
+    query's window (streams of tasks started since then would be missing).
+    The index is a json file in the cache dir, it may be used by several
+    threads (e.g. the shards of stats) at once.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, ttl=DEFAULT_STREAM_INDEX_TTL):
+        self.ttl = ttl
+        self.index_path = os.path.join(cache_dir, 'streams.json')
+        self.lock = threading.Lock()
+
+        os.makedirs(cache_dir, exist_ok=True)
+        try:
+            with open(self.index_path) as index_file:
+                self.entries = json.load(index_file)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def streams(self, client, log_group_name, prefix, end_time=None):
+        """Get the streams of the log group with the prefix (see _describe_log_streams)
+
+        end_time (ms) is the end of the window the streams are wanted for, None if it is open ended.
+        """
+        key = '{}/{}'.format(log_group_name, prefix)
+        with self.lock:
+            entry = self.entries.get(key)
+            if (entry is None or time.time() - entry['described'] > self.ttl
+                    or end_time is None or end_time > entry['described'] * 1000):
+                entry = {'described': time.time(), 'streams': _describe_log_streams(client, log_group_name, prefix)}
+                self.entries[key] = entry
+                self._save()
+            return entry['streams']
+
+    def _save(self):
+        """Write the index (the lock must be held)
+        """
+        tmp_path = '{}.{}.{}'.format(self.index_path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'w') as index_file:
+            json.dump(self.entries, index_file)
+        os.replace(tmp_path, self.index_path)
+
+
+def _discover_log_streams(client, log_group_name, prefix, start_time, end_time, stream_index=None):
+    """Get the names of the log streams with the prefix which may have events in [start_time, end_time)
+
+    Streams with no events, streams whose first event is after the window and
+    streams whose last event is well before the window (see
+    LAST_EVENT_TIMESTAMP_LAG_MS) are skipped. The streams are ordered by their
+    last event, most recent first.
+    """
+    if stream_index is not None:
+        streams = stream_index.streams(client, log_group_name, prefix, end_time)
+    else:
+        streams = _describe_log_streams(client, log_group_name, prefix)
+
+    overlapping = [ls for ls in streams
+                   if ls['first'] is not None and ls['first'] < end_time
+                      and ls['last'] + LAST_EVENT_TIMESTAMP_LAG_MS >= start_time]
+    overlapping.sort(key=lambda ls: ls['last'], reverse=True)
+    return [ls['name'] for ls in overlapping]
+
+
+def _service_option_callback(ctx, param, value):
+    """click callback converting a service's short name (see SERVICE_ALIASES) to the stack service name
+    """
+    return SERVICE_ALIASES.get(value, value)
+
+
+def _fetch_stream_pages(client, log_group_name, log_stream_name, start_time, end_time):
+    """Generate the pages of events of a log stream whose timestamp is in [start_time, end_time)
+
+    get_log_events returns at most 1MB (10,000 events) per call so the
+    nextForwardToken is followed until it stops changing, which is how
+    CloudWatch signals that the end of the requested time range was reached.
+
+    Each page is a list of events, each event has the logStreamName added to it.
+    """
+    kwargs = {'logGroupName': log_group_name,
+              'logStreamName': log_stream_name,
+              'startTime': start_time,
+              'endTime': end_time,
+              'startFromHead': True,
+             }
+    token = None
+    while True:
+        response = _call_with_backoff(client.get_log_events, **kwargs)
+        for event in response['events']:
+            event['logStreamName'] = log_stream_name
+        if response['events']:
+            yield response['events']
+
+        if response['nextForwardToken'] == token:
+            return
+        token = kwargs['nextToken'] = response['nextForwardToken']
+
+
+def _fetch_stream_events(client, log_group_name, log_stream_name, start_time, end_time):
+    """Get all events of a log stream whose timestamp is in [start_time, end_time) ordered by timestamp
+    """
+    events = [event for page in _fetch_stream_pages(client, log_group_name, log_stream_name, start_time, end_time)
+                    for event in page]
+    events.sort(key=lambda e: e['timestamp'])
+    return events
+
+
+def _filter_stream_events(client, log_group_name, log_stream_names, filter_pattern, start_time, end_time):
+    """Get the events of the log streams whose timestamp is in [start_time, end_time) and match the filter_pattern
+
+    The filter pattern is applied by CloudWatch so only matching events are
+    returned. filter_log_events pages are followed using the nextToken until
+    there is no nextToken.
+
+    Returns the list of matching events ordered by timestamp.
+    """
+    kwargs = {'logGroupName': log_group_name,
+              'logStreamNames': list(log_stream_names),
+              'startTime': start_time,
+              'endTime': end_time - 1,      # filter_log_events endTime is inclusive
+              'filterPattern': filter_pattern,
+             }
+    events = []
+    while True:
+        response = _call_with_backoff(client.filter_log_events, **kwargs)
+        events.extend(response['events'])
+        if 'nextToken' not in response:
+            break
+        kwargs['nextToken'] = response['nextToken']
+
+    events.sort(key=lambda e: e['timestamp'])
+    return events
+
+
+class LogCache:
+    """A local on disk store of the events fetched from CloudWatch log streams
+
+    The events of a log stream are stored in segments, each segment holds
+    all the events of the stream in a contiguous time range [start, end).
+    A segment file is append-only, each page of events fetched is appended
+    as a separate gzip member (block) and the index records the time range,
+    offset and length of every block so a query only decompresses the blocks
+    that overlap the time it asks for.
+
+    When a stream's events are requested only the time gaps not covered by a
+    segment are fetched from CloudWatch. A gap which starts where a segment
+    ends is appended to that segment, resuming from the segment's stored
+    nextForwardToken.
+
+    The index is a json file in the cache directory. When the total size of
+    the segments exceeds max_bytes the least recently used segments are
+    removed when the index is saved. Several processes may share the cache,
+    so saving merges the index on disk with this process's segments while
+    holding a lock on index.lock.
+    """
 
-#print([lg['logGroupName'] for lg in response['logGroups']])
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_CACHE_SIZE_MB * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self.lock_path = os.path.join(cache_dir, 'index.lock')
+        self.lock = threading.Lock()
 
-# It looks like the docker swarm stack that we deploy has a standard
-# name for the log group, ie stack name + '-lg'
-# We are using a standard stack name of swarm env name (ie staging, beta, prod...)
-# + 'swarm'
-logGroupName = swarmName + 'swarm-lg'
+        os.makedirs(os.path.join(cache_dir, 'segments'), exist_ok=True)
+        self.segments = self._load_index()
 
-# TODO find the latest log stream with the right prefix
-#logStreamPrefix = 'riff-stack_riff-rtc'
-#response = client.describe_log_streams(logGroupName=logGroupName,
-#                                       #logStreamNamePrefix='string',
-#                                       #orderBy='LogStreamName'|'LastEventTime',
-#                                       orderBy='LastEventTime',
-#                                       descending=True,
-#                                       #nextToken='string',
-#                                       limit=10)
-#
-#print(json.dumps([ls['logStreamName'] for ls in response['logStreams']], sort_keys=True, indent=2))
-#sys.exit()
+    def _load_index(self):
+        """Get the segments recorded in the index file, none if there is no valid index
+        """
+        try:
+            with open(self.index_path) as index_file:
+                return json.load(index_file)['segments']
+        except (OSError, ValueError, KeyError):
+            return []
+
+    def _stream_segments(self, log_group_name, log_stream_name, start_time, end_time):
+        """Get the segments of the stream which overlap [start_time, end_time) ordered by start
+        """
+        with self.lock:
+            return sorted((seg for seg in self.segments
+                           if seg['group'] == log_group_name and seg['stream'] == log_stream_name
+                              and seg['start'] < end_time and seg['end'] > start_time),
+                          key=lambda seg: seg['start'])
+
+    @staticmethod
+    def _gaps(segments, start_time, end_time):
+        """Get the time ranges in [start_time, end_time) which are not covered by the (ordered) segments
+        """
+        gaps = []
+        for seg in segments:
+            if seg['start'] > start_time:
+                gaps.append((start_time, min(seg['start'], end_time)))
+            start_time = max(start_time, seg['end'])
+        if start_time < end_time:
+            gaps.append((start_time, end_time))
+        return gaps
+
+    def covers(self, log_group_name, log_stream_name, start_time, end_time):
+        """Test if all the events of the stream in [start_time, end_time) are in the cache
+        """
+        segments = self._stream_segments(log_group_name, log_stream_name, start_time, end_time)
+        return not self._gaps(segments, start_time, end_time)
+
+    def _append_block(self, segment, events):
+        """Append a block holding the events to the segment's file and index it
+        """
+        lines = ''.join(json.dumps({'timestamp': e['timestamp'],
+                                    'ingestionTime': e.get('ingestionTime'),
+                                    'message': e['message']}) + '\n'
+                        for e in events)
+        block = gzip.compress(lines.encode('utf-8'))
+        path = os.path.join(self.cache_dir, 'segments', segment['file'])
+        timestamps = [e['timestamp'] for e in events]
+        with open(path, 'ab') as segment_file:
+            # another process may be extending the same segment, so the block's offset is only
+            # known once the segment is locked (until the block is written and indexed)
+            fcntl.flock(segment_file, fcntl.LOCK_EX)
+            offset = segment_file.seek(0, os.SEEK_END)
+            segment_file.write(block)
+            segment_file.flush()
+            with self.lock:
+                segment['blocks'].append([min(timestamps), max(timestamps), offset, len(block)])
+                segment['size'] = offset + len(block)
+
+    def _fetch_gap(self, client, log_group_name, log_stream_name, gap_start, gap_end, segment):
+        """Fetch the events of the stream in the gap and append them to the segment
+
+        If the segment ends where the gap starts and has a stored forward token
+        the fetch resumes from that token.
+        """
+        kwargs = {'logGroupName': log_group_name,
+                  'logStreamName': log_stream_name,
+                  'startTime': gap_start,
+                  'endTime': gap_end,
+                  'startFromHead': True,
+                 }
+        token = None
+        if segment['end'] == gap_start and segment.get('token'):
+            token = kwargs['nextToken'] = segment['token']
+
+        while True:
+            try:
+                response = _call_with_backoff(client.get_log_events, **kwargs)
+            except ClientError as e:
+                # a stored token may no longer be accepted, in which case fetch the gap by time
+                if token is None or e.response['Error']['Code'] != 'InvalidParameterException':
+                    raise
+                token = None
+                del kwargs['nextToken']
+                continue
+
+            # resuming from a token may return events before the gap which are already cached
+            events = [e for e in response['events'] if gap_start <= e['timestamp'] < gap_end]
+            if events:
+                self._append_block(segment, events)
+
+            if response['nextForwardToken'] == token:
+                break
+            token = kwargs['nextToken'] = response['nextForwardToken']
+
+        with self.lock:
+            segment['end'] = gap_end
+            segment['token'] = token
+
+    def _read_segment(self, segment, start_time, end_time):
+        """Get the events of the segment in [start_time, end_time)
+
+        Only the blocks which overlap the time range are read and decompressed.
+        """
+        events = []
+        if not segment['blocks']:
+            return events
+
+        path = os.path.join(self.cache_dir, 'segments', segment['file'])
+        with open(path, 'rb') as segment_file:
+            for first, last, offset, length in segment['blocks']:
+                if last < start_time or first >= end_time:
+                    continue
+                segment_file.seek(offset)
+                for line in gzip.decompress(segment_file.read(length)).decode('utf-8').splitlines():
+                    event = json.loads(line)
+                    if start_time <= event['timestamp'] < end_time:
+                        events.append(event)
+        with self.lock:
+            segment['accessed'] = time.time()
+        return events
+
+    def fetch_stream_events(self, client, log_group_name, log_stream_name, start_time, end_time):
+        """Get all events of a log stream whose timestamp is in [start_time, end_time) ordered by timestamp
+
+        Events in time ranges already in the cache are read from disk, the rest
+        are fetched from CloudWatch and added to the cache, except for the most
+        recent events which may not all have been ingested yet.
+        """
+        cacheable_end = min(end_time, int(time.time() * 1000) - INGESTION_DELAY_MS)
+        events = []
+
+        if start_time < cacheable_end:
+            segments = self._stream_segments(log_group_name, log_stream_name, start_time - 1, cacheable_end)
+            for gap_start, gap_end in self._gaps(segments, start_time, cacheable_end):
+                # extend the segment which ends at the start of the gap, or start a new segment
+                segment = next((seg for seg in segments if seg['end'] == gap_start), None)
+                if segment is None:
+                    segment = {'group': log_group_name, 'stream': log_stream_name,
+                               'start': gap_start, 'end': gap_start, 'token': None,
+                               'file': '{}/{}.seg'.format(hashlib.sha1('{}/{}'.format(log_group_name, log_stream_name).encode('utf-8')).hexdigest(),
+                                                          uuid.uuid4().hex),
+                               'size': 0, 'accessed': time.time(), 'blocks': []}
+                    os.makedirs(os.path.dirname(os.path.join(self.cache_dir, 'segments', segment['file'])), exist_ok=True)
+                    with self.lock:
+                        self.segments.append(segment)
+                self._fetch_gap(client, log_group_name, log_stream_name, gap_start, gap_end, segment)
+
+            for segment in self._stream_segments(log_group_name, log_stream_name, start_time, cacheable_end):
+                try:
+                    events.extend(self._read_segment(segment, start_time, cacheable_end))
+                except (OSError, EOFError, zlib.error, ValueError):
+                    # the segment file is gone (e.g. evicted by another run) or has a truncated or corrupt
+                    # block, forget it and fetch its events
+                    with self.lock:
+                        self.segments.remove(segment)
+                    try:
+                        os.remove(os.path.join(self.cache_dir, 'segments', segment['file']))
+                    except FileNotFoundError:
+                        pass
+                    events.extend(_fetch_stream_events(client, log_group_name, log_stream_name,
+                                                       max(start_time, segment['start']), min(cacheable_end, segment['end'])))
+
+        if cacheable_end < end_time:
+            events.extend(_fetch_stream_events(client, log_group_name, log_stream_name,
+                                               max(start_time, cacheable_end), end_time))
+
+        for event in events:
+            event['logStreamName'] = log_stream_name
+        events.sort(key=lambda e: e['timestamp'])
+        return events
+
+    def _merge_index(self):
+        """Merge the segments in the index file, which other processes may have saved, into this process's segments
+
+        A segment known to both keeps the larger of the two versions, and a
+        segment whose file no longer exists (it was evicted) is dropped.
+        """
+        segments = {seg['file']: seg for seg in self._load_index()}
+        for segment in self.segments:
+            saved = segments.get(segment['file'])
+            if saved is None or (segment['end'], segment['size']) >= (saved['end'], saved['size']):
+                if saved is not None:
+                    segment['accessed'] = max(segment['accessed'], saved['accessed'])
+                segments[segment['file']] = segment
+            else:
+                saved['accessed'] = max(segment['accessed'], saved['accessed'])
+
+        self.segments = [seg for seg in segments.values()
+                         if os.path.exists(os.path.join(self.cache_dir, 'segments', seg['file']))]
+
+    def save(self):
+        """Evict the least recently used segments if the cache is too big and write the index
+        """
+        with self.lock, open(self.lock_path, 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self._merge_index()
+
+            self.segments.sort(key=lambda seg: seg['accessed'], reverse=True)
+            total_size = 0
+            for n, segment in enumerate(self.segments):
+                total_size += segment['size']
+                if total_size > self.max_bytes:
+                    for evicted in self.segments[n:]:
+                        try:
+                            os.remove(os.path.join(self.cache_dir, 'segments', evicted['file']))
+                        except FileNotFoundError:
+                            pass
+                    del self.segments[n:]
+                    break
+
+            tmp_path = '{}.{}'.format(self.index_path, os.getpid())
+            with open(tmp_path, 'w') as index_file:
+                json.dump({'segments': self.segments}, index_file)
+            os.replace(tmp_path, self.index_path)
+
+
+def _time_slices(start_time, end_time, slice_ms):
+    """Generate the consecutive [start, end) time ranges of at most slice_ms which cover [start_time, end_time)
+    """
+    while start_time < end_time:
+        yield start_time, min(start_time + slice_ms, end_time)
+        start_time += slice_ms
+
+
+def _fetch_events(client, log_group_name, log_stream_names, start_time, end_time, max_workers=10,
+                  slice_ms=DEFAULT_SLICE_MS, filter_pattern=None, cache=None):
+    """Generate the events of all the given log streams in [start_time, end_time) merged in time order
+
+    The time window is split into slices, and the streams of a slice are
+    fetched concurrently using at most max_workers threads. The next slice
+    is fetched while the events of the current slice are being consumed, so
+    at most 2 slices of events are held in memory regardless of the size of
+    the time window.
+
+    If a CloudWatch filter_pattern is given the events are filtered by
+    CloudWatch (using filter_log_events on groups of streams) and only
+    the matching events are returned.
+
+    If a LogCache is given, streams are read through the cache. When there is
+    also a filter_pattern only the streams whose events in the window are all
+    cached are read from the cache, the others are filtered by CloudWatch.
+    """
+    log_stream_names = list(log_stream_names)
+    cached_names = []
+    if cache is not None:
+        cached_names = [name for name in log_stream_names
+                        if filter_pattern is None or cache.covers(log_group_name, name, start_time, end_time)]
+        log_stream_names = [name for name in log_stream_names if name not in cached_names]
+
+    fetch_tasks = [functools.partial(cache.fetch_stream_events, client, log_group_name, name)
+                   for name in cached_names]
+    if filter_pattern is None:
+        fetch_tasks += [functools.partial(_fetch_stream_events, client, log_group_name, name)
+                        for name in log_stream_names]
+    else:
+        fetch_tasks += [functools.partial(_filter_stream_events, client, log_group_name,
+                                          log_stream_names[i:i + MAX_FILTER_STREAMS], filter_pattern)
+                        for i in range(0, len(log_stream_names), MAX_FILTER_STREAMS)]
+
+    def submit_slice(executor, time_slice):
+        return [executor.submit(fetch_task, *time_slice) for fetch_task in fetch_tasks]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        slices = _time_slices(start_time, end_time, slice_ms)
+        next_slice = next(slices, None)
+        futures = submit_slice(executor, next_slice) if next_slice else []
+        while futures:
+            stream_events = [future.result() for future in futures]
+            next_slice = next(slices, None)
+            futures = submit_slice(executor, next_slice) if next_slice else []
+
+            yield from heapq.merge(*stream_events, key=lambda e: e['timestamp'])
+            del stream_events
+
+
+def _follow_events(client, log_group_name, since, log_stream_prefix=None, log_stream_names=None,
+                   filter_pattern=None, on_new_stream=None):
+    """Generate the events of the log group's streams with a timestamp >= since as they are logged
+
+    Each poll is a single filter_log_events call for all of the streams (those
+    named, in calls of at most MAX_FILTER_STREAMS of them, or all of those with
+    the prefix, so streams created for new tasks are followed as soon as they
+    have events). If a poll returns a nextToken the
+    next poll is made immediately, otherwise the polling interval is halved
+    when events arrived and grown when idle (between FOLLOW_MIN_INTERVAL and
+    FOLLOW_MAX_INTERVAL seconds).
+
+    Every poll overlaps the previous one by FOLLOW_OVERLAP_MS to pick up
+    events which were ingested late, the events already generated are
+    skipped using their eventId.
+
+    on_new_stream is called with the name of each stream the first time an
+    event from it is seen.
+
+    This generator never ends.
+    """
+    base_kwargs = {'logGroupName': log_group_name}
+    if filter_pattern:
+        base_kwargs['filterPattern'] = filter_pattern
+    if log_stream_names:
+        log_stream_names = list(log_stream_names)
+        requests = [dict(base_kwargs, logStreamNames=log_stream_names[i:i + MAX_FILTER_STREAMS])
+                    for i in range(0, len(log_stream_names), MAX_FILTER_STREAMS)]
+    elif log_stream_prefix:
+        requests = [dict(base_kwargs, logStreamNamePrefix=log_stream_prefix)]
+    else:
+        requests = [base_kwargs]
+
+    seen_event_ids = {}
+    known_streams = set()
+    newest = since
+    interval = FOLLOW_MIN_INTERVAL
+    request_index = 0
+    poll_had_events = False
+    while True:
+        kwargs = requests[request_index]
+        if 'nextToken' not in kwargs:
+            kwargs['startTime'] = max(since, newest - FOLLOW_OVERLAP_MS)
+        response = _call_with_backoff(client.filter_log_events, **kwargs)
+
+        new_events = [e for e in response['events'] if e['eventId'] not in seen_event_ids and e['timestamp'] >= since]
+        new_events.sort(key=lambda e: e['timestamp'])
+        for event in new_events:
+            seen_event_ids[event['eventId']] = event['timestamp']
+            newest = max(newest, event['timestamp'])
+            if event['logStreamName'] not in known_streams:
+                known_streams.add(event['logStreamName'])
+                if on_new_stream is not None:
+                    on_new_stream(event['logStreamName'])
+            yield event
+
+        # only the ids of events inside the overlap can be returned again
+        if new_events:
+            poll_had_events = True
+            oldest_needed = newest - FOLLOW_OVERLAP_MS
+            seen_event_ids = {event_id: ts for event_id, ts in seen_event_ids.items() if ts >= oldest_needed}
+
+        if 'nextToken' in response:
+            kwargs['nextToken'] = response['nextToken']
+            continue
+
+        kwargs.pop('nextToken', None)
+        # a poll of more than MAX_FILTER_STREAMS named streams goes on with the next of them
+        request_index = (request_index + 1) % len(requests)
+        if request_index:
+            continue
+
+        if poll_had_events:
+            interval = max(FOLLOW_MIN_INTERVAL, interval / 2)
+        else:
+            interval = min(FOLLOW_MAX_INTERVAL, interval * 1.5)
+        poll_had_events = False
+        time.sleep(interval)
 
-logStreamName = 'riff-stack_riff-rtc.1.d69t3hn9yk66kyb8rava9fp7p-49da7432e96e'
-#                riff-stack_riff-rtc.1.pzvtjiaqyqbh1dvbbsj31kcri-f50f0d1dc7d0
 
 def rmTermCtrlSeq(s):
     """
     Remove Terminal CSI sequences from s
 
+    A CSI sequence cut off by the end of s (e.g. a partial line) is also removed.
+    Most lines have no escape sequences at all, so they're returned as is
+    without running the regular expression.
+
     see https://en.wikipedia.org/wiki/ANSI_escape_code
     """
-    tcsReStr = '\x1b\\[[\x30-\x3F]*[\x20-\x2F]*[\x40-\x7E]'
-    tcsRe =  re.compile(tcsReStr)
-    return re.sub(tcsRe, '', s)
+    if '\x1b' not in s:
+        return s
+    return TERM_CTRL_SEQ_RE.sub('', s)
+
+
+def _decode_message(message):
+    """Decode a raw log message
+
+    Returns a tuple of the decoded message and whether it is a bunyan record.
+    A message which is a JSON object (starts with '{' and ends with '}') is
+    decoded to a dict, any other message (including an empty message and a
+    partial line of JSON) is text which has its terminal control sequences
+    and trailing line end removed.
+    """
+    message = message.rstrip('\r\n')
+    if message[:1] == '{' and message[-1:] == '}':
+        try:
+            record = JSON_DECODE(message)
+            if isinstance(record, dict):
+                return record, True
+        except ValueError:
+            pass
+    return rmTermCtrlSeq(message), False
+
+
+def _decode_events(events, counts):
+    """Generate the events with each message decoded (see _decode_message)
+
+    Each message is decoded exactly once, the decoded message replaces the
+    raw message of the event.
+
+    counts['totalCnt'] and counts['bunyanCnt'] are incremented as events are decoded.
+    """
+    for event in events:
+        event['message'], is_bunyan = _decode_message(event['message'])
+        if is_bunyan:
+            counts['bunyanCnt'] += 1
+        counts['totalCnt'] += 1
+        yield event
+
+
+def _filter_events(events, predicate, counts):
+    """Generate the decoded events whose message satisfies the predicate
+
+    If the predicate is None all events are generated.
+
+    counts['foundCnt'] is incremented for each event generated.
+    """
+    for event in events:
+        if predicate is None or predicate(event['message']):
+            counts['foundCnt'] += 1
+            yield event
+
+
+def _format_events(events, output_format):
+    """Generate the output line(s) for each decoded event
+
+    json:   each message as compact JSON on a single line
+    pretty: each message as indented JSON
+    text:   each message prefixed by its local time and log stream
+    """
+    for event in events:
+        message = event['message']
+        if output_format == 'text':
+            if isinstance(message, dict):
+                message = json.dumps(message, sort_keys=True)
+            yield '{time} {stream}: {msg}'.format(time=datetime.fromtimestamp(event['timestamp'] / 1000).isoformat(sep=' ', timespec='milliseconds'),
+                                                 stream=event['logStreamName'], msg=message)
+        elif output_format == 'pretty':
+            yield json.dumps(message, sort_keys=True, indent=2)
+        else:
+            yield json.dumps(message, sort_keys=True)
+
+
+def _parse_where(expression):
+    """Parse a where expression into its syntax tree
+
+    The grammar of a where expression is:
+        expr       := and_expr ( ('or' | '||') and_expr )*
+        and_expr   := not_expr ( ('and' | '&&') not_expr )*
+        not_expr   := ('not' | '!') not_expr | '(' expr ')' | comparison
+        comparison := field op value
+        op         := '=' | '==' | '!=' | '<' | '<=' | '>' | '>=' | '~' | '!~'
+    field is the (dotted) path of a bunyan record field e.g. res.statusCode
+    value is a number, a quoted string or an unquoted word. '~' and '!~' test
+    if the field does or doesn't match the value as a regular expression.
+    e.g. route_handler = spaIndex and (res.statusCode >= 500 or level >= warn)
+
+    The tree's nodes are tuples:
+        ('or', left, right), ('and', left, right), ('not', operand),
+        ('cmp', field, op, value)
+
+    Raises ValueError if the expression is not valid.
+    """
+    tokens = []
+    pos = 0
+    expression = expression.rstrip()
+    while pos < len(expression):
+        match = WHERE_TOKEN_RE.match(expression, pos)
+        if not match:
+            raise ValueError('unexpected character at: {}'.format(expression[pos:]))
+        pos = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'string':
+            value = re.sub(r'\\(.)', r'\1', value[1:-1])
+        elif kind == 'number':
+            value = float(value) if '.' in value else int(value)
+        elif value.lower() in WHERE_KEYWORDS and kind in ('word', 'op'):
+            kind, value = 'keyword', WHERE_KEYWORDS[value.lower()]
+        tokens.append((kind, value))
+    tokens.append(('end', None))
+
+    pos = 0
+
+    def accept(kind, value=None):
+        nonlocal pos
+        if tokens[pos][0] == kind and (value is None or tokens[pos][1] == value):
+            pos += 1
+            return tokens[pos - 1][1]
+        return None
+
+    def expect(kind, what):
+        value = accept(kind)
+        if value is None:
+            found = 'the end of the expression' if tokens[pos][0] == 'end' else '\'{}\''.format(tokens[pos][1])
+            raise ValueError('expected {what} but found {found}'.format(what=what, found=found))
+        return value
+
+    def parse_binary(op, parse_operand):
+        node = parse_operand()
+        while accept('keyword', op):
+            node = (op, node, parse_operand())
+        return node
+
+    def parse_or():
+        return parse_binary('or', parse_and)
 
-response = client.get_log_events(logGroupName=logGroupName,
-                                 logStreamName=logStreamName,
-                                 #startTime=123,
-                                 #endTime=123,
-                                 #nextToken='string',
-                                 limit=15,
-                                 startFromHead=False)
+    def parse_and():
+        return parse_binary('and', parse_not)
 
-#print(json.dumps(response, sort_keys=True, indent=2))
+    def parse_not():
+        if accept('keyword', 'not'):
+            return ('not', parse_not())
+        if accept('paren', '('):
+            node = parse_or()
+            if not accept('paren', ')'):
+                raise ValueError('expected a closing \')\'')
+            return node
+        field = expect('word', 'a field name')
+        op = expect('op', 'a comparison operator')
+        if op == '==':
+            op = '='
+        value = accept('number')
+        if value is None:
+            value = accept('string')
+        if value is None:
+            value = expect('word', 'a value')
+        return ('cmp', field, op, value)
 
-events = []
-for event in response['events']:
-    print(event)
-    newEvent = {}
-    for k,v in event.items():
-        if k == 'message':
-            v = json.loads(v) if v[0] == '{' else rmTermCtrlSeq(v)
-        elif k == 'timestamp':
-            v = datetime.fromtimestamp(v/1000)
+    tree = parse_or()
+    if tokens[pos][0] != 'end':
+        raise ValueError('unexpected \'{}\' after the end of the expression'.format(tokens[pos][1]))
+    return tree
+
+
+def _where_value(field, value):
+    """Convert the value of a comparison to the type it is compared as for the field
+
+    The level field may be compared to a bunyan level name, the time field
+    may be compared to any time accepted by --start/--end.
+    """
+    if field == 'level' and isinstance(value, str) and value.lower() in BUNYAN_LEVELS:
+        return BUNYAN_LEVELS[value.lower()]
+    if field == 'time' and isinstance(value, str):
+        return _parse_time(value)
+    return value
+
+
+def _bunyan_time(value):
+    """Convert a bunyan record's ISO 8601 time string to milliseconds since the epoch
+    """
+    return int(datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp() * 1000)
+
+
+def _compile_where(tree):
+    """Compile a where expression syntax tree (see _parse_where) into a predicate
+
+    The predicate takes a decoded message and returns True if it satisfies
+    the expression. Text (non bunyan) messages never satisfy an expression.
+    A comparison with a field missing from the record is False.
+    """
+    missing = object()
 
-        newEvent[k] = v
+    def compile_node(node):
+        if node[0] == 'and':
+            left, right = compile_node(node[1]), compile_node(node[2])
+            return lambda r: left(r) and right(r)
+        if node[0] == 'or':
+            left, right = compile_node(node[1]), compile_node(node[2])
+            return lambda r: left(r) or right(r)
+        if node[0] == 'not':
+            operand = compile_node(node[1])
+            return lambda r: not operand(r)
+        return compile_comparison(*node[1:])
 
-    events.append(newEvent)
+    def compile_getter(field):
+        path = field.split('.')
+        convert = _bunyan_time if field == 'time' else None
 
-#print(events)
-#sys.exit()
+        def get(record):
+            for key in path:
+                if not isinstance(record, dict):
+                    return missing
+                record = record.get(key, missing)
+            if convert is not None and isinstance(record, str):
+                try:
+                    return convert(record)
+                except ValueError:
+                    return missing
+            return record
 
-# extract the messages from the events
-rawMsgs = [event['message'] for event in response['events']]
-msgs = [json.loads(msg) if msg[0] == '{' else rmTermCtrlSeq(msg) for msg in rawMsgs]
-#print(json.dumps(msgs, sort_keys=True, indent=2))
+        return get
 
-bunyanMsgs = [m for m in msgs if isinstance(m, dict)]
-#filteredMsgs = [m for m in msgs if isinstance(m, dict) if m['route_handler'] == 'spaIndex']
-filteredMsgs = [m for m in bunyanMsgs if m['route_handler'] == 'spaIndex']
-print(json.dumps(filteredMsgs, sort_keys=True, indent=2))
-counts = { 'foundCnt': len(filteredMsgs), 'bunyanCnt': len(bunyanMsgs), 'totalCnt': len(msgs) }
-print('the number of messages found is: {foundCnt} out of {bunyanCnt} bunyan msgs out of {totalCnt} total msgs'.format(**counts))
+    def compile_comparison(field, op, value):
+        get = compile_getter(field)
+        value = _where_value(field, value)
+
+        if op in ('~', '!~'):
+            search = re.compile(str(value)).search
+            matched = (lambda v: search(str(v)) is not None) if op == '~' else (lambda v: search(str(v)) is None)
+            return lambda r: (lambda v: v is not missing and matched(v))(get(r))
+
+        if isinstance(value, (int, float)):
+            # numeric comparison, the record's value is converted to a number
+            def number(v):
+                if isinstance(v, bool) or v is missing or v is None:
+                    return None
+                try:
+                    return float(v)
+                except (TypeError, ValueError):
+                    return None
+            compare = {'=': lambda v: v == value, '!=': lambda v: v != value,
+                       '<': lambda v: v < value, '<=': lambda v: v <= value,
+                       '>': lambda v: v > value, '>=': lambda v: v >= value}[op]
+            return lambda r: (lambda v: v is not None and compare(v))(number(get(r)))
+
+        if op in ('=', '!='):
+            equal = op == '='
+            return lambda r: (lambda v: v is not missing and (str(v) == value) == equal)(get(r))
+
+        raise ValueError('{op} requires a numeric value for {field}'.format(op=op, field=field))
+
+    root = compile_node(tree)
+    return lambda message: isinstance(message, dict) and root(message)
+
+
+def _where_filter_pattern(tree):
+    """Get the CloudWatch JSON filter pattern which selects a superset of the records matching the where expression
+
+    Only comparisons which CloudWatch evaluates the way the local predicate
+    does are pushed down to the server. CloudWatch compares JSON numbers and
+    strings separately while the local predicate compares a number with a
+    record's value converted to a number and a string with the value
+    converted to a string. So numeric comparisons are only pushed down for
+    the fields which are always numbers (WHERE_NUMERIC_FIELDS), and an
+    equality which could be either type matches both, e.g.
+    (($.f = 500) || ($.f = "500")). Regular expressions, inequalities of
+    strings, negations, the bunyan time string and fields whose names aren't
+    identifiers (e.g. response-time) are never pushed down. An
+    'and' with only one side which can be pushed down pushes down that side,
+    an 'or' can only be pushed down if both sides can be.
+
+    Returns None if no part of the expression can be pushed down.
+    """
+    def pattern(node):
+        if node[0] == 'and':
+            left, right = pattern(node[1]), pattern(node[2])
+            if left and right:
+                return '({} && {})'.format(left, right)
+            return left or right
+        if node[0] == 'or':
+            left, right = pattern(node[1]), pattern(node[2])
+            if left and right:
+                return '({} || {})'.format(left, right)
+            return None
+        if node[0] == 'not':
+            return None
+
+        field, op, value = node[1:]
+        value = _where_value(field, value)
+        if field == 'time' or op in ('~', '!~') or not re.fullmatch(r'[A-Za-z_]\w*(\.[A-Za-z_]\w*)*', field):
+            # a selector like $.response-time isn't valid filter pattern syntax
+            return None
+        if isinstance(value, (int, float)) and field in WHERE_NUMERIC_FIELDS:
+            return '($.{field} {op} {value})'.format(field=field, op=op, value=value)
+        if op != '=':
+            return None
+
+        if isinstance(value, (int, float)):
+            number, string = value, str(value)
+        else:
+            string = value
+            try:
+                number = float(value) if '.' in value else int(value)
+            except ValueError:
+                number = None
+        if number is None or str(number) != string:
+            # the string can only equal the string value of a string
+            return '($.{field} = {string})'.format(field=field, string=json.dumps(string))
+        return '(($.{field} = {number}) || ($.{field} = {string}))'.format(field=field, number=number,
+                                                                          string=json.dumps(string))
+
+    server_pattern = pattern(tree)
+    return '{{ {} }}'.format(server_pattern) if server_pattern else None
+
+
+def _where_option_callback(ctx, param, value):
+    """click callback parsing a where expression option value into its syntax tree
+    """
+    if value is None:
+        return None
+    try:
+        tree = _parse_where(value)
+        _compile_where(tree)
+        return tree
+    except (ValueError, re.error) as e:
+        raise click.BadParameter('{}'.format(e))
+
+
+class LatencySketch:
+    """A mergeable quantile sketch of latencies (ms) with a fixed relative error
+
+    Similar to an HDR histogram or DDSketch, the values are counted in buckets
+    whose bounds grow logarithmically so any quantile is estimated within
+    relative_accuracy of its true value. The number of buckets depends on the
+    range of the values (about 1100 between 1 microsecond and 1 hour at 1%)
+    and not on the number of values added.
+    """
+    MIN_VALUE = 0.001
+
+    def __init__(self, relative_accuracy=0.01):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = collections.Counter()
+        self.zero_count = 0
+        self.count = 0
+        self.max = 0
+
+    def add(self, value):
+        """Add a value to the sketch
+        """
+        self.count += 1
+        self.max = max(self.max, value)
+        if value <= self.MIN_VALUE:
+            self.zero_count += 1
+        else:
+            self.buckets[math.ceil(math.log(value) / self.log_gamma)] += 1
+
+    def merge(self, other):
+        """Add all the values of another sketch (with the same relative accuracy) to this sketch
+        """
+        self.buckets.update(other.buckets)
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q):
+        """Get the estimated value at quantile q (0 <= q <= 1), or None if the sketch is empty
+        """
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                return min(self.max, 2 * self.gamma ** index / (self.gamma + 1))
+        return self.max
+
+
+class RequestStats:
+    """Fixed memory aggregates of decoded bunyan request records
+
+    Keeps per route_handler request counts, latency sketches and status code
+    counts, and per minute record counts by status code class and error level.
+    Instances computed over different events (e.g. shards of a time window)
+    can be combined with merge.
+    """
+
+    def __init__(self, latency_field=None):
+        self.latency_fields = [latency_field] if latency_field else LATENCY_FIELDS
+        self.routes = {}
+        self.minutes = collections.defaultdict(collections.Counter)
+
+    @staticmethod
+    def _field(record, field):
+        for key in field.split('.'):
+            if not isinstance(record, dict):
+                return None
+            record = record.get(key)
+        return record
+
+    def _route(self, name):
+        route = self.routes.get(name)
+        if route is None:
+            if len(self.routes) >= MAX_STATS_ROUTES:
+                name = '(other)'
+                route = self.routes.get(name)
+            if route is None:
+                route = self.routes[name] = {'count': 0, 'status': collections.Counter(), 'latency': LatencySketch()}
+        return route
+
+    def add(self, event):
+        """Add a decoded event to the aggregates, text (non bunyan) messages are ignored
+        """
+        record = event['message']
+        if not isinstance(record, dict):
+            return
+
+        minute = self.minutes[event['timestamp'] // 60000 * 60000]
+        minute['records'] += 1
+        level = record.get('level')
+        if isinstance(level, int):
+            if level >= BUNYAN_LEVELS['error']:
+                minute['error'] += 1
+            elif level >= BUNYAN_LEVELS['warn']:
+                minute['warn'] += 1
+
+        route_name = record.get('route_handler')
+        status = self._field(record, 'res.statusCode') or record.get('statusCode')
+        if route_name is None and status is None:
+            return
+
+        minute['requests'] += 1
+        route = self._route(route_name or '(none)')
+        route['count'] += 1
+        if status is not None:
+            status_class = '{}xx'.format(str(status)[0])
+            route['status'][status_class] += 1
+            minute[status_class] += 1
+
+        for field in self.latency_fields:
+            latency = self._field(record, field)
+            if isinstance(latency, (int, float)) and not isinstance(latency, bool):
+                route['latency'].add(latency)
+                break
+
+    def merge(self, other):
+        """Add the aggregates of another RequestStats to these
+        """
+        for name, other_route in other.routes.items():
+            route = self._route(name)
+            route['count'] += other_route['count']
+            route['status'].update(other_route['status'])
+            route['latency'].merge(other_route['latency'])
+        for minute, counter in other.minutes.items():
+            self.minutes[minute].update(counter)
+
+    def summary(self):
+        """Get the aggregates as a json serializable dict
+        """
+        def quantile(sketch, q):
+            value = sketch.quantile(q)
+            return None if value is None else round(value, 2)
+
+        return {
+            'routes': {name: {'count': route['count'],
+                              'status': dict(route['status']),
+                              'latency': {'count': route['latency'].count,
+                                          'p50': quantile(route['latency'], 0.50),
+                                          'p95': quantile(route['latency'], 0.95),
+                                          'p99': quantile(route['latency'], 0.99),
+                                          'max': route['latency'].max if route['latency'].count else None,
+                                         },
+                             }
+                       for name, route in sorted(self.routes.items(), key=lambda item: -item[1]['count'])},
+            'minutes': [dict(counter, minute=datetime.fromtimestamp(minute / 1000).isoformat(timespec='minutes'))
+                        for minute, counter in sorted(self.minutes.items())],
+        }
+
+
+def _format_stats_table(summary, by_minute=False):
+    """Generate the lines of a table of the stats summary (see RequestStats.summary)
+    """
+    def ms(value):
+        return '-' if value is None else '{:.1f}'.format(value)
+
+    def pct(count, total):
+        return '{:.1f}%'.format(100 * count / total) if total else '-'
+
+    yield '{:<32} {:>9} {:>9} {:>9} {:>9} {:>9} {:>7} {:>7}'.format('route_handler', 'requests', 'p50 ms', 'p95 ms',
+                                                                  'p99 ms', 'max ms', '4xx', '5xx')
+    for name, route in summary['routes'].items():
+        latency = route['latency']
+        yield '{:<32} {:>9} {:>9} {:>9} {:>9} {:>9} {:>7} {:>7}'.format(name[:32], route['count'],
+                                                                      ms(latency['p50']), ms(latency['p95']),
+                                                                      ms(latency['p99']), ms(latency['max']),
+                                                                      pct(route['status'].get('4xx', 0), route['count']),
+                                                                      pct(route['status'].get('5xx', 0), route['count']))
+    if by_minute:
+        yield ''
+        yield '{:<17} {:>9} {:>9} {:>7} {:>7} {:>7} {:>7}'.format('minute', 'records', 'requests', '4xx', '5xx', 'warn', 'error')
+        for minute in summary['minutes']:
+            yield '{:<17} {:>9} {:>9} {:>7} {:>7} {:>7} {:>7}'.format(minute['minute'], minute.get('records', 0),
+                                                                     minute.get('requests', 0),
+                                                                     pct(minute.get('4xx', 0), minute.get('requests', 0)),
+                                                                     pct(minute.get('5xx', 0), minute.get('requests', 0)),
+                                                                     pct(minute.get('warn', 0), minute.get('records', 0)),
+                                                                     pct(minute.get('error', 0), minute.get('records', 0)))
+
+
+def _write_stats(summary, output_format, by_minute=False):
+    """Write the stats summary as JSON or a table
+    """
+    if output_format == 'json':
+        click.echo(json.dumps(summary, indent=2))
+    else:
+        for line in _format_stats_table(summary, by_minute):
+            click.echo(line)
+
+
+def _whole_number(value):
+    """Convert a number (or numeric string) to an int, raising ValueError if it isn't a whole number
+    """
+    if isinstance(value, bool):
+        raise ValueError('{} is not a number'.format(value))
+    if isinstance(value, int):
+        return value
+    number = float(value)
+    if not number.is_integer():
+        raise ValueError('{} is not a whole number'.format(value))
+    return int(number)
+
+
+def _export_row(event):
+    """Flatten a decoded event into a row of the export columns (see EXPORT_COLUMNS)
+
+    Every row has the timestamp and stream columns. A bunyan record's fields
+    are moved to their columns and the remaining fields are JSON in the extra
+    column. A text message is in the text column.
+    """
+    row = {'timestamp': event['timestamp'], 'stream': event['logStreamName']}
+    row.update((column, None) for column, _, _ in EXPORT_COLUMNS)
+    row.update(text=None, extra=None)
+
+    record = event['message']
+    if not isinstance(record, dict):
+        row['text'] = record
+        return row
+
+    record = dict(record)
+    record.pop('time', None)    # the same as the timestamp
+    record.pop('v', None)       # the bunyan log format version
+    for column, field, column_type in EXPORT_COLUMNS:
+        # find the field, copying the nested dicts on its path so the field can be removed
+        *parents, key = field.split('.')
+        container = record
+        for parent in parents:
+            if not isinstance(container.get(parent), dict):
+                break
+            container[parent] = dict(container[parent])
+            container = container[parent]
+        else:
+            if container.get(key) is not None:
+                try:
+                    row[column] = {'int': _whole_number, 'float': float, 'string': str}[column_type](container[key])
+                    del container[key]
+                except (TypeError, ValueError):
+                    # a value which isn't of the column's type is left in extra
+                    pass
+
+    # remove the nested dicts emptied by moving their fields to columns
+    for field in {field.split('.')[0] for _, field, _ in EXPORT_COLUMNS if '.' in field}:
+        if record.get(field) == {}:
+            del record[field]
+
+    if record:
+        row['extra'] = json.dumps(record, sort_keys=True, separators=(',', ':'))
+    return row
+
+
+def _batched(iterable, size):
+    """Generate lists of (at most) size consecutive items of the iterable
+    """
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _export_parquet(events, output_file, row_group_size=EXPORT_ROW_GROUP_SIZE):
+    """Write the decoded events to a parquet file, a row group at a time
+
+    Requires pyarrow (pip install pyarrow), which isn't otherwise needed by
+    the riff-docker scripts so isn't in requirements.txt.
+
+    Returns the number of rows written.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise click.ClickException('Exporting to parquet requires pyarrow (pip install pyarrow), '
+                                   'or use --format ndjson')
+
+    arrow_types = {'int': pa.int64(), 'float': pa.float64(), 'string': pa.string()}
+    schema = pa.schema([('timestamp', pa.timestamp('ms', tz='UTC')),
+                        ('stream', pa.dictionary(pa.int32(), pa.string()))]
+                       + [(column, arrow_types[column_type]) for column, _, column_type in EXPORT_COLUMNS]
+                       + [('text', pa.string()), ('extra', pa.string())])
+
+    row_cnt = 0
+    with pq.ParquetWriter(output_file, schema, compression='zstd') as writer:
+        for batch in _batched(map(_export_row, events), row_group_size):
+            columns = {name: [row[name] for row in batch] for name in schema.names}
+            writer.write_table(pa.Table.from_pydict(columns, schema=schema))
+            row_cnt += len(batch)
+    return row_cnt
+
+
+def _export_ndjson(events, output_file):
+    """Write the decoded events to a newline delimited json file with one compact object per event
+
+    The objects have the same flattened fields as the parquet columns with the
+    empty (null) fields omitted. The file is gzip compressed if its name ends
+    with .gz.
+
+    Returns the number of rows written.
+    """
+    opener = gzip.open if output_file.endswith('.gz') else open
+    row_cnt = 0
+    with opener(output_file, 'wt', encoding='utf-8') as ndjson_file:
+        for row in map(_export_row, events):
+            ndjson_file.write(json.dumps({k: v for k, v in row.items() if v is not None}, separators=(',', ':')))
+            ndjson_file.write('\n')
+            row_cnt += 1
+    return row_cnt
+
+
+def _insights_field(field):
+    """Get the Logs Insights name of a (dotted) bunyan record field
+    """
+    return field if re.fullmatch(r'[A-Za-z_][\w.]*', field) else '`{}`'.format(field)
+
+
+def _where_insights_filter(tree):
+    """Translate a where expression syntax tree (see _parse_where) to a Logs Insights filter expression
+
+    Raises ValueError if the expression compares the bunyan time field, which
+    Logs Insights can't compare as a time (the time window is given by --start
+    and --end).
+    """
+    def translate(node):
+        if node[0] in ('and', 'or'):
+            return '({} {} {})'.format(translate(node[1]), node[0], translate(node[2]))
+        if node[0] == 'not':
+            return 'not {}'.format(translate(node[1]))
+
+        field, op, value = node[1:]
+        if field == 'time':
+            raise ValueError('the time field can\'t be used with Logs Insights, use --start and --end')
+        value = _where_value(field, value)
+        if op in ('~', '!~'):
+            return '{field} {like} /{regex}/'.format(field=_insights_field(field), like='like' if op == '~' else 'not like',
+                                                     regex=str(value).replace('/', '\\/'))
+        return '{field} {op} {value}'.format(field=_insights_field(field), op=op,
+                                             value=value if isinstance(value, (int, float)) else json.dumps(value))
+
+    return translate(tree)
+
+
+def _run_insights_query(client, log_group_name, query_string, start_time, end_time):
+    """Run a Logs Insights query over [start_time, end_time) and wait for its results
+
+    The results are polled for with a growing interval. Logs Insights query time
+    ranges are in whole seconds so the range queried may be up to a second
+    larger than asked for.
+
+    Returns the list of result rows, each row is a dict of field name: value.
+    """
+    query_id = _call_with_backoff(client.start_query,
+                                  logGroupName=log_group_name,
+                                  startTime=start_time // 1000,
+                                  endTime=-(-end_time // 1000),
+                                  queryString=query_string,
+                                  limit=INSIGHTS_MAX_ROWS)['queryId']
+    interval = INSIGHTS_MIN_POLL
+    try:
+        while True:
+            time.sleep(interval)
+            response = _call_with_backoff(client.get_query_results, queryId=query_id)
+            if response['status'] == 'Complete':
+                return [{field['field']: field['value'] for field in row} for row in response['results']]
+            if response['status'] in ('Failed', 'Cancelled', 'Timeout', 'Unknown'):
+                raise click.ClickException('Logs Insights query {status}: {query}'.format(status=response['status'],
+                                                                                         query=query_string))
+            interval = min(INSIGHTS_MAX_POLL, interval * 1.5)
+    except KeyboardInterrupt:
+        client.stop_query(queryId=query_id)
+        raise
+
+
+def _insights_timestamp(value):
+    """Convert a Logs Insights @timestamp value (UTC) to milliseconds since the epoch
+    """
+    return int(datetime.strptime(value, '%Y-%m-%d %H:%M:%S.%f').replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+
+def _insights_stream_filter(log_stream_prefix, log_stream_names):
+    """Get the Logs Insights filter command selecting the log streams
+    """
+    if log_stream_names:
+        return 'filter @logStream in {}'.format(json.dumps(list(log_stream_names)))
+    return 'filter @logStream like /^{}/'.format(re.escape(log_stream_prefix).replace('/', '\\/'))
+
+
+def _insights_slice_events(client, log_group_name, query_string, start_time, end_time):
+    """Get the events in [start_time, end_time) returned by a Logs Insights events query, ordered by timestamp
+
+    If the query returns the maximum number of rows some events are missing,
+    so the time range is split in half (on a whole second, since that's what
+    Logs Insights queries) and each half is queried. A range of less than 2
+    seconds can't be split, its events are truncated to the maximum.
+    """
+    rows = _run_insights_query(client, log_group_name, query_string, start_time, end_time)
+    if len(rows) >= INSIGHTS_MAX_ROWS:
+        if end_time - start_time >= 2000:
+            middle = start_time + max(1000, (end_time - start_time) // 2 // 1000 * 1000)
+            return (_insights_slice_events(client, log_group_name, query_string, start_time, middle)
+                    + _insights_slice_events(client, log_group_name, query_string, middle, end_time))
+        _highlight('More than {max} events were logged in the second at {time}, only {max} of them are included'.format(
+            max=INSIGHTS_MAX_ROWS, time=datetime.fromtimestamp(start_time / 1000).isoformat(sep=' ', timespec='seconds')),
+                   fg='yellow', err=True)
+
+    events = [{'timestamp': _insights_timestamp(row['@timestamp']),
+               'message': row['@message'],
+               'logStreamName': row['@logStream']}
+              for row in rows]
+    events = [e for e in events if start_time <= e['timestamp'] < end_time]
+    events.sort(key=lambda e: e['timestamp'])
+    return events
+
+
+def _insights_events(client, log_group_name, log_stream_prefix, log_stream_names, where, start_time, end_time,
+                     max_workers=10):
+    """Generate the (undecoded) events matching the where expression in [start_time, end_time) using Logs Insights
+
+    The window is split into INSIGHTS_SLICE_MS slices which are queried
+    concurrently, at most max_workers at a time, and the events are generated
+    in time order as the slices complete.
+    """
+    commands = ['fields @timestamp, @message, @logStream', _insights_stream_filter(log_stream_prefix, log_stream_names)]
+    if where:
+        commands.append('filter {}'.format(_where_insights_filter(where)))
+    commands.append('sort @timestamp asc')
+    query_string = ' | '.join(commands)
+
+    slices = _time_slices(start_time, end_time, INSIGHTS_SLICE_MS)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = collections.deque(executor.submit(_insights_slice_events, client, log_group_name, query_string, *time_slice)
+                                    for time_slice in itertools.islice(slices, max_workers))
+        while futures:
+            slice_events = futures.popleft().result()
+            next_slice = next(slices, None)
+            if next_slice is not None:
+                futures.append(executor.submit(_insights_slice_events, client, log_group_name, query_string, *next_slice))
+            yield from slice_events
+
+
+def _insights_stats(client, log_group_name, log_stream_prefix, log_stream_names, where, start_time, end_time,
+                    latency_field=None, shards=4):
+    """Get the request stats summary (like RequestStats.summary) computed by Logs Insights queries
+
+    The percentiles of a route's latency can't be combined from separate time
+    ranges, so that query covers the whole window. The counting queries are
+    split into shards which run concurrently with it and are summed.
+
+    Note: for Logs Insights the requests of a minute are the records with a
+    status code.
+    """
+    latency_fields = [latency_field] if latency_field else LATENCY_FIELDS
+    base = [_insights_stream_filter(log_stream_prefix, log_stream_names)]
+    if where:
+        base.append('filter {}'.format(_where_insights_filter(where)))
+
+    route = 'coalesce(route_handler, "(none)")'
+    latency_query = ' | '.join(base + [
+        'filter ispresent(route_handler) or ispresent(res.statusCode)',
+        'fields {route} as route, coalesce({latency}) as latency_ms'.format(
+            route=route, latency=', '.join(_insights_field(f) for f in latency_fields)),
+        'stats count(*) as requests, count(latency_ms) as latency_count, pct(latency_ms, 50) as p50, '
+        'pct(latency_ms, 95) as p95, pct(latency_ms, 99) as p99, max(latency_ms) as latency_max by route',
+    ])
+    route_status_query = ' | '.join(base + [
+        'filter ispresent(res.statusCode)',
+        'stats count(*) as n by {route} as route, floor(res.statusCode / 100) as status_class'.format(route=route),
+    ])
+    minute_query = ' | '.join(base + [
+        'filter ispresent(level)',
+        'stats count(*) as n by bin(1m) as minute, floor(res.statusCode / 100) as status_class, level',
+    ])
+
+    shard_ms = max(1000, -(-(end_time - start_time) // max(1, shards)))
+    shard_ranges = list(_time_slices(start_time, end_time, shard_ms))
+
+    def number(value):
+        return None if value in (None, '') else float(value)
+
+    with ThreadPoolExecutor(max_workers=1 + 2 * len(shard_ranges)) as executor:
+        latency_future = executor.submit(_run_insights_query, client, log_group_name, latency_query, start_time, end_time)
+        route_status_futures = [executor.submit(_run_insights_query, client, log_group_name, route_status_query, *shard)
+                                for shard in shard_ranges]
+        minute_futures = [executor.submit(_run_insights_query, client, log_group_name, minute_query, *shard)
+                          for shard in shard_ranges]
+
+        routes = {}
+        for row in latency_future.result():
+            routes[row['route']] = {'count': int(number(row['requests'])),
+                                    'status': collections.Counter(),
+                                    'latency': {'count': int(number(row.get('latency_count')) or 0),
+                                                'p50': number(row.get('p50')),
+                                                'p95': number(row.get('p95')),
+                                                'p99': number(row.get('p99')),
+                                                'max': number(row.get('latency_max')),
+                                               },
+                                   }
+        for future in route_status_futures:
+            for row in future.result():
+                if row['route'] in routes and row.get('status_class'):
+                    routes[row['route']]['status']['{}xx'.format(int(number(row['status_class'])))] += int(number(row['n']))
+
+        minutes = collections.defaultdict(collections.Counter)
+        for future in minute_futures:
+            for row in future.result():
+                minute = minutes[_insights_timestamp(row['minute'])]
+                n = int(number(row['n']))
+                minute['records'] += n
+                if row.get('status_class'):
+                    minute['requests'] += n
+                    minute['{}xx'.format(int(number(row['status_class'])))] += n
+                level = number(row.get('level')) or 0
+                if level >= BUNYAN_LEVELS['error']:
+                    minute['error'] += n
+                elif level >= BUNYAN_LEVELS['warn']:
+                    minute['warn'] += n
+
+    return {
+        'routes': {name: dict(route, status=dict(route['status']))
+                   for name, route in sorted(routes.items(), key=lambda item: -item[1]['count'])},
+        'minutes': [dict(counter, minute=datetime.fromtimestamp(minute / 1000).isoformat(timespec='minutes'))
+                    for minute, counter in sorted(minutes.items())],
+    }
+
+
+class LogQuery:
+    """The log events of a swarm selected by the log query commandline options
+
+    Holds the CloudWatch client, the local cache and stream index and the
+    compiled --where expression shared by the fetches of a command.
+    """
+
+    def __init__(self, region, swarm, stack, service, log_stream_names, workers, where, server_filter,
+                 use_cache, cache_dir, cache_size, stream_ttl):
+        self.workers = workers
+        self.log_stream_names = log_stream_names
+        self.log_stream_prefix = ('{stack}_'.format(stack=stack) if service == '*'
+                                  else '{stack}_{service}'.format(stack=stack, service=service))
+        self.client = _get_logs_client(region, workers)
+        self.log_group_name = _log_group_name(swarm)
+        self.cache = LogCache(cache_dir, cache_size * 1024 * 1024) if use_cache else None
+        self.stream_index = StreamIndex(cache_dir, stream_ttl) if use_cache else None
+        self.where = where
+        self.predicate = _compile_where(where) if where else None
+        self.filter_pattern = _where_filter_pattern(where) if where and server_filter else None
+
+    def stream_names(self, start_time, end_time):
+        """Get the names of the log streams to read for the time window
+        """
+        return self.log_stream_names or _discover_log_streams(self.client, self.log_group_name, self.log_stream_prefix,
+                                                              start_time, end_time, self.stream_index)
+
+    def fetch(self, start_time, end_time, workers=None, stream_names=None):
+        """Generate the (undecoded) events in [start_time, end_time) merged in time order
+
+        The stream_names of the window are looked up (see stream_names) unless they are given.
+        """
+        if stream_names is None:
+            stream_names = self.stream_names(start_time, end_time)
+        return _fetch_events(self.client, self.log_group_name, stream_names,
+                             start_time, end_time, workers or self.workers,
+                             filter_pattern=self.filter_pattern, cache=self.cache)
+
+    def check_insights(self):
+        """Raise a click.UsageError if the --where expression can't be used with Logs Insights
+        """
+        if self.where:
+            try:
+                _where_insights_filter(self.where)
+            except ValueError as e:
+                raise click.UsageError(str(e))
+
+    def insights_fetch(self, start_time, end_time):
+        """Generate the (undecoded) events in [start_time, end_time) matching --where found using Logs Insights
+        """
+        return _insights_events(self.client, self.log_group_name, self.log_stream_prefix, self.log_stream_names,
+                                self.where, start_time, end_time, self.workers)
+
+    def insights_stats(self, start_time, end_time, latency_field=None, shards=4):
+        """Get the request stats summary of [start_time, end_time) computed by Logs Insights (see _insights_stats)
+        """
+        return _insights_stats(self.client, self.log_group_name, self.log_stream_prefix, self.log_stream_names,
+                               self.where, start_time, end_time, latency_field, shards)
+
+    def follow(self, since, on_new_stream=None):
+        """Generate the (undecoded) events logged with a timestamp >= since as they arrive (see _follow_events)
+        """
+        return _follow_events(self.client, self.log_group_name, since,
+                              log_stream_prefix=self.log_stream_prefix,
+                              log_stream_names=self.log_stream_names,
+                              filter_pattern=self.filter_pattern,
+                              on_new_stream=on_new_stream)
+
+    def found(self, events, counts):
+        """Generate the events decoded, which satisfy the --where expression
+        """
+        return _filter_events(_decode_events(events, counts), self.predicate, counts)
+
+    def close(self):
+        """Save the local cache
+        """
+        if self.cache is not None:
+            self.cache.save()
+
+
+def _log_query_options(command):
+    """Decorator adding the options which select the log events to a command
+
+    The option values are passed to the command as keyword arguments named
+    for the LogQuery constructor parameters, along with start_time and end_time.
+    """
+    options = [
+        click_region_option,
+        click_swarm_option,
+        click.option('--stack', default='pfm-stk', show_default=True,
+                     help='The name of the docker stack deployed to the swarm.'),
+        click.option('--service', default='pfm-riffrtc', show_default=True, callback=_service_option_callback,
+                     help='The stack service whose log streams will be read, or \'*\' for all of the stack\'s services. '
+                          'riff-rtc, riffdata, signalmaster and web may be used for the pfm- services.'),
+        click.option('--stream', 'log_stream_names', multiple=True,
+                     help='The name of a log stream to read (may be repeated). Overrides --stack and --service.'),
+        click.option('--start', 'start_time', default='1h', show_default=True, callback=_time_option_callback,
+                     help='Start of the time window: "now", relative (15m, 2h, 1d ago) or an ISO 8601 date/time.'),
+        click.option('--end', 'end_time', default='now', show_default=True, callback=_time_option_callback,
+                     help='End of the time window: "now", relative (15m, 2h, 1d ago) or an ISO 8601 date/time.'),
+        click.option('--workers', type=int, default=10, show_default=True,
+                     help='The maximum number of log streams fetched concurrently.'),
+        click.option('--where', 'where', callback=_where_option_callback,
+                     help='Only use bunyan records matching this expression e.g. '
+                          '"route_handler = spaIndex and (res.statusCode >= 500 or level >= warn)".'),
+        click.option('--server-filter/--no-server-filter', default=True, show_default=True,
+                     help='Have CloudWatch apply the parts of the --where expression it can, so fewer events are downloaded.'),
+        click.option('--cache/--no-cache', 'use_cache', default=True, show_default=True,
+                     help='Keep fetched events in a local cache and read them from it when they are requested again.'),
+        click.option('--cache-dir', default=DEFAULT_CACHE_DIR, show_default=True,
+                     help='The directory of the local cache of fetched events.'),
+        click.option('--cache-size', type=int, default=DEFAULT_CACHE_SIZE_MB, show_default=True,
+                     help='The maximum size (MB) of the local cache, the least recently used events are removed first.'),
+        click.option('--stream-ttl', type=int, default=DEFAULT_STREAM_INDEX_TTL, show_default=True,
+                     help='How long (seconds) the log streams found in the log group are cached before looking for new streams.'),
+    ]
+    for option in reversed(options):
+        command = option(command)
+    return command
+
+
+@click.command()
+@_log_query_options
+@click.option('--format', 'output_format', type=click.Choice(['json', 'pretty', 'text']), default='json', show_default=True,
+              help='How each found message is written: a line of JSON, indented JSON or timestamped text.')
+@click.option('--follow', '-f', is_flag=True,
+              help='After the events up to now, keep writing new events as they are logged (until Ctrl-C). '
+                   'Unless --start is given only the events of the last 30 seconds and new events are written.')
+@click.option('--backend', type=click.Choice(['events', 'insights']), default='events', show_default=True,
+              help='Fetch the events (using the cache) or have CloudWatch Logs Insights queries find them, '
+                   'which is better for wide time windows.')
+@click.pass_context
+def events(ctx, start_time, end_time, output_format, follow, backend, **query_options):
+    """Get the log events of a swarm's service in a time window
+
+    All the events in the window from all of the service's log streams
+    are fetched (concurrently) and merged in time order. The events are
+    streamed through decoding, filtering and formatting as they are fetched
+    so any size time window can be scanned.
+
+    The --where expression compares bunyan record fields (use dotted names
+    for nested fields e.g. res.statusCode) using = != < <= > >= and ~ !~
+    (regular expression match), combined with and, or, not and parentheses.
+    level may be compared to the bunyan level names (e.g. level >= warn) and
+    time to any time accepted by --start (e.g. time < 2021-04-19T13:30).
+
+    With --backend insights the --where expression is translated to a Logs
+    Insights query (the time field can't be used) which is run concurrently
+    over slices of the window.
+    """
+    if follow and backend == 'insights':
+        raise click.UsageError('--follow can\'t be used with --backend insights')
+
+    if follow:
+        # events logged in the last FOLLOW_OVERLAP_MS may not all have been ingested yet, so the fetch
+        # stops and following starts that long ago, following picks them up as they are ingested
+        end_time = _parse_time('now') - FOLLOW_OVERLAP_MS
+        if ctx.get_parameter_source('start_time') == click.core.ParameterSource.DEFAULT:
+            start_time = end_time
+
+    query = LogQuery(**query_options)
+    counts = { 'foundCnt': 0, 'bunyanCnt': 0, 'totalCnt': 0 }
+
+    try:
+        if backend == 'insights':
+            query.check_insights()
+            merged_events = query.insights_fetch(start_time, end_time)
+        else:
+            stream_names = query.stream_names(start_time, end_time)
+            merged_events = query.fetch(start_time, end_time, stream_names=stream_names)
+        if follow:
+            def report_new_stream(name):
+                # streams for tasks (re)scheduled since we started are worth pointing out
+                if name not in stream_names:
+                    _highlight('following new log stream: {}'.format(name), fg='yellow', err=True)
+
+            merged_events = itertools.chain(merged_events, query.follow(end_time, on_new_stream=report_new_stream))
+
+        for line in _format_events(query.found(merged_events, counts), output_format):
+            click.echo(line)
+    except ClientError as e:
+        _highlight('{code}: {msg}'.format(code=e.response['Error']['Code'], msg=e.response['Error']['Message']), fg='red')
+        sys.exit(1)
+    except KeyboardInterrupt:
+        # the way to stop following
+        pass
+    finally:
+        query.close()
+
+    click.echo('the number of messages found is: {foundCnt} out of {bunyanCnt} bunyan msgs out of {totalCnt} total msgs'.format(**counts),
+               err=True)
+
+
+@click.command()
+@_log_query_options
+@click.option('--shards', type=int, default=4, show_default=True,
+              help='The number of parts the time window is split into which are aggregated in parallel.')
+@click.option('--latency-field',
+              help='The bunyan record field holding the request latency (ms). '
+                   'Defaults to the first of: {}'.format(', '.join(LATENCY_FIELDS)))
+@click.option('--format', 'output_format', type=click.Choice(['table', 'json']), default='table', show_default=True,
+              help='Write the stats as a table or as JSON.')
+@click.option('--by-minute', is_flag=True,
+              help='Also write the table of status code and error level rates of each minute.')
+@click.option('--backend', type=click.Choice(['events', 'insights']), default='events', show_default=True,
+              help='Aggregate the fetched events or have CloudWatch Logs Insights queries aggregate them, '
+                   'which is better for wide time windows.')
+def stats(start_time, end_time, shards, latency_field, output_format, by_minute, backend, **query_options):
+    """Aggregate the request stats of a swarm's service in a time window
+
+    For each route_handler: the number of requests, the p50/p95/p99 latency
+    and the 4xx/5xx status code rates. For each minute: the status code and
+    warn/error level rates. (--format json always includes the minutes)
+
+    The window is split into shards which are fetched and aggregated in
+    parallel and then merged. The aggregates use a fixed amount of memory so
+    a day or more of logs can be aggregated.
+
+    With --backend insights the aggregates are computed by Logs Insights
+    queries, so none of the events are downloaded (the percentiles are
+    Logs Insights' estimates).
+    """
+    query = LogQuery(**query_options)
+    shard_ms = max(1, -(-(end_time - start_time) // max(1, shards)))
+    shard_workers = max(1, query.workers // max(1, shards))
+
+    def aggregate_shard(shard):
+        shard_stats = RequestStats(latency_field)
+        shard_counts = collections.Counter()
+        for event in query.found(query.fetch(*shard, workers=shard_workers), shard_counts):
+            shard_stats.add(event)
+        return shard_stats, shard_counts
+
+    if backend == 'insights':
+        try:
+            query.check_insights()
+            summary = query.insights_stats(start_time, end_time, latency_field, shards)
+        except ClientError as e:
+            _highlight('{code}: {msg}'.format(code=e.response['Error']['Code'], msg=e.response['Error']['Message']), fg='red')
+            sys.exit(1)
+        finally:
+            query.close()
+
+        _write_stats(summary, output_format, by_minute)
+        return
+
+    request_stats = RequestStats(latency_field)
+    counts = collections.Counter(foundCnt=0, bunyanCnt=0, totalCnt=0)
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, shards)) as executor:
+            for shard_stats, shard_counts in executor.map(aggregate_shard, _time_slices(start_time, end_time, shard_ms)):
+                request_stats.merge(shard_stats)
+                counts.update(shard_counts)
+    except ClientError as e:
+        _highlight('{code}: {msg}'.format(code=e.response['Error']['Code'], msg=e.response['Error']['Message']), fg='red')
+        sys.exit(1)
+    finally:
+        query.close()
+
+    _write_stats(request_stats.summary(), output_format, by_minute)
+    click.echo('aggregated {foundCnt} out of {bunyanCnt} bunyan msgs out of {totalCnt} total msgs'.format(**counts), err=True)
+
+
+@click.command()
+@_log_query_options
+@click.option('--format', 'output_format', type=click.Choice(['parquet', 'ndjson']), default='parquet', show_default=True,
+              help='Write a parquet file (requires pyarrow) or newline delimited json (gzipped if the file name ends with .gz).')
+@click.option('--row-group-size', type=int, default=EXPORT_ROW_GROUP_SIZE, show_default=True,
+              help='The number of events in each parquet row group.')
+@click.argument('output_file', required=True)
+def export(start_time, end_time, output_format, row_group_size, output_file, **query_options):
+    """Export the decoded log events of a swarm's service in a time window to a file
+
+    Common bunyan record fields are written to their own typed columns
+    ({columns}), the other fields of a record are written as JSON to the
+    extra column and text messages to the text column. Events are written
+    in batches as they are fetched so any size time window can be exported.
+    """
+    query = LogQuery(**query_options)
+    counts = { 'foundCnt': 0, 'bunyanCnt': 0, 'totalCnt': 0 }
+
+    try:
+        found_events = query.found(query.fetch(start_time, end_time), counts)
+        if output_format == 'parquet':
+            row_cnt = _export_parquet(found_events, output_file, row_group_size)
+        else:
+            row_cnt = _export_ndjson(found_events, output_file)
+    except ClientError as e:
+        _highlight('{code}: {msg}'.format(code=e.response['Error']['Code'], msg=e.response['Error']['Message']), fg='red')
+        sys.exit(1)
+    finally:
+        query.close()
+
+    _highlight('Exported {rows} events to {file} ({bunyanCnt} bunyan msgs out of {totalCnt} total msgs)'
+               .format(rows=row_cnt, file=output_file, **counts), err=True)
+
+export.help = export.help.format(columns=', '.join(column for column, _, _ in EXPORT_COLUMNS))
+
+
+@click.command()
+@_log_query_options
+@click.argument('corpus_file', required=True)
+def record_corpus(start_time, end_time, corpus_file, **query_options):
+    """Record the raw log events of a time window to a corpus file for bench-decode
+
+    Each event is written undecoded as a line of JSON. The --where option
+    only has an effect on the events CloudWatch filters.
+    """
+    query = LogQuery(**query_options)
+    event_cnt = 0
+    try:
+        with open(corpus_file, 'w', encoding='utf-8') as corpus:
+            for event in query.fetch(start_time, end_time):
+                corpus.write(json.dumps({'timestamp': event['timestamp'],
+                                         'logStreamName': event['logStreamName'],
+                                         'message': event['message']}) + '\n')
+                event_cnt += 1
+    except ClientError as e:
+        _highlight('{code}: {msg}'.format(code=e.response['Error']['Code'], msg=e.response['Error']['Message']), fg='red')
+        sys.exit(1)
+    finally:
+        query.close()
+
+    _highlight('Recorded {cnt} events to {file}'.format(cnt=event_cnt, file=corpus_file), err=True)
+
+
+def _generate_corpus(event_cnt, seed):
+    """Generate the messages of a synthetic corpus resembling the riff-rtc and signalmaster streams
+
+    The same seed always generates the same messages: mostly bunyan request
+    and application records, with some colored (escaped) text, plain text,
+    empty lines and partial lines of JSON.
+    """
+    rng = random.Random(seed)
+    routes = ['/api/users', '/api/meetings/{}', '/api/rooms/{}/join', '/socket.io/', '/health']
+    messages = []
+    for n in range(event_cnt):
+        time_str = datetime.fromtimestamp(1618838400 + n / 50, timezone.utc).isoformat()
+        kind = rng.random()
+        if kind < 0.55:
+            status = rng.choice([200] * 20 + [201, 204, 304, 400, 401, 404, 500, 503])
+            record = {'name': 'riff-rtc', 'hostname': 'c0ffee{:06x}'.format(rng.randrange(16 ** 6)),
+                      'pid': rng.choice([1, 17, 23]), 'level': 50 if status >= 500 else 30,
+                      'req': {'method': rng.choice(['GET', 'GET', 'POST', 'PUT']),
+                              'url': rng.choice(routes).format(rng.randrange(10 ** 6)),
+                              'headers': {'user-agent': 'Mozilla/5.0', 'x-request-id': '{:032x}'.format(rng.getrandbits(128))}},
+                      'res': {'statusCode': status}, 'latency': round(rng.lognormvariate(3, 1.2), 3),
+                      'msg': 'request finished', 'time': time_str, 'v': 0}
+            messages.append(json.dumps(record))
+        elif kind < 0.75:
+            record = {'name': 'signalmaster', 'hostname': 'deadbeef', 'pid': 1,
+                      'level': rng.choice([20, 30, 30, 30, 40, 50]),
+                      'room': 'room-{}'.format(rng.randrange(500)),
+                      'msg': rng.choice(['client joined', 'client left', 'offer relayed', 'ice candidate relayed']),
+                      'time': time_str, 'v': 0}
+            messages.append(json.dumps(record))
+        elif kind < 0.87:
+            messages.append('\x1b[32minfo\x1b[39m: [{}] webpack compiled {} modules in {}ms\r\n'
+                            .format(time_str, rng.randrange(2000), rng.randrange(9000)))
+        elif kind < 0.95:
+            messages.append('npm info lifecycle riff-rtc@{}.{}.{}~start: riff-rtc@{}\n'
+                            .format(rng.randrange(3), rng.randrange(20), rng.randrange(10), time_str))
+        elif kind < 0.98:
+            messages.append('')
+        else:
+            messages.append('{"name":"riff-rtc","msg":"partial line of a long record')
+    return messages
+
+
+@click.command()
+@click.option('--repeat', type=int, default=5, show_default=True,
+              help='The number of times the corpus is decoded, the fastest time is reported.')
+@click.option('--generate', 'generate_cnt', type=int,
+              help='Decode a synthetic corpus of this many events instead of a recorded corpus file.')
+@click.option('--seed', type=int, default=1, show_default=True,
+              help='The seed of the --generate synthetic corpus, the same seed always generates the same events.')
+@click.argument('corpus_file', type=click.File('r', encoding='utf-8'), required=False)
+def bench_decode(repeat, generate_cnt, seed, corpus_file):
+    """Measure how fast the messages of a recorded or generated corpus are decoded
+
+    The corpus is a file written by record-corpus (e.g. of riff-rtc or
+    signalmaster streams), or with --generate a synthetic corpus generated
+    from a fixed seed so timings can be compared between runs and machines.
+    Reports the events decoded per second and how many of the messages are
+    bunyan records, text with escape sequences, plain text and empty.
+    """
+    if (corpus_file is None) == (generate_cnt is None):
+        raise click.UsageError('Either a CORPUS_FILE or --generate must be given')
+
+    if generate_cnt is not None:
+        messages = _generate_corpus(generate_cnt, seed)
+    else:
+        messages = [json.loads(line)['message'] for line in corpus_file if line.strip()]
+    if not messages:
+        raise click.ClickException('The corpus has no events')
+
+    kinds = collections.Counter()
+    for message in messages:
+        is_bunyan = _decode_message(message)[1]
+        kinds['bunyan' if is_bunyan else
+              'empty' if not message.strip() else
+              'escaped text' if '\x1b' in message else
+              'plain text'] += 1
+
+    timings = []
+    for _ in range(max(1, repeat)):
+        counts = collections.Counter()
+        events = ({'message': message} for message in messages)
+        start = time.perf_counter()
+        collections.deque(_decode_events(events, counts), maxlen=0)
+        timings.append(time.perf_counter() - start)
+
+    best = min(timings)
+    click.echo('{cnt} events: {kinds}'.format(cnt=len(messages),
+                                              kinds=', '.join('{} {}'.format(n, kind) for kind, n in kinds.most_common())))
+    _highlight('decoded {rate:,.0f} events/sec (best of {repeat}: {secs:.3f}s, median {median:.3f}s)'
+               .format(rate=len(messages) / best, repeat=len(timings), secs=best,
+                       median=sorted(timings)[len(timings) // 2]))
+
+
+@click.group()
+def cli():
+    """View the logs from AWS CloudWatch of a riff docker swarm.
+
+    Docker for AWS swarms send the logs of every container to a CloudWatch
+    log group named for the swarm (e.g. stagingswarm-lg) with one log stream
+    per container.
+    """
+    pass
 
-sys.exit()
+cli.add_command(events)
+cli.add_command(stats)
+cli.add_command(export)
+cli.add_command(record_corpus)
+cli.add_command(bench_decode)
 
+if __name__ == "__main__":
+    cli(obj={})
@@ -0,0 +1,3762 @@
+# docker_swarm.py
+# author: Michael Jay Lippert mike@rifflearning.com
+# The commands of the docker-swarm.py command line tool for managing docker swarms in the AWS cloud
+
+import time
+import json
+import re
+import sys
+import os
+import random
+import signal
+import socket
+import threading
+import contextlib
+import collections
+import fcntl
+
+import click
+
+# boto3 and botocore take hundreds of ms to import, so they are only imported when a command
+# first needs an AWS client (see _import_aws). The same goes for psutil, subprocess, http.client
+# and concurrent.futures which are imported by the functions which use them. This keeps the
+# commands which don't use AWS (and shell completion) starting quickly.
+boto3 = None
+Config = None
+
+
+class ClientError(Exception):
+    """Stands in for botocore.exceptions.ClientError until botocore is imported (see _import_aws)
+
+    Nothing can raise a ClientError before botocore is imported, so until then
+    the except ClientError clauses can refer to this class which is never raised.
+    """
+
+# The AWS regions where docker swarms may be deployed
+REGIONS = ['us-east-1',
+           'us-east-2',
+           'us-west-1',
+           'us-west-2',
+           'eu-west-1',
+           'eu-west-2']
+
+click_region_option = click.option('--region', type=click.Choice(REGIONS),
+                                   default='us-east-2', show_default=True,
+                                   help='The AWS region name where the docker swarm will be deployed.')
+
+
+def click_inventory_options(f):
+    """Add the options controlling the use of the stack inventory (see StackInventory) to a command"""
+    f = click.option('--inventory-ttl', type=int, default=DEFAULT_INVENTORY_TTL, show_default=True,
+                     help='How long (seconds) the manager instances in the local inventory of a stack can be used.')(f)
+    f = click.option('--refresh', is_flag=True,
+                     help='Look up the stack\'s manager instances in AWS even if they are in the local inventory.')(f)
+    return f
+
+# The bounds of the interval (seconds) between polls for new stack events, polling is fastest while the
+# stack's resources are changing and backs off to the slowest when nothing is happening
+STACK_EVENTS_MIN_POLL_INTERVAL = 2
+STACK_EVENTS_MAX_POLL_INTERVAL = 30
+
+# The stack statuses which begin a new stack operation
+STACK_OPERATION_START_STATUSES = ('CREATE_IN_PROGRESS', 'UPDATE_IN_PROGRESS', 'DELETE_IN_PROGRESS', 'IMPORT_IN_PROGRESS')
+
+# The logical ids of the autoscaling groups of the manager and worker nodes in the Docker for AWS template
+MANAGER_ASG_LOGICAL_ID = 'ManagerAsg'
+WORKER_ASG_LOGICAL_ID = 'NodeAsg'
+
+# Where the inventory of the swarm stacks' managers is kept, and how long (seconds) its entries may be used
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'riff-docker-swarm')
+DEFAULT_INVENTORY_TTL = 15 * 60
+
+# How long (seconds) to wait for ssh to connect to a docker machine before giving up on it
+TUNNEL_CONNECT_TIMEOUT = 30
+
+# How long (seconds) to wait for an ssh master connection to answer a check before deciding it is hung
+SSH_MASTER_CHECK_TIMEOUT = 5
+
+# A watched tunnel is pinged every interval (seconds), and reconnected after this many consecutive failed pings
+TUNNEL_WATCH_INTERVAL = 5
+TUNNEL_WATCH_MAX_FAILURES = 3
+
+# The bounds of the delay (seconds) between attempts to reconnect a watched tunnel
+TUNNEL_RECONNECT_MIN_DELAY = 1
+TUNNEL_RECONNECT_MAX_DELAY = 60
+
+# The number of most recent pings of a watched tunnel its latency stats are over
+TUNNEL_LATENCY_WINDOW = 120
+
+# How long (seconds) to wait for a manager to respond when probing which manager is the fastest to tunnel to
+MANAGER_PROBE_TIMEOUT = 3
+
+# The fields of a stack spec of the provision command and their defaults (see _load_stack_specs)
+STACK_SPEC_DEFAULTS = {'region': 'us-east-2',
+                       'manager_count': 3,
+                       'manager_type': 't2.micro',
+                       'worker_count': 4,
+                       'worker_type': 't2.micro',
+                       'tunnel': False,
+                       'key_file': None,
+                      }
+
+# Tunnels get the first free local port starting at this one (the 1st tunnel gets the port that was always used)
+TUNNEL_BASE_PORT = 2374
+
+# The boto3 session and clients shared by all the helpers used by a command, clients are keyed by (service, region)
+_boto_session = None
+_boto_clients = {}
+_boto_clients_lock = threading.Lock()
+
+# The responses of the read only AWS requests made by a command, so no request is repeated (see _cached_call)
+_aws_responses = {}
+
+# The profiler recording what the command spends its time on, when the --profile option is given (see Profiler)
+_profiler = None
+
+# The AWS error codes which mean a request was throttled
+THROTTLING_ERROR_CODES = ('Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequestsException')
+# The commands bench-startup runs which never need AWS, and the time (ms) they may add to the python
+# interpreter's own startup (which depends on what is installed in its site-packages)
+LOCAL_ONLY_COMMANDS = (['docker-host'], ['list-tunnels'])
+STARTUP_BUDGET_MS = 100
+
+# The docker stack deployed to the swarms (see the Makefile's deploy-stack), and how often (seconds) top refreshes
+DEFAULT_DOCKER_STACK = 'pfm-stk'
+TOP_REFRESH_INTERVAL = 5
+# How long (seconds) to wait for the docker engine api to respond, and how many requests to make to it at once
+DOCKER_API_TIMEOUT = 10
+DOCKER_API_WORKERS = 8
+# The compose/stack config files deployed to a swarm, docker-stack.<DEPLOY_SWARM>.yml follows them (see the Makefile)
+STACK_DEPLOY_FILES = ('docker-compose.yml', 'docker-stack.yml')
+# How long (seconds) deploy waits for the services to converge, and for a rollout making no progress before
+# reporting it as stuck. The services are checked at least every poll interval even when there are no events.
+DEPLOY_TIMEOUT = 600
+DEPLOY_STUCK_AFTER = 120
+DEPLOY_POLL_INTERVAL = 2
+# A service's rollout has failed once this many of its new tasks have failed
+DEPLOY_MAX_TASK_FAILURES = 3
+
+# The container running the riffdata mongo db is found by its data volume (see bin/mongo-backup.sh),
+# and the database and app names are used to name its backups
+MONGO_DATA_VOLUME = 'pfm-stk_pfm-riffdata-db-data'
+MONGO_DB_DEFAULT = 'riff-test'
+MONGO_BACKUP_APP = 'pfm'
+# Backups are compressed in chunks of this size (bytes), each a gzip member or zstd frame of its own so
+# the chunks can be compressed in parallel. They are transferred to and from S3 in parts of PART_SIZE (MiB),
+# with up to TRANSFERS parts being transferred at once.
+BACKUP_CHUNK_SIZE = 4 * 1024 * 1024
+BACKUP_PART_SIZE = 16
+BACKUP_TRANSFERS = 4
+BACKUP_EXTENSIONS = {'gzip': 'gz', 'zstd': 'zst'}
+
+# The port of the swarm's private registry on its nodes (see docker-stack.support.yml), the platform of
+# the images copied to it, and how many blobs are copied to it at once
+SWARM_REGISTRY_PORT = 5000
+SWARM_PLATFORM = 'linux/amd64'
+SYNC_TRANSFERS = 4
+# Images named without a registry are docker hub images
+DOCKER_HUB_REGISTRY = 'registry-1.docker.io'
+# The manifests of images, and of lists of the images of an image for each platform
+IMAGE_MANIFEST_TYPES = ('application/vnd.docker.distribution.manifest.v2+json',
+                        'application/vnd.oci.image.manifest.v1+json')
+IMAGE_INDEX_TYPES = ('application/vnd.docker.distribution.manifest.list.v2+json',
+                     'application/vnd.oci.image.index.v1+json')
+
+
+def _highlight(x, fg='green'):
+    """Write to the console, highlighting the text in green (by default)
+
+    _highlight will also convert any object not a string to a json string
+    and write that instead.
+    """
+    if not isinstance(x, str):
+        x = json.dumps(x, sort_keys=True, indent=2)
+    click.secho(x, fg=fg)
+
+
+class Profiler:
+    """Records how long the AWS requests, subprocesses, process scans and network probes of a command take
+
+    Each thing timed is a span with a category (aws, subprocess, psutil, net),
+    a name, and the thread it ran on. AWS requests are timed using botocore's
+    event hooks on each client (see attach) which also count the retries and
+    throttled attempts of each request.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def record(self, category, name, start, duration, **args):
+        """Record a span which started at start (a perf_counter time) and took duration seconds
+        """
+        span = {'category': category, 'name': name, 'start': start - self.start, 'duration': duration,
+                'thread': threading.get_ident(), 'args': args}
+        with self.lock:
+            self.spans.append(span)
+
+    @contextlib.contextmanager
+    def span(self, category, name, **args):
+        """Time the body of the with statement as a span
+        """
+        start = time.perf_counter()
+        try:
+            yield args
+        finally:
+            self.record(category, name, start, time.perf_counter() - start, **args)
+
+    def attach(self, client):
+        """Time every request made by the boto3 client
+        """
+        client.meta.events.register('before-parameter-build', self._before_call)
+        client.meta.events.register('needs-retry', self._needs_retry)
+        client.meta.events.register('after-call', self._after_call)
+        client.meta.events.register('after-call-error', self._after_call_error)
+
+    @staticmethod
+    def _before_call(model, context, **kwargs):
+        context['profile_operation'] = '{}.{}'.format(model.service_model.service_name, model.name)
+        context['profile_start'] = time.perf_counter()
+        context['profile_throttles'] = 0
+
+    @staticmethod
+    def _needs_retry(response, request_dict, **kwargs):
+        if response is not None:
+            code = response[1].get('Error', {}).get('Code')
+            if code in THROTTLING_ERROR_CODES:
+                request_dict['context']['profile_throttles'] = request_dict['context'].get('profile_throttles', 0) + 1
+
+    def _after_call(self, parsed, context, **kwargs):
+        self._record_call(context, retries=parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0),
+                          error=parsed.get('Error', {}).get('Code'))
+
+    def _after_call_error(self, exception, context, **kwargs):
+        self._record_call(context, retries=None, error=type(exception).__name__)
+
+    def _record_call(self, context, retries, error):
+        if 'profile_start' not in context:
+            return
+        self.record('aws', context['profile_operation'], context['profile_start'],
+                    time.perf_counter() - context['profile_start'], region=context.get('client_region'),
+                    retries=retries, throttles=context.get('profile_throttles', 0), error=error)
+
+    def summary(self):
+        """Get the spans summarized by category and name, the ones which took the longest in total first
+        """
+        groups = collections.OrderedDict()
+        for span in sorted(self.spans, key=lambda span: span['start']):
+            group = groups.setdefault((span['category'], span['name']),
+                                      {'category': span['category'], 'name': span['name'], 'count': 0, 'durations': [],
+                                       'retries': 0, 'throttles': 0, 'errors': 0})
+            group['count'] += 1
+            group['durations'].append(span['duration'])
+            group['retries'] += span['args'].get('retries') or 0
+            group['throttles'] += span['args'].get('throttles') or 0
+            group['errors'] += 1 if span['args'].get('error') else 0
+
+        rows = []
+        for group in groups.values():
+            durations = sorted(group.pop('durations'))
+            group.update(total_ms=1000 * sum(durations), mean_ms=1000 * sum(durations) / len(durations),
+                         max_ms=1000 * durations[-1])
+            rows.append(group)
+        rows.sort(key=lambda row: row['total_ms'], reverse=True)
+
+        return {'wall_ms': 1000 * (time.perf_counter() - self.start), 'spans': rows}
+
+    def chrome_trace(self):
+        """Get the spans as a Chrome trace (load it in chrome://tracing or https://ui.perfetto.dev)
+        """
+        return {'traceEvents': [{'name': span['name'],
+                                 'cat': span['category'],
+                                 'ph': 'X',
+                                 'ts': 1e6 * span['start'],
+                                 'dur': 1e6 * span['duration'],
+                                 'pid': os.getpid(),
+                                 'tid': span['thread'],
+                                 'args': span['args'],
+                                } for span in self.spans],
+                'displayTimeUnit': 'ms'}
+
+
+def _format_profile_table(summary):
+    """Generate the lines of a table of the profile summary (see Profiler.summary)"""
+    yield '{:<10} {:<44} {:>6} {:>10} {:>9} {:>9} {:>7} {:>9} {:>6}'.format('category', 'name', 'count', 'total ms', 'mean ms',
+                                                                           'max ms', 'retries', 'throttles', 'errors')
+    for row in summary['spans']:
+        yield '{:<10} {:<44} {:>6} {:>10.1f} {:>9.1f} {:>9.1f} {:>7} {:>9} {:>6}'.format(row['category'], row['name'][:44],
+                                                                                     row['count'], row['total_ms'],
+                                                                                     row['mean_ms'], row['max_ms'],
+                                                                                     row['retries'], row['throttles'],
+                                                                                     row['errors'])
+    yield 'wall time: {:.1f} ms'.format(summary['wall_ms'])
+
+
+def _write_profile(profiler, profile_format, profile_file):
+    """Write the profile of the command, to the profile_file or stderr
+
+    stdout is left alone so that commands used in shell substitutions can be profiled.
+    """
+    if profile_format == 'chrome':
+        output = json.dumps(profiler.chrome_trace())
+    elif profile_format == 'json':
+        output = json.dumps(profiler.summary(), indent=2)
+    else:
+        output = '\n'.join(_format_profile_table(profiler.summary()))
+
+    if profile_file is None:
+        click.echo(output, err=True)
+    else:
+        with open(profile_file, 'w') as f:
+            f.write(output)
+            f.write('\n')
+
+
+def _profile_span(category, name, **args):
+    """Time the body of a with statement when the command is being profiled (see Profiler.span)"""
+    if _profiler is None:
+        return contextlib.nullcontext(args)
+    return _profiler.span(category, name, **args)
+
+
+def _run(cmd, capture_stdout=False, capture_stderr=False, new_session=False, show_output=False, env=None, timeout=None):
+    """Run the command with no input, returning its subprocess.CompletedProcess
+
+    The command's output is discarded unless it is captured (as text) or shown
+    (written to the console). The command is run in its own session if
+    new_session is True. It is timed when the command is being profiled.
+    A command which runs longer than timeout seconds is killed and
+    subprocess.TimeoutExpired is raised.
+    """
+    import subprocess
+
+    def output(capture):
+        return subprocess.PIPE if capture else None if show_output else subprocess.DEVNULL
+
+    # ssh control commands are named by what they do, docker commands by their subcommand,
+    # everything else by the program run
+    if '-O' in cmd:
+        name = '{} -O {}'.format(cmd[0], cmd[cmd.index('-O') + 1])
+    elif cmd[0] == 'docker':
+        name = ' '.join(cmd[:3])
+    else:
+        name = cmd[0]
+    with _profile_span('subprocess', name):
+        return subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=output(capture_stdout), stderr=output(capture_stderr),
+                              start_new_session=new_session, universal_newlines=True, env=env, timeout=timeout)
+
+
+def _import_aws():
+    """Import boto3 and the botocore names used by this module (see the note on the imports)"""
+    global boto3, Config, ClientError
+
+    if boto3 is None:
+        with _profile_span('import', 'boto3'):
+            import boto3 as boto3_module
+            from botocore.config import Config as BotocoreConfig
+            from botocore.exceptions import ClientError as BotocoreClientError
+        boto3, Config, ClientError = boto3_module, BotocoreConfig, BotocoreClientError
+
+
+def _get_client(service, region, endpoint_url=None):
+    """Get the boto3 client for the AWS service in the region shared by all the helpers of a command
+
+    The endpoint_url is for services compatible with the AWS service (e.g. MinIO for S3).
+
+    Creating a client is expensive (the botocore service model is loaded and
+    a new connection pool is created) so a client is only created the first
+    time it is needed and is then reused. boto3 clients are thread safe but
+    creating them using a shared session is not, hence the lock.
+    """
+    global _boto_session
+
+    with _boto_clients_lock:
+        _import_aws()
+        if _boto_session is None:
+            with _profile_span('aws', 'create session'):
+                _boto_session = boto3.session.Session()
+        key = (service, region, endpoint_url)
+        if key not in _boto_clients:
+            with _profile_span('aws', 'create client {}'.format(service), region=region):
+                _boto_clients[key] = _boto_session.client(service, region_name=region, endpoint_url=endpoint_url,
+                                                          config=Config(max_pool_connections=20))
+            if _profiler is not None:
+                _profiler.attach(_boto_clients[key])
+        return _boto_clients[key]
+
+
+def _cached_call(service, region, operation, use_cache=True, **kwargs):
+    """Make a read only AWS request, or return its response if the same request was already made
+
+    A single command (e.g. tunnel) may need the same describe_* response in
+    several helpers, this makes sure that only the first one goes to AWS.
+    Errors are not cached. Requests whose response is expected to change
+    (e.g. polling a stack's status) should not use this, or should set
+    use_cache False to always make the request (its response replaces the
+    cached one).
+    """
+    key = (service, region, operation, json.dumps(kwargs, sort_keys=True))
+    if not use_cache or key not in _aws_responses:
+        _aws_responses[key] = getattr(_get_client(service, region), operation)(**kwargs)
+    return _aws_responses[key]
+
+
+def _describe_stack(stack_name, region, cached=True):
+    """Get the description of the named cloudformation stack
+
+    cloudformation exceptions will be raised, in particular ClientError
+    when the given stack_name does not exist.
+    """
+    if cached:
+        return _cached_call('cloudformation', region, 'describe_stacks', StackName=stack_name)['Stacks'][0]
+    return _get_client('cloudformation', region).describe_stacks(StackName=stack_name)['Stacks'][0]
+
+
+def _lookup_stack_manager_instances(stack_name, region, use_cache=True):
+    """Look up the manager nodes of a docker swarm created by the named cloudformation Stack in AWS
+
+    returns a list of manager node instance dicts containing the id, ip and dns of the instance
+
+    The AWS responses already received by this command are reused unless use_cache is False
+    (see _cached_call).
+
+    cloudformation, autoscaling and ec2 exceptions will be raised, in particular ClientError
+    when the given stack_name does not exist.
+    """
+    # To get the manager instances, we find the manager autoscaling group and get the
+    # instances from it, then look up that instance and get its IP. (The ASG is responsible
+    # for creating an new instance if one fails, so that the desired number of managers
+    # exist in the swarm, and similarly for the worker nodes)
+    # get the Manager ASG ID
+    mgr_asg_srd = _cached_call('cloudformation', region, 'describe_stack_resource', use_cache=use_cache,
+                               StackName=stack_name, LogicalResourceId=MANAGER_ASG_LOGICAL_ID)
+    mgr_asg_id = mgr_asg_srd['StackResourceDetail']['PhysicalResourceId']
+
+    # get the manager instance IDs (instances being terminated are already gone as far as we're concerned)
+    mgr_instances = _cached_call('autoscaling', region, 'describe_auto_scaling_groups', use_cache=use_cache,
+                                 AutoScalingGroupNames=[mgr_asg_id])['AutoScalingGroups'][0]['Instances']
+    mgr_instance_ids = [ instance['InstanceId'] for instance in mgr_instances
+                         if not instance['LifecycleState'].startswith('Terminat') ]
+    #click.echo('mgr_instance_ids: {resp}'.format(resp=mgr_instance_ids))
+    if not mgr_instance_ids:
+        return []
+
+    # get the manager instance IPs
+    reservations = _cached_call('ec2', region, 'describe_instances', use_cache=use_cache,
+                                InstanceIds=mgr_instance_ids)['Reservations']
+
+    # extract the instance id and ip from the instances of all returned reservations
+    #   Note: a reservation in this situation is a request to start a group of instances
+    #         see https://serverfault.com/questions/749118/aws-ec2-what-is-a-reservation-id-exactly-and-what-does-it-represent
+    return [{'id': inst['InstanceId'],
+             'ip': inst['PublicIpAddress'],
+             'dns': inst['PublicDnsName'],
+            }
+            for res in reservations for inst in res['Instances'] if 'PublicIpAddress' in inst]
+
+
+class StackInventory:
+    """A local inventory of the manager instances of docker swarm stacks
+
+    Looking up a stack's managers takes 3 sequential AWS requests (see
+    _lookup_stack_manager_instances), which is slow for commands used in
+    shell substitutions like get-stack-manager-ip. The inventory answers
+    them locally until its entry for the stack is older than ttl seconds.
+
+    An entry is dropped when looking up the stack fails, and a lookup which
+    finds no managers is not kept. The inventory is a json file in the cache dir,
+    which is shared by the commands (and threads) using it, so each change to
+    it is merged into the file's current entries (see save).
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, ttl=DEFAULT_INVENTORY_TTL):
+        self.ttl = ttl
+        self.inventory_path = os.path.join(cache_dir, 'inventory.json')
+
+        os.makedirs(cache_dir, exist_ok=True)
+        try:
+            with open(self.inventory_path) as inventory_file:
+                self.entries = json.load(inventory_file)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    @staticmethod
+    def _key(stack_name, region):
+        return '{}/{}'.format(region, stack_name)
+
+    def manager_instances(self, stack_name, region, refresh=False):
+        """Get the manager instances of the stack (see _lookup_stack_manager_instances)
+
+        The stack is looked up in AWS if refresh is True or its entry is missing or stale,
+        a refresh also makes the AWS requests this command already made again (e.g. when
+        tunnel --watch looks for a manager to reconnect to).
+        """
+        key = self._key(stack_name, region)
+        entry = self.entries.get(key)
+        if refresh or entry is None or time.time() - entry['cached'] > self.ttl:
+            try:
+                instances = _lookup_stack_manager_instances(stack_name, region, use_cache=not refresh)
+            except ClientError:
+                self.invalidate(stack_name, region)
+                raise
+
+            if not instances:
+                self.invalidate(stack_name, region)
+                return instances
+
+            entry = {'cached': time.time(), 'instances': instances}
+            self.entries[key] = entry
+            self.save(key)
+        return entry['instances']
+
+    def manager_ranking(self, stack_name, region):
+        """Get the ranking of the stack's managers (see _rank_managers), None if there isn't one
+        """
+        entry = self.entries.get(self._key(stack_name, region))
+        if entry is None or time.time() - entry['cached'] > self.ttl:
+            return None
+        return entry.get('ranking')
+
+    def set_manager_ranking(self, stack_name, region, ranking):
+        """Keep the ranking of the stack's managers, until the stack's managers are next looked up
+        """
+        key = self._key(stack_name, region)
+        entry = self.entries.get(key)
+        if entry is not None:
+            entry['ranking'] = ranking
+            self.save(key)
+
+    def invalidate(self, stack_name, region):
+        """Drop the stack's entry, e.g. when one of its instances turned out to be gone
+        """
+        key = self._key(stack_name, region)
+        if self.entries.pop(key, None) is not None:
+            self.save(key)
+
+    def save(self, key):
+        """Write the entry with the key (or its removal) to the inventory
+
+        The inventory file is read again under a lock so the entries other
+        commands and threads wrote since this inventory was read are kept.
+        """
+        with open(self.inventory_path + '.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                with open(self.inventory_path) as inventory_file:
+                    entries = json.load(inventory_file)
+            except (OSError, ValueError):
+                entries = {}
+            if key in self.entries:
+                entries[key] = self.entries[key]
+            else:
+                entries.pop(key, None)
+            self.entries = entries
+
+            tmp_path = '{}.{}.{}'.format(self.inventory_path, os.getpid(), threading.get_ident())
+            with open(tmp_path, 'w') as inventory_file:
+                json.dump(self.entries, inventory_file)
+            os.replace(tmp_path, self.inventory_path)
+
+
+def _get_stack_manager_instances(stack_name, region, refresh=False, inventory_ttl=DEFAULT_INVENTORY_TTL):
+    """Get the IP addresses of all manager nodes of a docker swarm created by the named cloudformation Stack
+
+    returns a list of manager node instance dicts containing the id and ip of the instance
+
+    The instances come from the stack inventory (see StackInventory) unless
+    refresh is True or the inventory's entry is older than inventory_ttl seconds.
+    """
+    try:
+        instances = StackInventory(ttl=inventory_ttl).manager_instances(stack_name, region, refresh)
+    except ClientError as e:
+        _highlight('{code}: {msg}'.format(code=e.response['Error']['Code'], msg=e.response['Error']['Message']), fg='red')
+        instances = []
+
+    return instances
+
+
+def _get_stack_status(stack_name, region, cached=True):
+    """
+    Returns the stack status which will be one of:
+        'CREATE_IN_PROGRESS'
+        'CREATE_FAILED'
+        'CREATE_COMPLETE'
+        'ROLLBACK_IN_PROGRESS'
+        'ROLLBACK_FAILED'
+        'ROLLBACK_COMPLETE'
+        'DELETE_IN_PROGRESS'
+        'DELETE_FAILED'
+        'DELETE_COMPLETE'
+        'UPDATE_IN_PROGRESS'
+        'UPDATE_COMPLETE_CLEANUP_IN_PROGRESS'
+        'UPDATE_COMPLETE'
+        'UPDATE_ROLLBACK_IN_PROGRESS'
+        'UPDATE_ROLLBACK_FAILED'
+        'UPDATE_ROLLBACK_COMPLETE_CLEANUP_IN_PROGRESS'
+        'UPDATE_ROLLBACK_COMPLETE'
+        'REVIEW_IN_PROGRESS'
+
+        cloudformation exceptions will be raised, in particular ClientError
+        when the given stack_name does not exist.
+
+        Use cached=False when the status is expected to change (e.g. waiting for it).
+    """
+    return _describe_stack(stack_name, region, cached)['StackStatus']
+
+
+def _is_terminal_status(status):
+    """Is the stack (or resource) status one which will not change until a new operation is started"""
+    return not status.endswith('_IN_PROGRESS')
+
+
+def _is_failed_status(status):
+    """Is the stack (or resource) status one that means the requested operation did not succeed"""
+    return status.endswith('_FAILED') or 'ROLLBACK' in status
+
+
+def _status_color(status):
+    """The color to use when displaying a stack (or resource) status"""
+    if _is_failed_status(status):
+        return 'red'
+    if status.endswith('_IN_PROGRESS'):
+        return 'yellow'
+    return 'green'
+
+
+def _create_swarm_stack(stack_name, region, key_name, manager_count=3, manager_type='t2.micro',
+                        worker_count=4, worker_type='t2.micro'):
+    """Start creating a CloudFormation stack for a docker swarm using the Docker for AWS template
+
+    returns the id of the new stack
+
+    cloudformation exceptions will be raised, in particular ClientError
+    when a stack with the given stack_name already exists.
+    """
+    # Cloudformation stack template to use. This is the Docker for AWS template (community edition, stable)
+    template_url = 'https://editions-us-east-1.s3.amazonaws.com/aws/stable/Docker.tmpl'
+
+    cloudformation = _get_client('cloudformation', region)
+
+    response = cloudformation.create_stack(
+        StackName=stack_name,
+        TemplateURL=template_url,
+        Parameters=[
+            { 'ParameterKey': 'KeyName',                'ParameterValue': key_name },
+            { 'ParameterKey': 'ManagerSize',            'ParameterValue': str(manager_count) },
+            { 'ParameterKey': 'ManagerInstanceType',    'ParameterValue': manager_type },
+            { 'ParameterKey': 'ClusterSize',            'ParameterValue': str(worker_count) },
+            { 'ParameterKey': 'InstanceType',           'ParameterValue': worker_type },
+            { 'ParameterKey': 'ManagerDiskSize',        'ParameterValue': '20' },
+            { 'ParameterKey': 'ManagerDiskType',        'ParameterValue': 'standard' },
+            { 'ParameterKey': 'WorkerDiskSize',         'ParameterValue': '20' },
+            { 'ParameterKey': 'WorkerDiskType',         'ParameterValue': 'standard' },
+            { 'ParameterKey': 'EnableCloudWatchLogs',   'ParameterValue': 'yes' },
+            { 'ParameterKey': 'EnableSystemPrune',      'ParameterValue': 'no' },
+        ],
+        TimeoutInMinutes=40,
+        Capabilities=[ 'CAPABILITY_IAM' ],
+        OnFailure='ROLLBACK'
+    )
+
+    # This seems more debugging, not sure what a failure would look like, but I'm guessing
+    # there's some exceptions that need catching (this code should be updated when that is
+    # discovered)
+    #click.echo('create_stack response: {resp}'.format(resp=response))
+    return response['StackId']
+
+
+def _load_stack_specs(spec_file):
+    """Load the specs of the docker swarm stacks to provision from a json file
+
+    The file has a list of stacks, and optionally defaults for the stacks' fields:
+
+      {
+        "defaults": {"region": "us-east-2", "manager_type": "t2.small", "tunnel": true},
+        "stacks": [
+          {"name": "staging-Pswarm", "key": "riffswarm_useast2_key", "manager_count": 1, "worker_count": 2},
+          {"name": "nsf-Pswarm", "key": "riffdev_1_uswest2_key", "region": "us-west-2"}
+        ]
+      }
+
+    Each stack must have a name and key (the AWS keypair), the other fields
+    (see STACK_SPEC_DEFAULTS) default to the create command's defaults.
+    key_file is the ssh key used to tunnel to the stack, it defaults to
+    ~/.ssh/<key>.pem if that exists.
+    """
+    try:
+        specs = json.load(spec_file)
+    except ValueError as e:
+        raise click.ClickException('{file} is not valid json: {err}'.format(file=spec_file.name, err=e))
+
+    if isinstance(specs, list):
+        specs = {'stacks': specs}
+
+    defaults = dict(STACK_SPEC_DEFAULTS, **specs.get('defaults', {}))
+    stacks = [dict(defaults, **stack) for stack in specs.get('stacks', [])]
+    for n, stack in enumerate(stacks):
+        unknown_fields = set(stack) - set(STACK_SPEC_DEFAULTS) - {'name', 'key'}
+        if unknown_fields:
+            raise click.ClickException('stack {n} has unknown fields: {fields}'.format(n=n, fields=', '.join(sorted(unknown_fields))))
+        if 'name' not in stack or 'key' not in stack:
+            raise click.ClickException('stack {n} must have a name and a key'.format(n=n))
+        if stack['region'] not in REGIONS:
+            raise click.ClickException('stack {name} has an invalid region {region}'.format(**stack))
+        if stack['key_file'] is None:
+            key_file = os.path.join(os.path.expanduser('~'), '.ssh', '{}.pem'.format(stack['key']))
+            stack['key_file'] = key_file if os.path.exists(key_file) else None
+
+    names = [stack['name'] for stack in stacks]
+    if len(set(names)) != len(names):
+        raise click.ClickException('stack names must be unique')
+
+    return stacks
+
+
+def _provision_stack(spec, tunnel_lock, reserved_ports):
+    """Create a docker swarm stack and, once it is created, find its DNS and managers and tunnel to it
+
+    Creating a stack which already exists just follows it until its current
+    operation finishes. The steps are reported prefixed by the stack's name.
+    The stacks share the tunnel_lock, which is held while a stack picks its
+    tunnel's port (adding it to reserved_ports until the tunnel is registered)
+    and registers its tunnel, but not while connecting.
+
+    returns a summary of the provisioned stack, with an 'error' if a step failed
+    """
+    stack_name = spec['name']
+    region = spec['region']
+    prefix = '[{}] '.format(stack_name)
+    result = {'stack': stack_name, 'region': region, 'status': None, 'dns': None,
+              'manager_ips': [], 'docker_host': None}
+    start = time.monotonic()
+
+    try:
+        try:
+            _create_swarm_stack(stack_name, region, spec['key'], spec['manager_count'], spec['manager_type'],
+                                spec['worker_count'], spec['worker_type'])
+            click.echo('{prefix}creating the stack'.format(prefix=prefix))
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'AlreadyExistsException':
+                raise
+            click.echo('{prefix}the stack already exists, following it'.format(prefix=prefix))
+
+        result['status'] = _wait_for_stack_operation(stack_name, region, prefix)
+        if _is_failed_status(result['status']) or result['status'].startswith('DELETE'):
+            result['error'] = 'the stack is {}'.format(result['status'])
+            return result
+
+        result['dns'] = _get_stack_output(_describe_stack(stack_name, region, cached=False), 'DefaultDNSTarget')
+        mgr_instances = _get_stack_manager_instances(stack_name, region, refresh=True)
+        result['manager_ips'] = [inst['ip'] for inst in mgr_instances]
+        click.echo('{prefix}dns: {dns}, managers: {ips}'.format(prefix=prefix, dns=result['dns'], ips=' '.join(result['manager_ips'])))
+
+        if spec['tunnel'] and mgr_instances:
+            mgr_ip = _rank_managers(mgr_instances)[0]['ip']
+            remote_ip = 'docker@{}'.format(mgr_ip)
+            # ports are allocated and the registry updated by one stack at a time
+            with tunnel_lock:
+                port = _allocate_tunnel_port(TunnelRegistry(), reserved_ports)
+                reserved_ports.add(port)
+            try:
+                master_pid = _open_tunnel(remote_ip, spec['key_file'], port, stack_name, accept_new_host_key=True)
+                if master_pid is None:
+                    result['error'] = 'creating the tunnel failed'
+                    return result
+                with tunnel_lock:
+                    TunnelRegistry().add(master_pid, port, mgr_ip, user='docker', stack_name=stack_name, name=stack_name,
+                                         remote=remote_ip)
+            finally:
+                with tunnel_lock:
+                    reserved_ports.discard(port)
+            result['docker_host'] = 'localhost:{}'.format(port)
+    except ClientError as e:
+        result['error'] = '{code}: {msg}'.format(code=e.response['Error']['Code'], msg=e.response['Error']['Message'])
+    finally:
+        result['elapsed'] = time.monotonic() - start
+
+    return result
+
+
+def _wait_for_stack_operation(stack_name, region, prefix=''):
+    """Wait for the stack's current operation to finish, writing the stack's events as they happen
+
+    The events are polled quickly while they are happening and less often
+    when nothing is happening (see STACK_EVENTS_MIN_POLL_INTERVAL).
+
+    returns the stack's (terminal) status
+
+    cloudformation exceptions will be raised, in particular ClientError
+    when the given stack_name does not exist.
+    """
+    cloudformation = _get_client('cloudformation', region)
+
+    stack = _describe_stack(stack_name, region, cached=False)
+    stack_id = stack['StackId']
+    status = stack['StackStatus']
+
+    last_event_id = None
+    resource_start_times = {}
+    period = STACK_EVENTS_MIN_POLL_INTERVAL
+    while True:
+        events = _get_new_stack_events(cloudformation, stack_id, last_event_id)
+        for event in events:
+            _echo_stack_event(event, resource_start_times, prefix)
+            if _is_stack_event(event, stack_id):
+                status = event['ResourceStatus']
+
+        if _is_terminal_status(status):
+            return status
+
+        # poll quickly while things are happening, back off when they aren't
+        if events:
+            last_event_id = events[-1]['EventId']
+            period = STACK_EVENTS_MIN_POLL_INTERVAL
+        else:
+            period = min(period * 2, STACK_EVENTS_MAX_POLL_INTERVAL)
+        time.sleep(period)
+
+
+def _is_stack_event(event, stack_id):
+    """Is the stack event about the stack itself (rather than about one of its resources)"""
+    return event['PhysicalResourceId'] == stack_id and event['ResourceType'] == 'AWS::CloudFormation::Stack'
+
+
+def _get_new_stack_events(cloudformation, stack_id, last_event_id=None):
+    """Get the events of the stack which happened after the event with last_event_id, oldest first
+
+    describe_stack_events returns the newest events first, so only the pages
+    needed to get back to the last event seen are requested. When there is
+    no last_event_id the events of the stack's latest operation are returned.
+
+    The stack_id should be used rather than the stack name so that the events
+    can still be retrieved once the stack has been deleted.
+    """
+    events = []
+    kwargs = {'StackName': stack_id}
+    while True:
+        page = cloudformation.describe_stack_events(**kwargs)
+        for event in page['StackEvents']:
+            if event['EventId'] == last_event_id:
+                return events[::-1]
+            events.append(event)
+            if (last_event_id is None and _is_stack_event(event, stack_id) and
+                    event['ResourceStatus'] in STACK_OPERATION_START_STATUSES):
+                return events[::-1]
+        if 'NextToken' not in page:
+            return events[::-1]
+        kwargs['NextToken'] = page['NextToken']
+
+
+def _echo_stack_event(event, resource_start_times, prefix=''):
+    """Write a stack event to the console (prefixed by prefix)
+
+    resource_start_times is updated with the time each resource went in progress
+    so that how long the resource took can be reported when it is done.
+    """
+    resource_key = event['PhysicalResourceId'] or event['LogicalResourceId']
+    status = event['ResourceStatus']
+    timestamp = event['Timestamp']
+
+    took = ''
+    if status.endswith('_IN_PROGRESS'):
+        resource_start_times.setdefault(resource_key, timestamp)
+    elif resource_key in resource_start_times:
+        elapsed = timestamp - resource_start_times.pop(resource_key)
+        took = ' ({:.0f}s)'.format(elapsed.total_seconds())
+
+    click.echo('{prefix}{time}: {resource} [{type}] {status}{took}'.format(prefix=prefix,
+                                                                           time=timestamp.astimezone().strftime('%H:%M:%S'),
+                                                                           resource=event['LogicalResourceId'],
+                                                                           type=event['ResourceType'],
+                                                                           status=click.style(status, fg=_status_color(status)),
+                                                                           took=took))
+    if 'ResourceStatusReason' in event and _is_failed_status(status):
+        _highlight('{}    {}'.format(prefix, event['ResourceStatusReason']), fg='red')
+
+
+def _is_docker_swarm_stack(stack):
+    """Was the stack created from the Docker for AWS template (i.e. is it a docker swarm)"""
+    parameter_keys = {param['ParameterKey'] for param in stack.get('Parameters', [])}
+    return 'ManagerSize' in parameter_keys and 'ClusterSize' in parameter_keys
+
+
+def _get_stack_output(stack, output_key):
+    """Get the value of the named output of the stack, None if the stack doesn't have that output (yet)"""
+    return next((output['OutputValue'] for output in stack.get('Outputs', []) if output['OutputKey'] == output_key), None)
+
+
+def _list_swarm_stacks(region):
+    """Get the descriptions of all the docker swarm stacks in the region"""
+    paginator = _get_client('cloudformation', region).get_paginator('describe_stacks')
+    return [stack for page in paginator.paginate() for stack in page['Stacks'] if _is_docker_swarm_stack(stack)]
+
+
+def _asg_health(asg):
+    """Summarize the health of an autoscaling group as the number of healthy instances and the desired number"""
+    healthy = sum(1 for inst in asg['Instances']
+                  if inst['LifecycleState'] == 'InService' and inst['HealthStatus'] == 'Healthy')
+    return {'healthy': healthy, 'desired': asg['DesiredCapacity']}
+
+
+def _get_swarm_info(stack, region):
+    """Get the status, DNS, manager IPs and node health of a docker swarm stack
+
+    Errors are reported in the returned info rather than raised so that one
+    broken stack doesn't hide the state of the rest of the fleet.
+    """
+    info = {'region': region,
+            'stack': stack['StackName'],
+            'status': stack['StackStatus'],
+            'dns': _get_stack_output(stack, 'DefaultDNSTarget'),
+            'manager_ips': [],
+            'managers': None,
+            'workers': None,
+           }
+    try:
+        resources = _get_client('cloudformation', region).describe_stack_resources(StackName=stack['StackId'])['StackResources']
+        asg_ids = {res['LogicalResourceId']: res['PhysicalResourceId'] for res in resources
+                   if res['LogicalResourceId'] in (MANAGER_ASG_LOGICAL_ID, WORKER_ASG_LOGICAL_ID) and 'PhysicalResourceId' in res}
+        if not asg_ids:
+            return info
+
+        asgs = _get_client('autoscaling', region).describe_auto_scaling_groups(AutoScalingGroupNames=list(asg_ids.values()))['AutoScalingGroups']
+        asgs = {asg['AutoScalingGroupName']: asg for asg in asgs}
+        mgr_asg = asgs.get(asg_ids.get(MANAGER_ASG_LOGICAL_ID))
+        wrk_asg = asgs.get(asg_ids.get(WORKER_ASG_LOGICAL_ID))
+        info['managers'] = mgr_asg and _asg_health(mgr_asg)
+        info['workers'] = wrk_asg and _asg_health(wrk_asg)
+
+        mgr_instance_ids = [inst['InstanceId'] for inst in mgr_asg['Instances']] if mgr_asg else []
+        if mgr_instance_ids:
+            reservations = _get_client('ec2', region).describe_instances(InstanceIds=mgr_instance_ids)['Reservations']
+            info['manager_ips'] = [inst['PublicIpAddress'] for res in reservations for inst in res['Instances']
+                                   if 'PublicIpAddress' in inst]
+    except ClientError as e:
+        info['error'] = '{code}: {msg}'.format(code=e.response['Error']['Code'], msg=e.response['Error']['Message'])
+
+    return info
+
+
+def _format_fleet_table(fleet):
+    """Generate the lines of a table of the fleet's swarm infos (see _get_swarm_info)"""
+    def health(asg):
+        return '-' if asg is None else '{healthy}/{desired}'.format(**asg)
+
+    yield '{:<10} {:<24} {:<28} {:>8} {:>8}  {:<48} {}'.format('region', 'stack', 'status', 'managers', 'workers', 'dns', 'manager ips')
+    for info in fleet:
+        line = '{:<10} {:<24} {:<28} {:>8} {:>8}  {:<48} {}'.format(info['region'], info['stack'][:24], info['status'],
+                                                                   health(info['managers']), health(info['workers']),
+                                                                   info['dns'] or '-', ' '.join(info['manager_ips']) or '-')
+        if 'error' in info:
+            line = '{}\n    {}'.format(line, click.style(info['error'], fg='red'))
+        yield line
+
+
+def _probe_tcp_latency(ip, port=22, timeout=MANAGER_PROBE_TIMEOUT):
+    """Time connecting to the port of the ip
+
+    returns the connect time (ms), or None if connecting failed
+    """
+    start = time.perf_counter()
+    try:
+        with _profile_span('net', 'tcp connect', ip=ip, port=port):
+            with socket.create_connection((ip, port), timeout=timeout):
+                pass
+    except OSError:
+        return None
+
+    return (time.perf_counter() - start) * 1000
+
+
+def _probe_ssh_latency(ip, timeout=MANAGER_PROBE_TIMEOUT):
+    """Time an ssh handshake (the key exchange, no authentication is needed) with the ip
+
+    returns the handshake time (ms), or None if it failed
+    """
+    start = time.perf_counter()
+    keyscan = _run(['ssh-keyscan', '-T', str(timeout), ip], capture_stdout=True)
+    if keyscan.returncode != 0 or not keyscan.stdout:
+        return None
+
+    return (time.perf_counter() - start) * 1000
+
+
+def _probe_manager(ip, probe_ssh=False):
+    """Measure how quickly the manager at the ip responds (see _probe_tcp_latency and _probe_ssh_latency)"""
+    probe = {'ip': ip, 'tcp_ms': _probe_tcp_latency(ip), 'ssh_ms': None}
+    if probe_ssh and probe['tcp_ms'] is not None:
+        probe['ssh_ms'] = _probe_ssh_latency(ip)
+    return probe
+
+
+def _rank_managers(mgr_instances, probe_ssh=False):
+    """Probe all the manager instances concurrently
+
+    returns the probes (see _probe_manager) of the managers, fastest first and unreachable ones last
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=len(mgr_instances)) as executor:
+        probes = list(executor.map(lambda inst: _probe_manager(inst['ip'], probe_ssh), mgr_instances))
+
+    latency = 'ssh_ms' if probe_ssh else 'tcp_ms'
+    probes.sort(key=lambda probe: (probe[latency] is None, probe[latency] or 0))
+    return probes
+
+
+def _select_fastest_manager(stack_name, region, mgr_instances, probe_ssh=False, refresh=False, inventory_ttl=DEFAULT_INVENTORY_TTL):
+    """Get the ip of the stack's manager which responds the quickest, None if none of them respond
+
+    The ranking of the managers is kept in the stack inventory (see StackInventory)
+    so they only get probed again when the stack's managers are looked up again.
+    """
+    inventory = StackInventory(ttl=inventory_ttl)
+    ranking = None if refresh else inventory.manager_ranking(stack_name, region)
+
+    mgr_ips = {inst['ip'] for inst in mgr_instances}
+    if (ranking is None or ranking['probe_ssh'] != probe_ssh or
+            {probe['ip'] for probe in ranking['probes']} != mgr_ips):
+        ranking = {'probe_ssh': probe_ssh, 'probes': _rank_managers(mgr_instances, probe_ssh)}
+        inventory.set_manager_ranking(stack_name, region, ranking)
+        click.echo('Manager latencies (ms):')
+    else:
+        click.echo('Manager latencies (ms) when last probed:')
+
+    def ms(value):
+        return 'unreachable' if value is None else '{:.1f}'.format(value)
+
+    for n, probe in enumerate(ranking['probes']):
+        line = '  {ip}: tcp {tcp}'.format(ip=probe['ip'], tcp=ms(probe['tcp_ms']))
+        if probe_ssh:
+            line = '{line}, ssh {ssh}'.format(line=line, ssh=ms(probe['ssh_ms']))
+        _highlight(line, fg='green' if n == 0 else 'white')
+
+    fastest = ranking['probes'][0]
+    if fastest['ssh_ms' if probe_ssh else 'tcp_ms'] is None:
+        return None
+    return fastest['ip']
+
+
+def _start_docker_tunnel(ip, user=None, key_name=None, stack_name=None, name=None, port=None):
+    """Start an ssh tunnel to a network location (IP) running docker.
+
+    This function exists so that it can be used by the tunnel command which
+    tunnels to a manager of a docker swarm running on an AWS Cloudformation stack
+    as well as by the start-docker-tunnel command which can tunnel to an arbitrary
+    docker machine.
+
+    The given ip may be an alias defined in the ~/.ssh/config file which specifies
+    the host user and actual ip address.
+
+    Tunnels are named (by default by the stack they go to, or the ip) and each one
+    gets its own local port, so tunnels to several swarms can be used at once.
+    The tunnel is a port forward added to an ssh master connection to the ip
+    (see _start_ssh_master) so that all tunnels to the same machine share one ssh
+    connection, and a tunnel to an already connected machine takes no ssh handshake.
+    The tunnel is recorded in the tunnel registry (see TunnelRegistry).
+
+    returns the local port of the tunnel or None if it wasn't created
+    """
+    name = name or stack_name or ip
+    remote_ip = ip
+    if user is not None:
+        remote_ip = '{user}@{ip}'.format(user=user, ip=ip)
+
+    registry = TunnelRegistry()
+    existing = registry.find(name)
+    if existing is not None and existing.get('remote') == remote_ip and port in (None, existing['port']):
+        click.echo('The tunnel {name} to {ip} is already running'.format(name=name, ip=ip))
+        _echo_docker_host(existing['port'])
+        return existing['port']
+
+    if existing is not None and port not in (None, existing['port']):
+        # the named tunnel is moving to a different port
+        _stop_tunnel(existing, registry)
+        existing = None
+
+    if port is None:
+        port = existing['port'] if existing is not None else _allocate_tunnel_port(registry)
+
+    # check if we have existing ssh tunnel processes (the named tunnel to a different ip, or whatever is using the port)
+    kill_tunnels, tunnel_cnt = _kill_existing_tunnels(port, registry,
+                                                      prompt='Do you want to kill the existing tunnel(s)\n'
+                                                             'and create a new one to {ip}? (y/n)'.format(ip=ip))
+
+    if tunnel_cnt > 0:
+        if not kill_tunnels:
+            _highlight('Leaving existing tunnels and aborting creating the tunnel to {ip}.'.format(ip=ip))
+            if 'DOCKER_HOST' in os.environ:
+                _highlight('\nYou have DOCKER_HOST exported in your environment:\n  DOCKER_HOST={}'.format(os.environ['DOCKER_HOST']))
+            else:
+                _highlight('\nYou don\'t have DOCKER_HOST exported in your environment you should:\n'
+                           '  export DOCKER_HOST=localhost:{}'.format(port))
+
+            return None
+
+    # create the tunnel
+    master_pid = _open_tunnel(remote_ip, key_name, port, name)
+    if master_pid is None:
+        sys.exit(1)
+
+    registry.add(master_pid, port, ip, user=user, stack_name=stack_name, name=name, remote=remote_ip)
+
+    _echo_docker_host(port)
+    return port
+
+
+def _open_tunnel(remote_ip, key_name, port, name, accept_new_host_key=False):
+    """Forward the local port to the docker socket of remote_ip over its ssh master connection
+
+    The master connection is started if it isn't running (see _start_ssh_master).
+
+    returns the pid of the master connection, or None if the tunnel couldn't be created
+    """
+    master_pid = _start_ssh_master(remote_ip, key_name, accept_new_host_key)
+    if master_pid is None:
+        return None
+
+    tunnel_cmd = _ssh_control_cmd(remote_ip, 'forward', '-L', _forward_spec(port))
+    click.echo('Creating the tunnel {name} to {ip} using cmd:\n  {cmd}'.format(name=name, ip=remote_ip,
+                                                                              cmd=click.style(' '.join(tunnel_cmd), fg='green')))
+    ssh_retcode = _run(tunnel_cmd).returncode
+
+    # if retcode is 0 all is good, otherwise (likely 255) creating the tunnel failed
+    if ssh_retcode != 0:
+        _highlight('Creating the tunnel failed (ssh cmd returned {})'.format(ssh_retcode), fg='red')
+        return None
+
+    return master_pid
+
+
+def _echo_docker_host(port):
+    """Tell the user how to use the tunnel at the local port"""
+    click.echo('\n'.join(
+        [
+            '\nTo use this tunnel w/ your local docker you will need DOCKER_HOST set',
+            'appropriately in your environment. Set it with the command:',
+            click.style('  export DOCKER_HOST=localhost:{port}\n'.format(port=port), fg='cyan'),
+        ]))
+
+
+def _forward_spec(port):
+    """The ssh local forward of the port to the remote docker socket"""
+    return 'localhost:{port}:/var/run/docker.sock'.format(port=port)
+
+
+def _ssh_control_cmd(remote_ip, control_cmd, *args):
+    """The ssh command sending a control command (check, forward, cancel, exit) to the master connection to remote_ip"""
+    return ['ssh', '-o', 'ControlPath={}'.format(os.path.join(DEFAULT_CACHE_DIR, 'ssh-%C')),
+            '-O', control_cmd] + list(args) + [remote_ip]
+
+
+def _get_ssh_master_pid(remote_ip, timeout=None):
+    """Get the pid of the running ssh master connection to remote_ip, None if there isn't one
+
+    A master connection which doesn't answer within timeout seconds is hung, so also None.
+    """
+    import subprocess
+
+    try:
+        check = _run(_ssh_control_cmd(remote_ip, 'check'), capture_stderr=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return None
+    match = re.search(r'pid=(\d+)', check.stderr)
+    if check.returncode != 0 or match is None:
+        return None
+    return int(match.group(1))
+
+
+def _start_ssh_master(remote_ip, key_name=None, accept_new_host_key=False):
+    """Start the ssh master connection to remote_ip if it isn't already running
+
+    Tunnels are added to and removed from the master connection with ssh -O
+    (see _ssh_control_cmd). It runs until it is told to exit when the last tunnel
+    using it is stopped (see _stop_tunnel).
+
+    The master connection checks that the remote is still responding so that
+    it exits (rather than hanging) when the connection is lost. The host key
+    of a remote which isn't in known_hosts is only accepted (and added to
+    known_hosts) if accept_new_host_key is True, e.g. for a new stack.
+
+    returns the pid of the master connection, or None if connecting failed
+    """
+    master_pid = _get_ssh_master_pid(remote_ip)
+    if master_pid is not None:
+        return master_pid
+
+    master_cmd = ['ssh', '-f', '-N', '-M',
+                         '-o', 'ControlPath={}'.format(os.path.join(DEFAULT_CACHE_DIR, 'ssh-%C')),
+                         '-o', 'ControlPersist=yes',
+                         '-o', 'ConnectTimeout={}'.format(TUNNEL_CONNECT_TIMEOUT),
+                         '-o', 'ServerAliveInterval=15',
+                         '-o', 'ServerAliveCountMax=3',
+                         '{remote_ip}'.format(remote_ip=remote_ip)]
+
+    # if a key was supplied add it to the command
+    if key_name is not None:
+        master_cmd[4:4] = ['-i', '{}'.format(key_name)]
+    if accept_new_host_key:
+        master_cmd[4:4] = ['-o', 'StrictHostKeyChecking=accept-new']
+
+    click.echo('Connecting to {ip} using cmd:\n  {cmd}'.format(cmd=click.style(' '.join(master_cmd), fg='green'), ip=remote_ip))
+    # ssh -f returns once it has connected, leaving the master connection running in the background
+    ssh_retcode = _run(master_cmd, new_session=True).returncode
+
+    # if retcode is 0 all is good, otherwise (likely 255) connecting failed
+    master_pid = _get_ssh_master_pid(remote_ip) if ssh_retcode == 0 else None
+    if master_pid is None:
+        _highlight('Connecting to {ip} failed (ssh cmd returned {retcode})'.format(ip=remote_ip, retcode=ssh_retcode), fg='red')
+
+    return master_pid
+
+
+def _stop_tunnel(tunnel, registry, keep_master=False):
+    """Stop a tunnel, and its ssh master connection if no other tunnel is using it (unless keep_master is True)
+    """
+    remote_ip = tunnel.get('remote')
+    if remote_ip is None:
+        # not created by this tool (see TunnelRegistry.reconcile) so it is its own ssh process
+        _kill([tunnel['pid']])
+    else:
+        _highlight('Stopping tunnel {name} on port {port}'.format(**tunnel), fg='green')
+        _run(_ssh_control_cmd(remote_ip, 'cancel', '-L', _forward_spec(tunnel['port'])))
+        if not keep_master and not any(other.get('remote') == remote_ip
+                                       for other in registry.tunnels() if other['port'] != tunnel['port']):
+            _run(_ssh_control_cmd(remote_ip, 'exit'))
+
+    registry.remove(tunnel['port'])
+
+
+def _is_port_in_use(port):
+    """Is something accepting connections on the localhost port"""
+    try:
+        with socket.create_connection(('localhost', port), timeout=1):
+            return True
+    except OSError:
+        return False
+
+
+def _allocate_tunnel_port(registry, reserved_ports=()):
+    """Get the first local port (from TUNNEL_BASE_PORT) which isn't reserved or used by a tunnel or anything else"""
+    used_ports = {tunnel['port'] for tunnel in registry.tunnels()} | set(reserved_ports)
+    port = TUNNEL_BASE_PORT
+    while port in used_ports or _is_port_in_use(port):
+        port += 1
+    return port
+
+
+def _ping_docker(port, timeout=TUNNEL_WATCH_INTERVAL):
+    """Ping the docker engine at the end of the tunnel at the local port
+
+    returns the round trip time (ms), or None if the ping failed
+    """
+    import http.client
+
+    start = time.perf_counter()
+    conn = http.client.HTTPConnection('localhost', port, timeout=timeout)
+    try:
+        with _profile_span('net', 'docker ping', port=port):
+            conn.request('GET', '/_ping')
+            response = conn.getresponse()
+            response.read()
+        if response.status != 200:
+            return None
+    except (OSError, http.client.HTTPException):
+        return None
+    finally:
+        conn.close()
+
+    return (time.perf_counter() - start) * 1000
+
+
+class TunnelStats:
+    """The uptime and rolling latency stats of a watched tunnel
+
+    The tunnel is considered down from its first failed ping until its next
+    successful one. The latency percentiles are over the latest successful pings.
+    """
+
+    def __init__(self, window=TUNNEL_LATENCY_WINDOW):
+        self.started = time.monotonic()
+        self.latencies = collections.deque(maxlen=window)
+        self.pings = 0
+        self.failed_pings = 0
+        self.reconnects = 0
+        self.down_time = 0.0
+        self.down_since = None
+
+    def record_ping(self, latency):
+        """Record the result of a ping (see _ping_docker)
+        """
+        now = time.monotonic()
+        self.pings += 1
+        if latency is None:
+            self.failed_pings += 1
+            if self.down_since is None:
+                self.down_since = now
+        else:
+            self.latencies.append(latency)
+            if self.down_since is not None:
+                self.down_time += now - self.down_since
+                self.down_since = None
+
+    def summary(self):
+        """Get the stats so far
+        """
+        now = time.monotonic()
+        elapsed = now - self.started
+        down_time = self.down_time + (now - self.down_since if self.down_since is not None else 0)
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))] if latencies else None
+
+        return {'elapsed': elapsed,
+                'uptime_pct': 100 * (elapsed - down_time) / elapsed if elapsed else 100.0,
+                'pings': self.pings,
+                'failed_pings': self.failed_pings,
+                'reconnects': self.reconnects,
+                'latency_ms': {'p50': percentile(0.5), 'p95': percentile(0.95), 'max': latencies[-1] if latencies else None},
+               }
+
+
+def _format_tunnel_stats(summary):
+    """Format the stats of a watched tunnel (see TunnelStats.summary) as a single line"""
+    def ms(value):
+        return '-' if value is None else '{:.1f}'.format(value)
+
+    return ('up {uptime:.2f}% of {elapsed:.0f}s, {pings} pings ({failed} failed), {reconnects} reconnects, '
+            'latency ms p50 {p50} p95 {p95} max {max}'.format(uptime=summary['uptime_pct'], elapsed=summary['elapsed'],
+                                                             pings=summary['pings'], failed=summary['failed_pings'],
+                                                             reconnects=summary['reconnects'],
+                                                             p50=ms(summary['latency_ms']['p50']),
+                                                             p95=ms(summary['latency_ms']['p95']),
+                                                             max=ms(summary['latency_ms']['max'])))
+
+
+def _reconnect_tunnel(stack_name, region, port, user, key_name, mgr_ip):
+    """Re-create the stack's tunnel at the local port to a manager the stack has now
+
+    Only the tunnel's forward is cancelled, its ssh master connection may be
+    carrying other forwards (e.g. the registry forward of sync-images) so it
+    is only killed if it doesn't answer a check (it is dead or hung). The
+    stack's managers are looked up again in case the ASG replaced the one the
+    tunnel went to, in which case the tunnel goes to another manager.
+
+    returns the ip of the manager the tunnel now goes to, or None if reconnecting failed
+    """
+    registry = TunnelRegistry()
+    tunnel = registry.find(stack_name)
+    if tunnel is not None:
+        remote_ip = tunnel.get('remote')
+        if remote_ip is not None and _get_ssh_master_pid(remote_ip, timeout=SSH_MASTER_CHECK_TIMEOUT) is None:
+            _highlight('The ssh master connection to {} is not responding, stopping it'.format(remote_ip), fg='yellow')
+            _kill([tunnel['pid']])
+            registry.remove(tunnel['port'])
+        else:
+            _stop_tunnel(tunnel, registry, keep_master=True)
+
+    mgr_ips = [inst['ip'] for inst in _get_stack_manager_instances(stack_name, region, refresh=True)]
+    if not mgr_ips:
+        return None
+    if mgr_ip not in mgr_ips:
+        _highlight('Manager {old} is gone, reconnecting to {new}'.format(old=mgr_ip, new=mgr_ips[0]), fg='yellow')
+        mgr_ip = mgr_ips[0]
+
+    remote_ip = mgr_ip if user is None else '{user}@{ip}'.format(user=user, ip=mgr_ip)
+    master_pid = _open_tunnel(remote_ip, key_name, port, stack_name)
+    if master_pid is None:
+        return None
+
+    registry.add(master_pid, port, mgr_ip, user=user, stack_name=stack_name, name=stack_name, remote=remote_ip)
+    return mgr_ip
+
+
+def _watch_tunnel(stack_name, region, port, user, key_name, mgr_ip, interval=TUNNEL_WATCH_INTERVAL, report_interval=60):
+    """Supervise the stack's tunnel at the local port until interrupted (Ctrl-C)
+
+    The docker engine is pinged through the tunnel every interval seconds. After
+    TUNNEL_WATCH_MAX_FAILURES failed pings in a row the tunnel is reconnected
+    (see _reconnect_tunnel), retrying with exponential backoff until it works.
+    The tunnel's stats (see TunnelStats) are written every report_interval seconds.
+    """
+    stats = TunnelStats()
+    failures = 0
+    delay = TUNNEL_RECONNECT_MIN_DELAY
+    next_report = time.monotonic() + report_interval
+
+    _highlight('Watching the tunnel {name} on port {port}, press Ctrl-C to stop'.format(name=stack_name, port=port))
+    try:
+        while True:
+            latency = _ping_docker(port, timeout=interval)
+            stats.record_ping(latency)
+            if latency is not None:
+                failures = 0
+                delay = TUNNEL_RECONNECT_MIN_DELAY
+            else:
+                failures += 1
+                _highlight('{time}: ping failed ({cnt} in a row)'.format(time=time.strftime('%H:%M:%S'), cnt=failures), fg='yellow')
+
+            if failures >= TUNNEL_WATCH_MAX_FAILURES:
+                reconnected_ip = _reconnect_tunnel(stack_name, region, port, user, key_name, mgr_ip)
+                if reconnected_ip is not None:
+                    mgr_ip = reconnected_ip
+                    stats.reconnects += 1
+                    failures = 0
+                    _highlight('{time}: reconnected to {ip}'.format(time=time.strftime('%H:%M:%S'), ip=mgr_ip))
+                    continue
+
+                # back off (with jitter so a fleet of watchers don't retry in lockstep)
+                time.sleep(delay * random.uniform(0.5, 1.5))
+                delay = min(delay * 2, TUNNEL_RECONNECT_MAX_DELAY)
+                continue
+
+            if time.monotonic() >= next_report:
+                click.echo('{time}: {stats}'.format(time=time.strftime('%H:%M:%S'), stats=_format_tunnel_stats(stats.summary())))
+                next_report += report_interval
+
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+
+    _highlight('\n{stats}'.format(stats=_format_tunnel_stats(stats.summary())))
+
+
+class TunnelRegistry:
+    """A local registry of the ssh tunnels created by this tool
+
+    Each tunnel has its name, the pid of its ssh (master) process, its local port,
+    the remote host (and user) it goes to, the stack whose manager that is and
+    when it started.
+    Whether a tunnel is still running is checked using its pid and the start time
+    of that process (so a reused pid isn't mistaken for the tunnel), which avoids
+    scanning every process on the machine. The registry is a json file in the cache
+    dir and is keyed by the local port.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR):
+        self.registry_path = os.path.join(cache_dir, 'tunnels.json')
+
+        os.makedirs(cache_dir, exist_ok=True)
+        try:
+            with open(self.registry_path) as registry_file:
+                self.entries = json.load(registry_file)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    @staticmethod
+    def _is_running(tunnel):
+        import psutil
+
+        try:
+            with _profile_span('psutil', 'pid check'):
+                return psutil.Process(tunnel['pid']).create_time() == tunnel['create_time']
+        except psutil.Error:
+            return False
+
+    def add(self, pid, port, ip, user=None, stack_name=None, name=None, remote=None):
+        """Record a running tunnel process
+        """
+        import psutil
+
+        try:
+            create_time = psutil.Process(pid).create_time()
+        except psutil.Error:
+            return
+        self.entries[str(port)] = {'pid': pid,
+                                   'create_time': create_time,
+                                   'port': port,
+                                   'ip': ip,
+                                   'user': user,
+                                   'stack': stack_name,
+                                   'name': name or stack_name or ip,
+                                   'remote': remote,
+                                   'started': time.strftime('%Y-%m-%d %H:%M:%S'),
+                                  }
+        self.save()
+
+    def get(self, port):
+        """Get the running tunnel using the port, None if there isn't one
+        """
+        tunnel = self.entries.get(str(port))
+        if tunnel is not None and not self._is_running(tunnel):
+            self.remove(port)
+            tunnel = None
+        return tunnel
+
+    def find(self, name):
+        """Get the running tunnel with the name, None if there isn't one
+        """
+        return next((tunnel for tunnel in self.tunnels() if tunnel.get('name') == name), None)
+
+    def tunnels(self):
+        """Get all the running tunnels, dropping any which are no longer running
+        """
+        return [tunnel for tunnel in (self.get(port) for port in list(self.entries)) if tunnel is not None]
+
+    def remove(self, port):
+        """Drop the tunnel using the port
+        """
+        if self.entries.pop(str(port), None) is not None:
+            self.save()
+
+    def reconcile(self, port):
+        """Find the ssh tunnels using the port which aren't in the registry and add them to it
+
+        This has to scan the command lines of all processes (see _scan_tunnel_procs)
+        so it should only be needed when a tunnel was created by something else.
+        """
+        tunnels = _scan_tunnel_procs(port)
+        for tunnel in tunnels:
+            tunnel.update(port=port, name=tunnel['ip'], remote=None)
+            self.add(tunnel['pid'], port, tunnel['ip'], user=tunnel['user'])
+        return tunnels
+
+    def save(self):
+        """Write the registry
+        """
+        tmp_path = '{}.{}.{}'.format(self.registry_path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'w') as registry_file:
+            json.dump(self.entries, registry_file, indent=2)
+        os.replace(tmp_path, self.registry_path)
+
+
+def _scan_tunnel_procs(port):
+    """Scan all processes for ssh tunnels using the given local port
+
+    Each process gets: { 'pid', 'ip', 'user' }
+    """
+    # [bind_address:]port:remote_socket
+    bind_re = re.compile('(?:(?P<bind_address>[^:]*):)?(?P<port>[0-9]+):(?P<remote_socket>.*)')
+    # remote_user@remote_ip
+    user_ip_re = re.compile('(?:(?P<remote_user>.*)@)?(?P<remote_ip>.*)')
+
+    # Tunnels created by this tool are forwards of an ssh master connection so they aren't
+    # found this way. This is an example of what the tunnel process(es) info from psutil
+    # look like for tunnels created otherwise (e.g. by older versions of this tool):
+    # {'name': 'ssh',
+    #  'pid': 26332,
+    #  'exe': '/usr/bin/ssh',
+    #  'username': 'mjl',
+    #  'cmdline': ['ssh', '-f', '-NL', 'localhost:2374:/var/run/docker.sock', 'docker@18.191.218.147']
+    # }
+    # the key and other options may come before or after the forwarding
+
+    def forwards_port(cmdline):
+        """Test if an ssh command line forwards the given port
+        """
+        for prev_arg, arg in zip(cmdline, cmdline[1:]):
+            # the forward follows an option ending in L (-L, -NL) or is joined to it (-Llocalhost:...)
+            if prev_arg.startswith('-') and prev_arg.endswith('L'):
+                spec = arg
+            elif arg.startswith('-L'):
+                spec = arg[2:]
+            else:
+                continue
+            bind = bind_re.fullmatch(spec)
+            if bind and bind.group('port') == str(port):
+                return True
+        return False
+
+    import psutil
+
+    tunnel_info = []
+    with _profile_span('psutil', 'process scan'):
+        for p in psutil.process_iter(attrs=['pid', 'name', 'cmdline']):
+            if p.info['name'] != 'ssh' or not p.info['cmdline'] or not forwards_port(p.info['cmdline']):
+                continue
+            user_ip = user_ip_re.fullmatch(p.info['cmdline'][-1])
+            tunnel_info.append({'pid': int(p.info['pid']),
+                                'ip': user_ip.group('remote_ip'),
+                                'user': user_ip.group('remote_user'),
+                               })
+
+    return tunnel_info
+
+
+def _get_tunnel_info(port, registry=None):
+    """Get info on any running ssh tunnel processes using the given local port
+
+    Each process gets: { 'pid', 'ip', 'port', 'name' }
+
+    The tunnel registry answers this without looking at other processes,
+    unless the port is in use by a tunnel the registry doesn't know about.
+    """
+    registry = registry or TunnelRegistry()
+    tunnel = registry.get(port)
+    if tunnel is not None:
+        return [tunnel]
+    if not _is_port_in_use(port):
+        return []
+    return registry.reconcile(port)
+
+
+def _kill(pids):
+    """
+    """
+    for pid in pids:
+        _highlight("Killing PID {}".format(pid), fg='green')
+        os.kill(pid, signal.SIGKILL)
+
+
+def _kill_existing_tunnels(port, registry=None, **kwargs):
+    """Ask whether to stop the tunnel(s) using the local port, and stop them if so
+
+    returns whether the tunnels were stopped and how many there were
+    """
+    # check if we have existing ssh tunnel processes
+    registry = registry or TunnelRegistry()
+    tunnel_info = _get_tunnel_info(port, registry)
+
+    if len(tunnel_info) > 1:
+        _highlight('There are {cnt} existing ssh tunnels! More than one is unexpected!'.format(cnt=len(tunnel_info)))
+
+    return _stop_tunnels(tunnel_info, registry, **kwargs)
+
+
+def _stop_tunnels(tunnel_info, registry, **kwargs):
+    """Ask whether to stop the tunnels, and stop them if so
+
+    returns whether the tunnels were stopped and how many there were
+    """
+    if len(tunnel_info) == 0:
+        return True, 0
+
+    tunnel_ref = 'this existing tunnel'
+    if len(tunnel_info) > 1:
+        tunnel_ref = 'these existing tunnels'
+
+    click.echo('\nFound {} (name: port, pid, ip addr):'.format(tunnel_ref))
+    _highlight('\n'.join(['  {name}: {port}, {pid}, {ip}'.format(**info) for info in tunnel_info]))
+
+    if 'prompt' in kwargs:
+        prompt = kwargs['prompt']
+    else:
+        prompt = 'Kill {} (y/n)?'.format(tunnel_ref)
+    kill_tunnels = click.prompt(prompt, type=bool)
+
+    if kill_tunnels:
+        for tinfo in tunnel_info:
+            _stop_tunnel(tinfo, registry)
+
+    return kill_tunnels, len(tunnel_info)
+
+
+class DockerApiError(Exception):
+    """A request to the docker engine api failed"""
+
+
+class DockerApi:
+    """Client for the docker engine api at the end of a tunnel's local port
+
+    Each thread using the client gets its own keep-alive connection which it
+    reuses for all of its requests, so polling the api doesn't pay for a new
+    connection (through the tunnel) per request.
+    """
+
+    def __init__(self, port, timeout=DOCKER_API_TIMEOUT):
+        self.port = port
+        self.timeout = timeout
+        self._local = threading.local()
+        self._connections = []
+        self._streams = []
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        import http.client
+
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = http.client.HTTPConnection('localhost', self.port, timeout=self.timeout)
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def get(self, path, params=None):
+        """Get the parsed json response of the api path
+
+        Query params which aren't strings (e.g. filters) are sent as json.
+        """
+        import http.client
+        from urllib.parse import urlencode
+
+        query = {k: v if isinstance(v, str) else json.dumps(v) for k, v in (params or {}).items()}
+        url = path + ('?' + urlencode(query) if query else '')
+        # profile the requests by endpoint, not by the id (or name) of the object requested
+        name = 'GET ' + re.sub(r'^/(services|tasks|nodes|containers)/(?!json$)[^/]+', r'/\1/{id}', path)
+
+        for attempt in (1, 2):
+            conn = self._connection()
+            try:
+                with _profile_span('docker', name):
+                    conn.request('GET', url)
+                    response = conn.getresponse()
+                    body = response.read()
+                break
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError) as e:
+                # the engine may close a keep-alive connection which has been idle, retry once on a new one
+                conn.close()
+                if attempt == 2:
+                    raise DockerApiError('The docker engine on localhost:{} closed the connection: {}'.format(self.port, e))
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                raise DockerApiError('Could not reach the docker engine on localhost:{} (is the tunnel running?): {}'
+                                     .format(self.port, e))
+
+        if response.status >= 400:
+            try:
+                message = json.loads(body)['message']
+            except (ValueError, KeyError, TypeError):
+                message = body.decode(errors='replace').strip()
+            raise DockerApiError('{status}: {msg}'.format(status=response.status, msg=message))
+
+        return json.loads(body)
+
+    def events(self, params=None):
+        """Generate the events of the api's event stream (which doesn't end) as they happen
+
+        The stream gets a connection of its own, with no timeout since events
+        can be far apart. Closing the client ends the stream (with a DockerApiError).
+        """
+        import http.client
+        from urllib.parse import urlencode
+
+        query = {k: v if isinstance(v, str) else json.dumps(v) for k, v in (params or {}).items()}
+        conn = http.client.HTTPConnection('localhost', self.port)
+        try:
+            conn.request('GET', '/events' + ('?' + urlencode(query) if query else ''))
+            response = conn.getresponse()
+            if response.status >= 400:
+                raise DockerApiError('{status}: {msg}'.format(status=response.status,
+                                                              msg=response.read().decode(errors='replace').strip()))
+            with self._lock:
+                self._streams.append(conn.sock)
+            for line in response:
+                if line.strip():
+                    yield json.loads(line)
+        except (OSError, ValueError, http.client.HTTPException) as e:
+            raise DockerApiError('The docker event stream from localhost:{} ended: {}'.format(self.port, e))
+        finally:
+            conn.close()
+
+    def close(self):
+        """Close the connections of all the threads which used the client"""
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            # a stream's connection can't be closed while it is being read, shutting down its socket
+            # ends the stream, and the stream then closes its connection
+            for sock in self._streams:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            self._connections = []
+            self._streams = []
+        self._local = threading.local()
+
+
+def _docker_api_port(name=None, port=None):
+    """Get the local port of the docker engine api to use
+
+    That is the port if given, else the port of the named tunnel, else
+    the port of DOCKER_HOST if it is a local tcp port, else TUNNEL_BASE_PORT.
+    """
+    if port is not None:
+        return port
+
+    if name is not None:
+        tunnel = TunnelRegistry().find(name)
+        if tunnel is None:
+            _highlight('No tunnel named {} is running'.format(name), fg='red')
+            sys.exit(1)
+        return tunnel['port']
+
+    docker_host = re.match(r'^(?:tcp://)?(?:localhost|127\.0\.0\.1):(\d+)$', os.environ.get('DOCKER_HOST', ''))
+    if docker_host:
+        return int(docker_host.group(1))
+
+    return TUNNEL_BASE_PORT
+
+
+def _stack_filter(stack):
+    """The docker api filter for the services and containers of the stack"""
+    return {'label': ['com.docker.stack.namespace={}'.format(stack)]}
+
+
+def _container_stats(stats, prev_sample, now):
+    """Get the resource use of a container from its stats (from the docker api)
+
+    The cpu use and network rates are over the time since the previous
+    sample of the stats (a (time, stats) tuple), they are None without one.
+    """
+    mem = stats.get('memory_stats', {})
+    # like docker stats, don't count the page cache (cgroup v1 and v2 name it differently)
+    mem_stats = mem.get('stats', {})
+    cache = mem_stats.get('total_inactive_file', mem_stats.get('inactive_file', 0))
+    networks = stats.get('networks', {}).values()
+    rx_bytes = sum(net['rx_bytes'] for net in networks)
+    tx_bytes = sum(net['tx_bytes'] for net in networks)
+
+    usage = {'mem': mem.get('usage', 0) - cache if 'usage' in mem else None,
+             'mem_limit': mem.get('limit'),
+             'cpu_pct': None, 'rx_rate': None, 'tx_rate': None,
+            }
+
+    if prev_sample is not None:
+        prev_time, prev = prev_sample
+        cpu, prev_cpu = stats.get('cpu_stats', {}), prev.get('cpu_stats', {})
+        cpu_delta = cpu.get('cpu_usage', {}).get('total_usage', 0) - prev_cpu.get('cpu_usage', {}).get('total_usage', 0)
+        system_delta = cpu.get('system_cpu_usage', 0) - prev_cpu.get('system_cpu_usage', 0)
+        online_cpus = cpu.get('online_cpus') or len(cpu.get('cpu_usage', {}).get('percpu_usage') or []) or 1
+        if system_delta > 0:
+            usage['cpu_pct'] = 100.0 * cpu_delta / system_delta * online_cpus
+
+        elapsed = now - prev_time
+        prev_networks = prev.get('networks', {}).values()
+        if elapsed > 0:
+            usage['rx_rate'] = (rx_bytes - sum(net['rx_bytes'] for net in prev_networks)) / elapsed
+            usage['tx_rate'] = (tx_bytes - sum(net['tx_bytes'] for net in prev_networks)) / elapsed
+
+    return usage
+
+
+class StackTop:
+    """Polls the docker engine api for the services, tasks and container stats of a stack
+
+    The requests of a refresh are made concurrently using the executor. The
+    swarm's nodes are only looked up again when a task is on an unknown node,
+    and the last stats of each container are kept so that its cpu use and
+    network rates are over the time between refreshes.
+
+    The docker api only has stats for the containers on the node it is
+    connected to (the tunnel's manager), the other tasks just have their state.
+    """
+
+    def __init__(self, api, stack, executor):
+        self.api = api
+        self.stack = stack
+        self.executor = executor
+        self.nodes = {}
+        self.requests = 0
+        self._samples = {}
+
+    def _get(self, path, params=None):
+        self.requests += 1
+        return self.api.get(path, params)
+
+    def refresh(self):
+        """Get the current state of the stack's services
+
+        returns the services (name, replicas and tasks), sorted by name
+        """
+        services_future = self.executor.submit(self._get, '/services', {'filters': _stack_filter(self.stack)})
+        containers_future = self.executor.submit(self._get, '/containers/json', {'filters': _stack_filter(self.stack)})
+        services = services_future.result()
+        containers = containers_future.result()
+
+        tasks = []
+        if services:
+            tasks = self._get('/tasks', {'filters': {'service': [svc['Spec']['Name'] for svc in services],
+                                                     'desired-state': ['running']}})
+
+        if any(task.get('NodeID') not in self.nodes for task in tasks):
+            self.nodes = {node['ID']: node['Description']['Hostname'] for node in self._get('/nodes')}
+
+        # stats=false/one-shot=true returns a single sample right away instead of waiting for a 2nd one
+        stats_futures = {ctr['Labels'].get('com.docker.swarm.task.id'):
+                         (ctr['Id'], self.executor.submit(self._get, '/containers/{}/stats'.format(ctr['Id']),
+                                                          {'stream': 'false', 'one-shot': 'true'}))
+                         for ctr in containers if ctr['State'] == 'running'}
+
+        now = time.monotonic()
+        samples = {}
+        container_usage = {}
+        for task_id, (ctr_id, future) in stats_futures.items():
+            try:
+                stats = future.result()
+            except DockerApiError:
+                # the container may have stopped since it was listed
+                continue
+            container_usage[task_id] = _container_stats(stats, self._samples.get(ctr_id), now)
+            samples[ctr_id] = (now, stats)
+        self._samples = samples
+
+        snapshot = []
+        for svc in services:
+            svc_tasks = sorted((task for task in tasks if task['ServiceID'] == svc['ID']),
+                               key=lambda task: (task.get('Slot', 0), task.get('NodeID', '')))
+            mode = svc['Spec'].get('Mode', {})
+            snapshot.append({
+                'name': svc['Spec']['Name'],
+                'running': sum(1 for task in svc_tasks if task['Status']['State'] == 'running'),
+                'desired': mode['Replicated'].get('Replicas', 1) if 'Replicated' in mode else len(svc_tasks),
+                'tasks': [dict(container_usage.get(task['ID'], {}),
+                               name='{}.{}'.format(svc['Spec']['Name'], task.get('Slot') or task.get('NodeID', '')[:12]),
+                               state=task['Status']['State'],
+                               error=task['Status'].get('Err'),
+                               node=self.nodes.get(task.get('NodeID'), task.get('NodeID', '')[:12]),
+                               local=task['ID'] in container_usage)
+                          for task in svc_tasks],
+            })
+
+        return sorted(snapshot, key=lambda svc: svc['name'])
+
+
+def _format_size(n_bytes):
+    """Format a number of bytes for people (e.g. 1.5MiB)"""
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if abs(n_bytes) < 1024 or unit == 'GiB':
+            return '{:.0f}{}'.format(n_bytes, unit) if unit == 'B' else '{:.1f}{}'.format(n_bytes, unit)
+        n_bytes /= 1024
+
+
+def _format_top(snapshot):
+    """Format the state of a stack's services (see StackTop.refresh) as the lines of a table"""
+    def value(task, key, fmt):
+        return '-' if task.get(key) is None else fmt(task[key])
+
+    lines = ['{:<32} {:>8} {:<10} {:<20} {:>7} {:>19} {:>11} {:>11}'
+             .format('service/task', 'replicas', 'state', 'node', 'cpu %', 'mem / limit', 'net rx/s', 'net tx/s')]
+    for svc in snapshot:
+        lines.append('{:<32} {:>8}'.format(svc['name'], '{running}/{desired}'.format(**svc)))
+        for task in svc['tasks']:
+            mem = '-' if task.get('mem') is None else '{} / {}'.format(_format_size(task['mem']),
+                                                                      value(task, 'mem_limit', _format_size))
+            lines.append('  {:<30} {:>8} {:<10} {:<20} {:>7} {:>19} {:>11} {:>11}'.format(
+                task['name'], '', task['state'], task['node'][:20],
+                value(task, 'cpu_pct', '{:.1f}'.format), mem,
+                value(task, 'rx_rate', _format_size), value(task, 'tx_rate', _format_size)))
+            if task['error'] and task['state'] != 'running':
+                lines.append('    {}'.format(task['error']))
+    return lines
+
+
+class StackEvents:
+    """Follows the docker event stream for the events of a stack's services and their containers
+
+    Waiters are woken by each event of the stack (see wait), so they can check
+    on the services as soon as something happens instead of polling.
+    """
+
+    def __init__(self, api, stack):
+        self.api = api
+        self.stack = stack
+        self.count = 0
+        self._changed = threading.Condition()
+        self._thread = threading.Thread(target=self._follow, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _follow(self):
+        prefix = self.stack + '_'
+        try:
+            for event in self.api.events({'since': str(int(time.time())),
+                                          'filters': {'type': ['service', 'container']}}):
+                attrs = event.get('Actor', {}).get('Attributes', {})
+                if attrs.get('name', '').startswith(prefix) or attrs.get('com.docker.stack.namespace') == self.stack:
+                    with self._changed:
+                        self.count += 1
+                        self._changed.notify_all()
+        except DockerApiError:
+            # the deploy keeps polling the services without the events
+            pass
+
+    def wait(self, seen, timeout):
+        """Wait until there has been an event since the seen count of events (or the timeout)
+
+        returns the count of events so far
+        """
+        with self._changed:
+            self._changed.wait_for(lambda: self.count != seen, timeout)
+            return self.count
+
+
+class ServiceRollout:
+    """The rollout of a stack's service from a deploy until it has converged
+
+    A service has converged when it is not updating and all of its desired
+    tasks are running (swarm only counts a task with a healthcheck as running
+    once it is healthy). A service whose spec changed must also have started
+    replacing its tasks, right after a deploy swarm may not have started the
+    update yet so its old tasks are all still running. New tasks which fail
+    are reported as they happen, and the rollout is failed when the update
+    pauses or rolls back, or too many of its tasks fail. A rollout which makes
+    no progress for stuck_after seconds is reported as stuck.
+    """
+
+    def __init__(self, name, version, old_tasks, stuck_after=DEPLOY_STUCK_AFTER):
+        self.name = name
+        self.version = version
+        self.stuck_after = stuck_after
+        self.started = time.monotonic()
+        self.finished = None
+        self.result = None
+        self.failed_tasks = []
+        self.stuck = False
+        self._seen_tasks = set(old_tasks)
+        self._old_tasks = set(old_tasks)
+        self._update_seen = False
+        self._progress = None
+        self._progress_time = self.started
+
+    @property
+    def done(self):
+        return self.result is not None
+
+    def elapsed(self):
+        return (self.finished or time.monotonic()) - self.started
+
+    def finish(self, result, now):
+        """Record the result of the rollout"""
+        self.result = result
+        self.finished = now
+
+    def _update_started(self, service, desired_tasks):
+        """Has swarm started rolling out the service's changed spec
+
+        Either its update was seen, it has tasks which weren't running before
+        the deploy, or the spec changed without changing its tasks' template
+        (so swarm has no tasks to replace).
+        """
+        if self._update_seen or any(task['ID'] not in self._old_tasks for task in desired_tasks):
+            return True
+        previous = service.get('PreviousSpec')
+        return previous is not None and previous.get('TaskTemplate') == service['Spec'].get('TaskTemplate')
+
+    def check(self, api, now=None):
+        """Check on the service's rollout
+
+        returns the messages about what has happened (e.g. failed tasks) since the last check
+        """
+        now = now or time.monotonic()
+        messages = []
+        try:
+            service = api.get('/services/{}'.format(self.name))
+        except DockerApiError:
+            # a new service may not have been created yet
+            return messages
+        tasks = api.get('/tasks', {'filters': {'service': [self.name]}})
+
+        for task in tasks:
+            status = task['Status']
+            if task['ID'] not in self._seen_tasks and status['State'] in ('failed', 'rejected'):
+                self._seen_tasks.add(task['ID'])
+                self.failed_tasks.append(task['ID'])
+                messages.append('task {id} {state}: {err}'.format(id=task['ID'][:12], state=status['State'],
+                                                                 err=status.get('Err') or status.get('Message')))
+
+        mode = service['Spec'].get('Mode', {})
+        desired_tasks = [task for task in tasks if task['DesiredState'] == 'running']
+        desired = mode['Replicated'].get('Replicas', 1) if 'Replicated' in mode else len(desired_tasks)
+        running = sum(1 for task in desired_tasks if task['Status']['State'] == 'running')
+        update = service.get('UpdateStatus', {})
+        update_state = update.get('State')
+        if update_state == 'updating':
+            self._update_seen = True
+        unchanged = service['Version']['Index'] == self.version
+
+        if update_state in ('paused', 'rollback_started', 'rollback_paused', 'rollback_completed'):
+            messages.append('update {state}: {msg}'.format(state=update_state, msg=update.get('Message', '')))
+            self.finish('failed', now)
+        elif len(self.failed_tasks) >= DEPLOY_MAX_TASK_FAILURES:
+            messages.append('{} new tasks have failed'.format(len(self.failed_tasks)))
+            self.finish('failed', now)
+        elif (update_state != 'updating' and running == desired == len(desired_tasks)
+              and (unchanged or self._update_started(service, desired_tasks))):
+            self.finish('unchanged' if unchanged else 'converged', now)
+        else:
+            progress = (update_state, running, tuple(sorted(task['ID'] for task in desired_tasks)))
+            if progress != self._progress:
+                self._progress = progress
+                self._progress_time = now
+                self.stuck = False
+            elif not self.stuck and now - self._progress_time >= self.stuck_after:
+                self.stuck = True
+                waiting = ['{state} ({msg})'.format(state=task['Status']['State'],
+                                                    msg=task['Status'].get('Err') or task['Status'].get('Message'))
+                           for task in desired_tasks if task['Status']['State'] != 'running']
+                messages.append('stuck for {:.0f}s with {}/{} tasks running{}'.format(
+                    now - self._progress_time, running, desired,
+                    ', waiting on: ' + '; '.join(waiting) if waiting else ''))
+
+        return messages
+
+
+def _stack_service_versions(api, stack):
+    """Get the spec version of each of the stack's services, and the ids of their tasks
+
+    A deploy's rollouts (see ServiceRollout) start from these.
+    """
+    services = api.get('/services', {'filters': _stack_filter(stack)})
+    versions = {svc['Spec']['Name']: svc['Version']['Index'] for svc in services}
+    tasks = api.get('/tasks', {'filters': {'service': list(versions)}}) if versions else []
+    return versions, {task['ID'] for task in tasks}
+
+
+def _echo_rollout(rollout, message, fg='white'):
+    _highlight('{time}: {name}: {msg}'.format(time=time.strftime('%H:%M:%S'), name=rollout.name, msg=message), fg=fg)
+
+
+def _follow_rollouts(api, events, rollouts, timeout):
+    """Follow the rollouts until they are all done or the timeout (seconds) has passed
+
+    The rollouts are checked whenever there is an event of the stack, and
+    at least every DEPLOY_POLL_INTERVAL seconds.
+    """
+    deadline = time.monotonic() + timeout
+    seen = events.count
+    while True:
+        for rollout in rollouts:
+            if rollout.done:
+                continue
+            for message in rollout.check(api):
+                _echo_rollout(rollout, message, fg='yellow' if rollout.stuck or not rollout.done else 'red')
+            if rollout.result == 'converged':
+                _echo_rollout(rollout, 'converged in {:.1f}s'.format(rollout.elapsed()), fg='green')
+            elif rollout.result == 'failed':
+                _echo_rollout(rollout, 'failed after {:.1f}s'.format(rollout.elapsed()), fg='red')
+
+        if all(rollout.done for rollout in rollouts):
+            return
+        if time.monotonic() >= deadline:
+            for rollout in rollouts:
+                if not rollout.done:
+                    rollout.finish('timed out', time.monotonic())
+                    _echo_rollout(rollout, 'did not converge within {}s'.format(timeout), fg='red')
+            return
+        seen = events.wait(seen, DEPLOY_POLL_INTERVAL)
+
+
+def _docker_env(port):
+    """The environment for docker commands using the docker engine at the local port"""
+    return dict(os.environ, DOCKER_HOST='localhost:{}'.format(port))
+
+
+def _stack_deploy(stack, compose_files, port):
+    """docker stack deploy the compose files as the stack using the docker engine at the local port
+
+    returns whether the deploy succeeded
+    """
+    cmd = ['docker', 'stack', 'deploy', '--with-registry-auth']
+    for compose_file in compose_files:
+        cmd += ['-c', compose_file]
+    cmd.append(stack)
+    return _run(cmd, show_output=True, env=_docker_env(port)).returncode == 0
+
+
+def _load_stack_config(compose_files, port):
+    """Get the stack config the compose files combine into (using docker stack config)"""
+    # PyYAML is only needed for the tiered deploys
+    import yaml
+
+    cmd = ['docker', 'stack', 'config']
+    for compose_file in compose_files:
+        cmd += ['-c', compose_file]
+    config = _run(cmd, capture_stdout=True, capture_stderr=True, env=_docker_env(port))
+    if config.returncode != 0:
+        _highlight('docker stack config failed (it needs docker 20.10 or later): {}'.format(config.stderr.strip()),
+                   fg='red')
+        sys.exit(1)
+    return yaml.safe_load(config.stdout)
+
+
+def _service_tiers(config):
+    """Group the services of the stack config into tiers by their placement constraints
+
+    The tiers are independent of each other. The services of a tier are ordered
+    so that the services they depend on (in the same tier) come first.
+
+    returns the tiers by name (their constraints)
+    """
+    grouped = collections.defaultdict(list)
+    for name, service in config['services'].items():
+        constraints = service.get('deploy', {}).get('placement', {}).get('constraints') or []
+        grouped[', '.join(sorted(constraints)) or 'unconstrained'].append(name)
+
+    tiers = {}
+    for tier, names in sorted(grouped.items()):
+        ordered = []
+        remaining = sorted(names)
+        while remaining:
+            ready = [name for name in remaining
+                     if not set(config['services'][name].get('depends_on') or []) & (set(remaining) - {name})]
+            # a dependency cycle can't be ordered, the rest are deployed in name order
+            ready = ready or remaining
+            ordered.append(ready[0])
+            remaining.remove(ready[0])
+        tiers[tier] = ordered
+    return tiers
+
+
+def _deploy_tier(api, events, stack, config, services, port, versions, old_tasks, timeout, stuck_after, tmp_dir):
+    """Deploy the services of a tier one at a time, each once the one before it has converged
+
+    returns the rollouts of the tier's services, those after a service which failed to deploy
+    or converge are skipped
+    """
+    rollouts = []
+    for name in services:
+        # stack deploy leaves the stack's services which aren't in the compose file alone (there's no --prune)
+        # so deploying a compose file with just this service updates just this service
+        service_config = dict(config, services={name: config['services'][name]})
+        compose_file = os.path.join(tmp_dir, '{}.json'.format(name))
+        with open(compose_file, 'w') as f:
+            json.dump(service_config, f)
+
+        full_name = '{}_{}'.format(stack, name)
+        rollout = ServiceRollout(full_name, versions.get(full_name), old_tasks, stuck_after)
+        rollouts.append(rollout)
+        if _stack_deploy(stack, [compose_file], port):
+            _follow_rollouts(api, events, [rollout], timeout)
+        else:
+            rollout.finish('failed', time.monotonic())
+            _echo_rollout(rollout, 'docker stack deploy failed', fg='red')
+
+        if rollout.result not in ('converged', 'unchanged'):
+            for skipped_name in services[len(rollouts):]:
+                skipped = ServiceRollout('{}_{}'.format(stack, skipped_name), None, old_tasks)
+                skipped.finish('skipped', skipped.started)
+                rollouts.append(skipped)
+                _echo_rollout(skipped, 'not deployed since {} did not converge'.format(name), fg='red')
+            break
+    return rollouts
+
+
+def _format_rollouts(rollouts):
+    """Format the results of the rollouts of a deploy as the lines of a table"""
+    lines = ['{:<36} {:<10} {:>10} {:>12}'.format('service', 'result', 'rollout s', 'failed tasks')]
+    for rollout in sorted(rollouts, key=lambda rollout: rollout.name):
+        lines.append('{:<36} {:<10} {:>10.1f} {:>12}'.format(rollout.name, rollout.result + ('*' if rollout.stuck else ''),
+                                                             rollout.elapsed(), len(rollout.failed_tasks)))
+    if any(rollout.stuck for rollout in rollouts):
+        lines.append('* was stuck')
+    return lines
+
+
+def _find_mongo_container(api, volume):
+    """Get the name of the running container with the volume (the riffdata mongo db's data volume)
+
+    Only the containers on the node the docker api is connected to can be found.
+    """
+    containers = api.get('/containers/json', {'filters': {'volume': [volume], 'status': ['running']}})
+    if not containers:
+        _highlight('No running container with the volume {} was found. Is the tunnel to the node running it?'
+                   .format(volume), fg='red')
+        sys.exit(1)
+    return containers[0]['Names'][0].lstrip('/')
+
+
+def _chunk_compressor(compression, level):
+    """Get a function compressing a chunk of data into a complete gzip member or zstd frame
+
+    Concatenated members (frames) are a valid gzip (zstd) stream, so the chunks
+    of a stream can be compressed in parallel. zlib and zstandard release the
+    GIL while compressing so threads are enough.
+    """
+    import zlib
+
+    if compression == 'gzip':
+        def compress(chunk):
+            compressor = zlib.compressobj(level if level is not None else 6, zlib.DEFLATED, 31)
+            return compressor.compress(chunk) + compressor.flush()
+        return compress
+
+    zstandard = _import_zstandard()
+    local = threading.local()
+
+    def compress(chunk):
+        # a ZstdCompressor can't be used by several threads at once
+        if not hasattr(local, 'compressor'):
+            local.compressor = zstandard.ZstdCompressor(level=level if level is not None else 3)
+        return local.compressor.compress(chunk)
+    return compress
+
+
+def _import_zstandard():
+    """Import the zstandard package which is only needed for zstd compressed backups"""
+    try:
+        import zstandard
+    except ImportError:
+        _highlight('zstd compression needs the zstandard package: pip install zstandard', fg='red')
+        sys.exit(1)
+    return zstandard
+
+
+class TransferStats:
+    """The bytes moved by a backup or restore, and the most bytes it held in memory at once"""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.buffered = 0
+        self.peak_buffered = 0
+        self._lock = threading.Lock()
+
+    def buffer(self, n_bytes):
+        """Record that n_bytes more (or fewer if negative) are being held in memory"""
+        with self._lock:
+            self.buffered += n_bytes
+            self.peak_buffered = max(self.peak_buffered, self.buffered)
+
+    def add(self, raw_bytes=0, compressed_bytes=0):
+        """Count bytes moved, from any thread"""
+        with self._lock:
+            self.raw_bytes += raw_bytes
+            self.compressed_bytes += compressed_bytes
+
+    def summary(self):
+        import resource
+
+        elapsed = time.monotonic() - self.started
+        # ru_maxrss is in KiB on linux
+        return ('{raw} ({compressed} compressed, {ratio:.1f}x) in {elapsed:.1f}s: {raw_rate}/s ({compressed_rate}/s '
+                'compressed), peak buffered {peak}, peak rss {rss}'
+                .format(raw=_format_size(self.raw_bytes), compressed=_format_size(self.compressed_bytes),
+                        ratio=self.raw_bytes / self.compressed_bytes if self.compressed_bytes else 0,
+                        elapsed=elapsed, raw_rate=_format_size(self.raw_bytes / elapsed if elapsed else 0),
+                        compressed_rate=_format_size(self.compressed_bytes / elapsed if elapsed else 0),
+                        peak=_format_size(self.peak_buffered),
+                        rss=_format_size(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)))
+
+
+class MultipartUpload:
+    """Uploads a stream to S3 as a multipart upload, uploading its parts concurrently
+
+    Once max_uploads parts are being uploaded, writing blocks until one of them
+    is done, which bounds the memory used by the upload to max_uploads + 1 parts.
+    Writing raises the error of a part which failed to upload.
+    """
+
+    def __init__(self, s3, bucket, key, part_size, max_uploads, executor, stats):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.executor = executor
+        self.stats = stats
+        self.upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+        self._buffer = bytearray()
+        self._parts = []
+        self._checked = 0
+        self._slots = threading.BoundedSemaphore(max_uploads)
+
+    def _upload_part(self, part_number, data):
+        try:
+            etag = self.s3.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                       PartNumber=part_number, Body=data)['ETag']
+        finally:
+            self.stats.buffer(-len(data))
+            self._slots.release()
+        return {'PartNumber': part_number, 'ETag': etag}
+
+    def _submit_part(self, data):
+        # a part which failed to upload fails the upload now, rather than after the rest of the stream
+        while self._checked < len(self._parts) and self._parts[self._checked].done():
+            self._parts[self._checked].result()
+            self._checked += 1
+        self._slots.acquire()
+        self.stats.add(compressed_bytes=len(data))
+        self._parts.append(self.executor.submit(self._upload_part, len(self._parts) + 1, data))
+
+    def write(self, data):
+        self.stats.buffer(len(data))
+        self._buffer += data
+        while len(self._buffer) >= self.part_size:
+            self._submit_part(bytes(self._buffer[:self.part_size]))
+            del self._buffer[:self.part_size]
+
+    def complete(self):
+        """Upload the rest of the stream (the last part can be smaller) and complete the upload"""
+        if self._buffer or not self._parts:
+            self._submit_part(bytes(self._buffer))
+            self._buffer = bytearray()
+        parts = [future.result() for future in self._parts]
+        self.s3.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                          MultipartUpload={'Parts': parts})
+
+    def abort(self):
+        for future in self._parts:
+            future.cancel()
+        self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+
+class RangeReader:
+    """A file-like reader of an S3 object which downloads the object's parts concurrently
+
+    The next max_downloads parts are downloaded ahead of what has been read,
+    which bounds the memory used by the reader to max_downloads + 1 parts.
+    """
+
+    def __init__(self, s3, bucket, key, size, part_size, max_downloads, executor, stats):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.size = size
+        self.part_size = part_size
+        self.max_downloads = max_downloads
+        self.executor = executor
+        self.stats = stats
+        self._offset = 0
+        self._downloads = collections.deque()
+        self._buffer = bytearray()
+        self._prefetch()
+
+    def _download_part(self, start, end):
+        data = self.s3.get_object(Bucket=self.bucket, Key=self.key, Range='bytes={}-{}'.format(start, end))['Body'].read()
+        self.stats.buffer(len(data))
+        return data
+
+    def _prefetch(self):
+        while len(self._downloads) < self.max_downloads and self._offset < self.size:
+            end = min(self._offset + self.part_size, self.size) - 1
+            self._downloads.append(self.executor.submit(self._download_part, self._offset, end))
+            self._offset = end + 1
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        while self._downloads and (size < 0 or len(self._buffer) < size):
+            data = self._downloads.popleft().result()
+            self.stats.add(compressed_bytes=len(data))
+            self._buffer += data
+            self._prefetch()
+
+        size = len(self._buffer) if size < 0 else min(size, len(self._buffer))
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        self.stats.buffer(-size)
+        return data
+
+
+def _backup_archive_key(prefix, db_name, app, compression):
+    """Get the S3 key of a new backup, named like the archives of bin/mongo-backup.sh"""
+    return '{prefix}mongodb_{db}.{app}.{swarm}.backup-{timestamp}.{ext}'.format(
+        prefix=prefix, db=db_name, app=app, swarm=os.environ.get('DEPLOY_SWARM', 'UNKNOWN'),
+        timestamp=time.strftime('%Y%m%d%H%M%S'), ext=BACKUP_EXTENSIONS[compression])
+
+
+def _stream_mongo_backup(dump, upload, compress, threads, stats):
+    """Compress the mongodump archive from the dump process in parallel chunks into the upload
+
+    At most 2 * threads chunks are being compressed (or waiting to be uploaded
+    in order) at once.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    def compress_chunk(chunk):
+        compressed = compress(chunk)
+        stats.buffer(len(compressed) - len(chunk))
+        return compressed
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = collections.deque()
+        while True:
+            chunk = dump.stdout.read(BACKUP_CHUNK_SIZE)
+            if not chunk:
+                break
+            stats.add(raw_bytes=len(chunk))
+            stats.buffer(len(chunk))
+            pending.append(executor.submit(compress_chunk, chunk))
+            if len(pending) >= 2 * threads:
+                compressed = pending.popleft().result()
+                stats.buffer(-len(compressed))
+                upload.write(compressed)
+
+        while pending:
+            compressed = pending.popleft().result()
+            stats.buffer(-len(compressed))
+            upload.write(compressed)
+
+
+class RegistryError(Exception):
+    """A request to a docker registry failed"""
+
+
+def _parse_image(image):
+    """Split an image name (e.g. ghcr.io/rifflearning/riff-docker/riffrtc:2.0, node:16) into its parts
+
+    returns the registry host, the repository in the registry, the tag, and
+    the name of the image without the registry (its name in the swarm's registry)
+    """
+    host, _, path = image.partition('/')
+    if not path or not ('.' in host or ':' in host or host == 'localhost'):
+        host, path = DOCKER_HUB_REGISTRY, image
+
+    name, tag = path, 'latest'
+    if ':' in path.rsplit('/', 1)[-1]:
+        name, tag = path.rsplit(':', 1)
+
+    repo = 'library/' + name if host == DOCKER_HUB_REGISTRY and '/' not in name else name
+    return host, repo, tag, name
+
+
+def _registry_credentials(host):
+    """Get the (username, password) docker login saved for the registry host, None if there isn't one"""
+    import base64
+    import subprocess
+
+    try:
+        with open(os.path.expanduser('~/.docker/config.json')) as f:
+            config = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    # docker login saves docker hub's credentials under its old index url
+    server = 'https://index.docker.io/v1/' if host == DOCKER_HUB_REGISTRY else host
+    helper = config.get('credHelpers', {}).get(server, config.get('credsStore'))
+    if helper:
+        try:
+            creds = subprocess.run(['docker-credential-{}'.format(helper), 'get'], input=server, stdout=subprocess.PIPE,
+                                   stderr=subprocess.DEVNULL, universal_newlines=True)
+        except OSError:
+            return None
+        if creds.returncode != 0:
+            return None
+        creds = json.loads(creds.stdout)
+        return creds['Username'], creds['Secret']
+
+    auth = config.get('auths', {}).get(server, {}).get('auth')
+    if not auth:
+        return None
+    username, _, password = base64.b64decode(auth).decode().partition(':')
+    return username, password
+
+
+class RegistryClient:
+    """Client for the HTTP API (v2) of a docker registry
+
+    Like DockerApi, each thread using the client gets its own keep-alive
+    connection, to the registry and to each host it redirects to (e.g. the
+    CDN serving docker hub's blobs). Bearer tokens are fetched when the
+    registry asks for them and are reused for the scope they were issued for.
+    """
+
+    def __init__(self, host, credentials=None, timeout=DOCKER_API_TIMEOUT):
+        self.host = host
+        # like docker, only local registries are used without tls
+        self.secure = host.split(':')[0] not in ('localhost', '127.0.0.1')
+        self.credentials = credentials
+        self.timeout = timeout
+        self._tokens = {}
+        self._local = threading.local()
+
+    def _connection(self, host, secure):
+        import http.client
+
+        connections = self._local.__dict__.setdefault('connections', {})
+        if (host, secure) not in connections:
+            conn_class = http.client.HTTPSConnection if secure else http.client.HTTPConnection
+            connections[(host, secure)] = conn_class(host, timeout=self.timeout, blocksize=1024 * 1024)
+        return connections[(host, secure)]
+
+    def _send(self, method, url, headers, body=None, host=None, secure=None):
+        """Send a request on this thread's connection to the host (the registry's by default)
+
+        returns the response, which must be read before the next request
+        """
+        import http.client
+
+        host, secure = host or self.host, self.secure if secure is None else secure
+        for attempt in (1, 2):
+            conn = self._connection(host, secure)
+            try:
+                with _profile_span('registry', '{} {}'.format(method, host)):
+                    conn.request(method, url, body=body, headers=headers)
+                    return conn.getresponse()
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError) as e:
+                # the registry may close a keep-alive connection which has been idle, retry once on a new one
+                # (unless the body is a stream which has been read from)
+                conn.close()
+                if attempt == 2 or hasattr(body, 'read'):
+                    raise RegistryError('{} closed the connection: {}'.format(host, e))
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                raise RegistryError('Could not reach the registry {}: {}'.format(host, e))
+
+    def _authorization(self, challenge, scope):
+        """Get the authorization header answering the registry's WWW-Authenticate challenge"""
+        import base64
+        from urllib.parse import urlencode, urlsplit
+
+        basic = None
+        if self.credentials is not None:
+            basic = 'Basic ' + base64.b64encode('{}:{}'.format(*self.credentials).encode()).decode()
+        if not challenge.lower().startswith('bearer '):
+            return basic
+
+        params = dict(re.findall(r'(\w+)="([^"]*)"', challenge))
+        realm = urlsplit(params.pop('realm'))
+        params['scope'] = scope
+        headers = {'Authorization': basic} if basic else {}
+        response = self._send('GET', '{}?{}'.format(realm.path, urlencode(params)), headers,
+                              host=realm.netloc, secure=realm.scheme == 'https')
+        body = response.read()
+        if response.status != 200:
+            raise RegistryError('{}: authentication failed ({}): {}'.format(self.host, response.status,
+                                                                            body.decode(errors='replace').strip()))
+        token = json.loads(body)
+        return 'Bearer ' + token.get('token', token.get('access_token', ''))
+
+    def request(self, method, path, scope, headers=None, body=None, expect=(200,)):
+        """Make a request of the registry, authenticating for the scope when the registry asks for it
+
+        Redirects of GET requests are followed. The response is returned if it
+        has an expected status, it must be read before the next request.
+        """
+        from urllib.parse import urlsplit
+
+        headers = dict(headers or {})
+        if scope in self._tokens:
+            headers['Authorization'] = self._tokens[scope]
+        response = self._send(method, path, headers, body)
+
+        if response.status == 401 and 'Authorization' not in headers and not hasattr(body, 'read'):
+            response.read()
+            self._tokens[scope] = self._authorization(response.getheader('WWW-Authenticate', ''), scope)
+            if self._tokens[scope]:
+                headers['Authorization'] = self._tokens[scope]
+                response = self._send(method, path, headers, body)
+
+        if method == 'GET' and response.status in (301, 302, 303, 307, 308):
+            response.read()
+            location = urlsplit(response.getheader('Location'))
+            url = location.path + ('?' + location.query if location.query else '')
+            if location.netloc:
+                # redirects elsewhere (presigned urls) must not be sent the registry's authorization
+                response = self._send('GET', url, {}, host=location.netloc, secure=location.scheme == 'https')
+            else:
+                response = self._send('GET', url, headers)
+
+        if response.status not in expect:
+            message = response.read().decode(errors='replace').strip()
+            raise RegistryError('{host}: {method} {path}: {status}: {msg}'.format(
+                host=self.host, method=method, path=path.split('?')[0], status=response.status, msg=message[:200]))
+        return response
+
+    def get_manifest(self, repo, reference):
+        """Get the manifest of the image (or list of images), returns the manifest, its media type and its raw bytes"""
+        response = self.request('GET', '/v2/{}/manifests/{}'.format(repo, reference), 'repository:{}:pull'.format(repo),
+                                {'Accept': ', '.join(IMAGE_MANIFEST_TYPES + IMAGE_INDEX_TYPES)})
+        raw = response.read()
+        manifest = json.loads(raw)
+        return manifest, manifest.get('mediaType') or response.getheader('Content-Type'), raw
+
+    def put_manifest(self, repo, tag, media_type, raw):
+        self.request('PUT', '/v2/{}/manifests/{}'.format(repo, tag), 'repository:{}:pull,push'.format(repo),
+                     {'Content-Type': media_type}, raw, expect=(201,)).read()
+
+    def has_blob(self, repo, digest):
+        response = self.request('HEAD', '/v2/{}/blobs/{}'.format(repo, digest), 'repository:{}:pull,push'.format(repo),
+                                expect=(200, 404))
+        response.read()
+        return response.status == 200
+
+    def get_blob(self, repo, digest):
+        """returns the response streaming the blob, it must be read before the next request"""
+        return self.request('GET', '/v2/{}/blobs/{}'.format(repo, digest), 'repository:{}:pull'.format(repo))
+
+    def mount_blob(self, repo, digest, from_repo):
+        """Mount a blob the registry has in another repository, returns whether it was mounted"""
+        from urllib.parse import urlencode
+
+        response = self.request('POST', '/v2/{}/blobs/uploads/?{}'.format(repo, urlencode({'mount': digest, 'from': from_repo})),
+                                'repository:{}:pull,push repository:{}:pull'.format(repo, from_repo),
+                                {'Content-Length': '0'}, expect=(201, 202))
+        response.read()
+        if response.status == 201:
+            return True
+
+        # the registry started an upload instead, it isn't needed
+        self.request('DELETE', self._upload_url(response), 'repository:{}:pull,push'.format(repo),
+                     expect=(204, 404)).read()
+        return False
+
+    @staticmethod
+    def _upload_url(response):
+        from urllib.parse import urlsplit
+
+        location = urlsplit(response.getheader('Location'))
+        return location.path + ('?' + location.query if location.query else '')
+
+    def put_blob(self, repo, digest, stream, size):
+        """Upload the blob read from the stream in a single request"""
+        from urllib.parse import urlencode
+
+        scope = 'repository:{}:pull,push'.format(repo)
+        response = self.request('POST', '/v2/{}/blobs/uploads/'.format(repo), scope, {'Content-Length': '0'},
+                                expect=(202,))
+        response.read()
+        url = self._upload_url(response)
+        url += ('&' if '?' in url else '?') + urlencode({'digest': digest})
+        self.request('PUT', url, scope, {'Content-Type': 'application/octet-stream', 'Content-Length': str(size)},
+                     stream, expect=(201,)).read()
+
+
+class _CountingReader:
+    """Counts the bytes read from a stream (in the stats)"""
+
+    def __init__(self, stream, stats):
+        self.stream = stream
+        self.stats = stats
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.stats.add(raw_bytes=len(data))
+        return data
+
+
+class ImageSync:
+    """Copies images to a registry (the swarm's), transferring only the blobs it doesn't already have
+
+    The blobs of all the images are copied concurrently using the executor.
+    The registry is named dest_name (e.g. localhost:5000) in the results,
+    which is how the swarm's nodes reach it.
+    A blob the registry already has in the image's repository is skipped, and
+    a blob it has in another repository (e.g. a base image's layer shared by
+    several images) is mounted from there instead of being transferred again.
+    """
+
+    def __init__(self, dest, executor, platform=SWARM_PLATFORM, dest_name=None):
+        self.dest = dest
+        self.executor = executor
+        self.platform = platform
+        self.dest_name = dest_name or dest.host
+        self.stats = TransferStats()
+        self._sources = {}
+        self._sources_lock = threading.Lock()
+        # the first transfer of each blob digest in this sync: (repository, future)
+        self._blobs = {}
+
+    def _source(self, host):
+        with self._sources_lock:
+            if host not in self._sources:
+                self._sources[host] = RegistryClient(host, credentials=_registry_credentials(host))
+            return self._sources[host]
+
+    def _image_manifest(self, image):
+        """Get the manifest of the image for the platform
+
+        returns the image's source registry client, repository, manifest, media type and raw manifest
+        """
+        host, repo, tag, _ = _parse_image(image)
+        source = self._source(host)
+        manifest, media_type, raw = source.get_manifest(repo, tag)
+        if media_type in IMAGE_INDEX_TYPES:
+            os_name, _, arch = self.platform.partition('/')
+            entry = next((m for m in manifest['manifests']
+                          if m.get('platform', {}).get('os') == os_name
+                          and m.get('platform', {}).get('architecture') == arch), None)
+            if entry is None:
+                raise RegistryError('{} has no {} image'.format(image, self.platform))
+            manifest, media_type, raw = source.get_manifest(repo, entry['digest'])
+        return source, repo, manifest, media_type, raw
+
+    def _copy_blob(self, source, src_repo, repo, blob, first):
+        """Copy the blob to the repository unless the registry has it
+
+        returns how the registry got the blob: present, mounted or transferred
+        """
+        digest = blob['digest']
+        if self.dest.has_blob(repo, digest):
+            return 'present'
+
+        if first is not None:
+            first_repo, first_future = first
+            first_future.result()
+            if self.dest.mount_blob(repo, digest, first_repo):
+                return 'mounted'
+
+        response = source.get_blob(src_repo, digest)
+        self.dest.put_blob(repo, digest, _CountingReader(response, self.stats), blob['size'])
+        return 'transferred'
+
+    def sync(self, images):
+        """Copy the images, tagging them in the registry with their name without their source registry
+
+        returns the results of copying each image (image name, counts of how the registry got its blobs)
+        """
+        manifests = list(self.executor.map(self._image_manifest, images))
+
+        copies = []
+        for image, (source, src_repo, manifest, media_type, raw) in zip(images, manifests):
+            _, _, tag, repo = _parse_image(image)
+            blobs = [manifest['config']] + manifest['layers']
+            futures = []
+            for blob in blobs:
+                first = self._blobs.get(blob['digest'])
+                if first is not None and first[0] == repo:
+                    futures.append(first[1])
+                    continue
+                future = self.executor.submit(self._copy_blob, source, src_repo, repo, blob, first)
+                self._blobs.setdefault(blob['digest'], (repo, future))
+                futures.append(future)
+            copies.append((image, repo, tag, media_type, raw, blobs, futures))
+
+        results = []
+        for image, repo, tag, media_type, raw, blobs, futures in copies:
+            counts = collections.Counter(future.result() for future in futures)
+            # the manifest is only pushed once the registry has all of its blobs
+            self.dest.put_manifest(repo, tag, media_type, raw)
+            results.append({'image': image, 'name': '{}/{}:{}'.format(self.dest_name, repo, tag),
+                             'blobs': len(blobs), 'size': sum(blob['size'] for blob in blobs), **counts})
+        return results
+
+
+def _format_image_sync(results):
+    """Format the results of an image sync (see ImageSync.sync) as lines"""
+    lines = []
+    for result in results:
+        lines.append('{image} -> {name}'.format(**result))
+        lines.append('  {blobs} blobs ({size}): {present} present, {mounted} mounted, {transferred} transferred'.format(
+            blobs=result['blobs'], size=_format_size(result['size']), present=result.get('present', 0),
+            mounted=result.get('mounted', 0), transferred=result.get('transferred', 0)))
+    return lines
+
+
+@click.command()
+@click_region_option
+@click.option('--key', 'key_name', required=True)
+@click.option('--manager-count', '-m', type=int, default='3', required=True, help='Number of managers to spin up. Recommended (and default) number is 3 (from Docker for AWS) for reliability.')
+@click.option('--manager-type', '-I', default='t2.micro', required=True, help='AWS Instance type for managers. Defaults to t2.micro.')
+@click.option('--worker-count', '-w', type=int, default='4', required=True, help='Number of workers to spin up. Defaults to 4')
+@click.option('--worker_type', '-i', default='t2.micro', required=True, help='AWS Instance type for workers. Defaults to t2.micro.')
+@click.argument('stack_name', required=True)
+def create(stack_name, region, key_name, manager_count, manager_type, worker_count, worker_type):
+    """Create a CloudFormation stack for a docker swarm.
+
+    A cloudformation stack name can contain only alphanumeric characters (case sensitive) and hyphens.
+    It must start with an alphabetic character and cannot be longer than 128 characters.
+    """
+    click.echo('Creating cloudformation stack:\n'
+               '      name: {name} ; region: \'{region}\'\n'
+               '       key: {key}\n'
+               '  managers: {mgr_cnt} {mgr_type} instance(s)\n'
+               '   workers: {wkr_cnt} {wkr_type} instance(s)\n'
+               .format(name=stack_name, region=region, key=key_name,
+                       mgr_cnt=manager_count, mgr_type=manager_type,
+                       wkr_cnt=worker_count, wkr_type=worker_type))
+
+    try:
+        _create_swarm_stack(stack_name, region, key_name, manager_count, manager_type, worker_count, worker_type)
+    except ClientError as e:
+        _highlight('{code}: {msg}'.format(code=e.response['Error']['Code'], msg=e.response['Error']['Message']), fg='red')
+        sys.exit(1)
+
+
+@click.command()
+@click_region_option
+@click.argument("stack_name", required=True)
+def delete(stack_name, region):
+    """Delete the CloudFormation stack(s) with the given name
+    """
+    cloudformation = _get_client('cloudformation', region)
+
+    try:
+        stacks = cloudformation.describe_stacks(StackName=stack_name)['Stacks']
+
+        _highlight('Found {cnt} stacks with the name {name}'.format(name=stack_name, cnt=len(stacks)))
+        delete_stacks = click.prompt('Are you sure you want to delete these stack(s)? (y/n)', type=bool)
+        if delete_stacks:
+            for stack in stacks:
+                _highlight("Deleting stack {}".format(stack['StackId']))
+                cloudformation.delete_stack(StackName=stack['StackId'])
+            StackInventory().invalidate(stack_name, region)
+    except ClientError as e:
+        _highlight('{code}: {msg}'.format(code=e.response['Error']['Code'], msg=e.response['Error']['Message']), fg='red')
+        sys.exit(1)
+
+
+@click.command()
+@click_region_option
+@click.argument("stack_name", required=True)
+def status(stack_name, region):
+    """Get the current status of an existing cloudformation stack
+    """
+    try:
+        status = _get_stack_status(stack_name, region)
+        _highlight(status)
+    except ClientError as e:
+        _highlight('{code}: {msg}'.format(code=e.response['Error']['Code'], msg=e.response['Error']['Message']), fg='red')
+        sys.exit(1)
+
+
+@click.command()
+@click_region_option
+@click.argument("stack_name", required=True)
+def wait_for_complete(stack_name, region):
+    """Wait for the stack status to be *_COMPLETE (or *_FAILED)
+
+    Wait for the stack's current operation to finish, writing the stack's
+    events (the progress of each of its resources) as they happen. Exits
+    with an error status if the operation failed or was rolled back.
+    """
+    try:
+        status = _wait_for_stack_operation(stack_name, region)
+    except ClientError as e:
+        # if waiting for delete to complete, then this is expected, but still should be reported specially just in case
+        _highlight('{code}: {msg}'.format(code=e.response['Error']['Code'], msg=e.response['Error']['Message']), fg='red')
+        return
+
+    _highlight('{time}: {status}'.format(time=time.strftime('%H:%M:%S'), status=click.style(status, fg=_status_color(status))))
+    if _is_failed_status(status):
+        sys.exit(1)
+
+
+@click.command()
+@click.option('--tunnel/--no-tunnel', 'tunnel', default=None,
+              help='Tunnel to each stack once it is created, overriding the stack specs.')
+@click.option('--format', 'output_format', type=click.Choice(['table', 'json']), default='table', show_default=True)
+@click.argument('spec_file', type=click.File('r'))
+def provision(spec_file, tunnel, output_format):
+    """Create the docker swarm stacks described in SPEC_FILE concurrently
+
+    Each stack is created, followed until its creation finishes and then its
+    DNS and managers are looked up and optionally a tunnel is created to it,
+    independently of the other stacks, so all the stacks are ready in about
+    the time it takes to create the slowest one. See _load_stack_specs for the
+    format of the SPEC_FILE.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    specs = _load_stack_specs(spec_file)
+    if tunnel is not None:
+        for spec in specs:
+            spec['tunnel'] = tunnel
+
+    tunnel_lock = threading.Lock()
+    reserved_ports = set()
+    with ThreadPoolExecutor(max_workers=max(1, len(specs))) as executor:
+        results = list(executor.map(lambda spec: _provision_stack(spec, tunnel_lock, reserved_ports), specs))
+
+    if output_format == 'json':
+        click.echo(json.dumps(results, indent=2))
+    else:
+        click.echo('\n{:<24} {:<10} {:<20} {:>7}  {:<16} {:<48} {}'.format('stack', 'region', 'status', 'minutes',
+                                                                          'docker host', 'dns', 'manager ips'))
+        for result in results:
+            _highlight('{:<24} {:<10} {:<20} {:>7.1f}  {:<16} {:<48} {}'.format(result['stack'][:24], result['region'],
+                                                                             result['status'] or '-', result['elapsed'] / 60,
+                                                                             result['docker_host'] or '-', result['dns'] or '-',
+                                                                             ' '.join(result['manager_ips']) or '-'),
+                       fg='red' if 'error' in result else 'green')
+            if 'error' in result:
+                _highlight('    {}'.format(result['error']), fg='red')
+
+    if any('error' in result for result in results):
+        sys.exit(1)
+
+
+@click.command()
+@click_region_option
+@click.argument("stack_name", required=True)
+def get_stack_dns(stack_name, region):
+    """Gets the public DNS of a stack with the name stack_name
+
+    """
+    try:
+        stack = _describe_stack(stack_name, region)
+
+        # The DefaultDNSTarget is one of the outputs from the Docker for AWS template we use to create the stack
+        outputs = stack['Outputs']
+        for o in outputs:
+            if o['OutputKey'] == 'DefaultDNSTarget':
+                dns = o['OutputValue']
+                click.echo('\n'.join(['The {name} stack\'s public DNS is:'.format(name=stack_name),
+                                      click.style('  {dns}\n'.format(dns=dns), fg='green')]))
+
+    except ClientError as e:
+        _highlight('{code}: {msg}'.format(code=e.response['Error']['Code'], msg=e.response['Error']['Message']), fg='red')
+
+
+@click.command()
+@click_region_option
+@click_inventory_options
+@click.argument("stack_name", required=True)
+def get_stack_manager_ips(stack_name, region, refresh, inventory_ttl):
+    """Get the IP addresses of all manager nodes of a docker swarm created by the named cloudformation Stack
+
+    Retrieves the IP addresses all manager nodes from a CloudFormation
+    docker swarm Stack with the given stack_name
+    """
+    instances = _get_stack_manager_instances(stack_name, region, refresh, inventory_ttl)
+
+    click.echo('manager instances:')
+    _highlight('\n'.join(['  {id}: {ip}'.format(**inst) for inst in instances]))
+
+
+@click.command()
+@click_region_option
+@click.option('-i', 'index', default=0, help='The index of manager whose ip should be returned. 0 is the index of the 1st manager')
+@click_inventory_options
+@click.argument("stack_name", required=True)
+def get_stack_manager_ip(stack_name, index, region, refresh, inventory_ttl):
+    """Get the IP address of the specified manager node of a docker swarm created by the named cloudformation Stack
+
+    Retrieves the IP address of the manager node at the specified index
+    from a CloudFormation docker swarm Stack with the given stack_name
+    with no extra text, so it can be used in a environment variable.
+    """
+    try:
+        instances = _get_stack_manager_instances(stack_name, region, refresh, inventory_ttl)
+        click.echo(instances[index]['ip'])
+    except IndexError:
+        click.echo('Only {cnt} mananger(s) found, could not get the ip of manager[{i}]'.format(i=index, cnt=len(instances)), err=True)
+
+
+@click.command()
+@click_region_option
+@click_inventory_options
+@click.argument("stack_name", required=True)
+def get_stack_manager_dns(stack_name, region, refresh, inventory_ttl):
+    """Get the DNS addresses of all manager nodes of a docker swarm created by the named cloudformation Stack
+
+    Retrieves the DNS addresses all manager nodes from a CloudFormation
+    docker swarm Stack with the given stack_name
+    """
+    instances = _get_stack_manager_instances(stack_name, region, refresh, inventory_ttl)
+
+    click.echo('manager instances:')
+    _highlight('\n'.join(['  {id}: {dns}'.format(**inst) for inst in instances]))
+
+
+@click.command()
+@click.option('--region', 'regions', type=click.Choice(REGIONS), multiple=True,
+              help='Only look at swarms in this region (may be repeated). Defaults to all regions.')
+@click.option('--workers', default=16, show_default=True, help='The maximum number of concurrent AWS requests')
+@click.option('--format', 'output_format', type=click.Choice(['table', 'json']), default='table', show_default=True)
+def fleet(regions, workers, output_format):
+    """Show the status of every docker swarm stack in every region
+
+    The regions are listed concurrently and each swarm is described as soon
+    as its region has been listed, so this takes about as long as the
+    slowest region rather than the sum of all the requests.
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        region_futures = {executor.submit(_list_swarm_stacks, region): region for region in regions or REGIONS}
+        swarm_futures = []
+        for future in as_completed(region_futures):
+            region = region_futures[future]
+            try:
+                stacks = future.result()
+            except ClientError as e:
+                _highlight('{region}: {code}: {msg}'.format(region=region, code=e.response['Error']['Code'],
+                                                            msg=e.response['Error']['Message']), fg='red')
+                continue
+            swarm_futures.extend(executor.submit(_get_swarm_info, stack, region) for stack in stacks)
+
+        swarms = [future.result() for future in swarm_futures]
+
+    swarms.sort(key=lambda info: (info['region'], info['stack']))
+    if output_format == 'json':
+        click.echo(json.dumps(swarms, indent=2))
+    else:
+        for line in _format_fleet_table(swarms):
+            click.echo(line)
+
+
+@click.command()
+@click.option('--key', 'key_name',
+              help='The full path to the AWS key file for the docker swarm. If unspecified, '
+                   'the key must be associated with the node\'s IP address in ~/.ssh/config')
+@click.option('--port', type=int, help='The local port for the tunnel. Defaults to the port the stack\'s tunnel '
+                                         'already uses, or the first free port from {}.'.format(TUNNEL_BASE_PORT))
+@click.option('--watch', is_flag=True,
+              help='Keep watching the tunnel (until Ctrl-C), reconnecting it when it stops working.')
+@click.option('--ping-interval', type=int, default=TUNNEL_WATCH_INTERVAL, show_default=True,
+              help='How often (seconds) a watched tunnel is pinged.')
+@click.option('--report-interval', type=int, default=60, show_default=True,
+              help='How often (seconds) the stats of a watched tunnel are written.')
+@click.option('--auto', is_flag=True,
+              help='Tunnel to the manager which responds the quickest instead of asking which manager to use.')
+@click.option('--probe-ssh', is_flag=True,
+              help='With --auto, time an ssh handshake with each manager rather than just connecting to its ssh port.')
+@click_region_option
+@click_inventory_options
+@click.argument("stack_name", required=True)
+def tunnel(stack_name, region, key_name, port, watch, ping_interval, report_interval, auto, probe_ssh, refresh, inventory_ttl):
+    """Create a tunnel to a docker swarm manager node of a cloudformation stack
+
+    An ssh tunnel to a selected manager node will be created. If there is more
+    than one manager node the user will be prompted to select one of them,
+    unless --auto is given, then the managers are probed concurrently and the
+    one which responds the quickest is used.
+    If there is an existing tunnel to a different manager of the stack, the user
+    will be prompted on whether to replace it or abort, leaving the existing
+    tunnel alone.
+    Each stack's tunnel gets its own localhost port (the first one gets 2374)
+    so tunnels to several stacks can be used at the same time.
+    After creating the tunnel, in order for docker to use it the evironment
+    variable DOCKER_HOST must be exported pointing to the tunnel.
+      export DOCKER_HOST=$(docker-swarm.py docker-host STACK_NAME)
+    With --watch the tunnel is supervised, it is pinged regularly and reconnected
+    (to another manager if its manager is gone) when it stops working.
+    """
+    # how to tunnel to the docker swarm manager is described at
+    # https://docs.docker.com/docker-for-aws/deploy/#manager-nodes
+
+    # There's no need at this time to allow the user or tunnel port to be configurable
+    # so they are hardcoded here. This makes them easily configurable in the future if desired.
+    user = 'docker'
+
+    # Check that the stack exists and that create has completed
+    try:
+        status = _get_stack_status(stack_name, region)
+        if status != 'CREATE_COMPLETE':
+            _highlight('Stack not ready. Status: {status}'.format(status=status), fg='red')
+            _highlight('You can wait for it to be ready using:\n'
+                       '  docker-swarm.py wait-for-complete {name} --region={region}\n\n'
+                       .format(name=stack_name, region=region))
+            return
+    except ClientError as e:
+        _highlight('{code}: {msg}'.format(code=e.response['Error']['Code'], msg=e.response['Error']['Message']), fg='red')
+        return
+
+    mgr_instances = _get_stack_manager_instances(stack_name, region, refresh, inventory_ttl)
+    if not mgr_instances:
+        _highlight('No manager instances found for stack {name}'.format(name=stack_name), fg='red')
+        sys.exit(1)
+
+    if auto:
+        mgr_ip = _select_fastest_manager(stack_name, region, mgr_instances, probe_ssh, refresh, inventory_ttl)
+        if mgr_ip is None:
+            _highlight('None of the managers of stack {name} responded'.format(name=stack_name), fg='red')
+            StackInventory().invalidate(stack_name, region)
+            sys.exit(1)
+    elif len(mgr_instances) == 1:
+        mgr_ip = mgr_instances[0]['ip']
+    else:
+        # Ask which manager to tunnel to
+        _highlight('Select the manager you want to tunnel to:', fg='white')
+        selection_str = '\n'.join(['  {n}) {id}: {ip}'.format(n=n + 1, id=inst['id'], ip=inst['ip'])
+                                   for n, inst in enumerate(mgr_instances)])
+        _highlight(selection_str)
+        sel = click.prompt('Your selection', type=click.IntRange(1, len(mgr_instances)))
+        mgr_ip = mgr_instances[sel - 1]['ip']
+
+    # create the tunnel (will check for existing ssh tunnel processes which we want to
+    # happen after selecting the mgr so the user can see the mgr IPs)
+    try:
+        port = _start_docker_tunnel(mgr_ip, user=user, key_name=key_name, stack_name=stack_name, port=port)
+    except SystemExit:
+        # ssh failed, the manager from the inventory may no longer exist so look it up again next time
+        StackInventory().invalidate(stack_name, region)
+        raise
+
+    if watch and port is not None:
+        _watch_tunnel(stack_name, region, port, user, key_name, mgr_ip, ping_interval, report_interval)
+
+
+@click.command()
+@click.option('--reconcile', is_flag=True, help='Also scan the running processes for tunnels created by something else.')
+def list_tunnels(reconcile):
+    """List the running tunnels to docker machines
+    """
+    registry = TunnelRegistry()
+    if reconcile:
+        port = TUNNEL_BASE_PORT
+        if registry.get(port) is None and _is_port_in_use(port):
+            registry.reconcile(port)
+
+    tunnels = registry.tunnels()
+    if not tunnels:
+        click.echo('No tunnels are running')
+        return
+
+    click.echo('{:<24} {:>6} {:>7}  {:<20} {}'.format('name', 'port', 'pid', 'started', 'host'))
+    for tunnel in tunnels:
+        host = tunnel['ip'] if tunnel['user'] is None else '{user}@{ip}'.format(**tunnel)
+        _highlight('{:<24} {:>6} {:>7}  {:<20} {}'.format(tunnel['name'], tunnel['port'], tunnel['pid'],
+                                                         tunnel['started'], host))
+
+
+@click.command()
+@click.argument('name', required=False)
+def kill_tunnel(name):
+    """Kill running tunnels to docker swarm manager nodes
+
+    Kills the tunnel with the given name (a stack name or ip), or all tunnels
+    if no name is given.
+    """
+    registry = TunnelRegistry()
+    if name is not None:
+        tunnel = registry.find(name)
+        if tunnel is None:
+            _highlight('No tunnel named {} is running'.format(name), fg='red')
+            return
+        tunnel_info = [tunnel]
+    else:
+        tunnel_info = registry.tunnels()
+        if not any(tunnel['port'] == TUNNEL_BASE_PORT for tunnel in tunnel_info):
+            tunnel_info.extend(_get_tunnel_info(TUNNEL_BASE_PORT, registry))
+
+    kill_tunnel, tunnel_cnt = _stop_tunnels(tunnel_info, registry)
+
+    if kill_tunnel and tunnel_cnt > 0:
+        if 'DOCKER_HOST' in os.environ:
+            _highlight('\nYou have DOCKER_HOST exported in your environment:\n'
+                       '  DOCKER_HOST={}\n'
+                       'You can remove it using:\n'
+                       '  unset DOCKER_HOST\n'.format(os.environ['DOCKER_HOST']))
+    else:
+        # did not kill existing tunnel (ie replied no to prompt)
+        if tunnel_cnt > 0:
+            sys.exit(1)
+
+
+@click.command()
+@click.argument('name', required=False)
+def docker_host(name):
+    """Print the DOCKER_HOST for the tunnel with the given name (a stack name or ip)
+
+    With no name, the DOCKER_HOST of every running tunnel is listed.
+
+    \b
+      export DOCKER_HOST=$(docker-swarm.py docker-host STACK_NAME)
+    """
+    registry = TunnelRegistry()
+    if name is not None:
+        tunnel = registry.find(name)
+        if tunnel is None:
+            click.echo('No tunnel named {} is running'.format(name), err=True)
+            sys.exit(1)
+        click.echo('localhost:{port}'.format(**tunnel))
+        return
+
+    for tunnel in registry.tunnels():
+        click.echo('{name}: DOCKER_HOST=localhost:{port}'.format(**tunnel))
+
+
+@click.command()
+@click.option('--key', 'key_name',
+              help='The full path to the AWS key file for the docker swarm. If unspecified, '
+                   'the key must be associated with the node\'s IP address in ~/.ssh/config')
+@click.option('--user', '-u', help='The username for the shell on the remote IP if different from the ssh default')
+@click.option('--name', help='The name of the tunnel. Defaults to the ip.')
+@click.option('--port', type=int, help='The local port for the tunnel. Defaults to the port the named tunnel '
+                                         'already uses, or the first free port from {}.'.format(TUNNEL_BASE_PORT))
+@click.argument("ip", required=True)
+def start_docker_tunnel(ip, user, key_name, name, port):
+    """Start an ssh tunnel to a network location (IP) running docker.
+
+    The given ip may be an alias defined in the ~/.ssh/config file which specifies
+    the host user and actual ip address.
+    """
+    _start_docker_tunnel(ip, user=user, key_name=key_name, name=name, port=port)
+
+
+def _time_startup(args, repeat):
+    """Run the docker-swarm.py script with the args repeat times (just the python interpreter if there are no args)
+
+    returns the wall clock times (ms) of the runs, and whether running it imports boto3
+    """
+    import subprocess
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'docker-swarm.py')
+    cmd = [sys.executable, script] + args if args else [sys.executable, '-c', 'pass']
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append((time.perf_counter() - start) * 1000)
+
+    # -X importtime reports every module imported on stderr (it slows the run so it isn't timed)
+    importtime = subprocess.run([sys.executable, '-X', 'importtime'] + cmd[1:], stdin=subprocess.DEVNULL,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    imports_boto3 = any(line.rstrip().endswith('| boto3') for line in importtime.stderr.splitlines())
+    return times, imports_boto3
+
+
+@click.command()
+@click.option('--stack', default=DEFAULT_DOCKER_STACK, show_default=True, help='The docker stack to deploy.')
+@click.option('--compose-file', '-c', 'compose_files', multiple=True, type=click.Path(exists=True, dir_okay=False),
+              help='A compose/stack config file to deploy (repeatable). Defaults to {} and docker-stack.DEPLOY_SWARM.yml.'
+                   .format(' '.join(STACK_DEPLOY_FILES)))
+@click.option('--port', type=int,
+              help='The local port of the tunnel to the docker engine. Defaults to the port of the named tunnel, '
+                   'else of DOCKER_HOST, else {}.'.format(TUNNEL_BASE_PORT))
+@click.option('--tiers', is_flag=True,
+              help='Deploy the tiers of services (grouped by placement constraints) in parallel, deploying the '
+                   'services of a tier one at a time, each once the one before it is healthy.')
+@click.option('--timeout', type=int, default=DEPLOY_TIMEOUT, show_default=True,
+              help='How long (seconds) to wait for the services (each service with --tiers) to converge.')
+@click.option('--stuck-after', type=int, default=DEPLOY_STUCK_AFTER, show_default=True,
+              help='How long (seconds) a rollout can make no progress before it is reported as stuck.')
+@click.argument('name', required=False)
+def deploy(name, stack, compose_files, port, tiers, timeout, stuck_after):
+    """Deploy a docker stack and follow its rollout until every service has converged
+
+    The stack is deployed through the tunnel with the given name (a stack name
+    or ip). Failing tasks and stuck services are reported as they happen, and
+    the rollout time of each service when they are done.
+    Like make deploy-stack, by default the files deployed need DEPLOY_SWARM set.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    import tempfile
+
+    if not compose_files:
+        if not os.environ.get('DEPLOY_SWARM'):
+            _highlight('DEPLOY_SWARM must be set to deploy the default compose files', fg='red')
+            sys.exit(1)
+        compose_files = STACK_DEPLOY_FILES + ('docker-stack.{}.yml'.format(os.environ['DEPLOY_SWARM']),)
+
+    port = _docker_api_port(name, port)
+    api = DockerApi(port)
+    try:
+        versions, old_tasks = _stack_service_versions(api, stack)
+        events = StackEvents(api, stack).start()
+
+        if tiers:
+            config = _load_stack_config(compose_files, port)
+            service_tiers = _service_tiers(config)
+            for tier, services in service_tiers.items():
+                _highlight('{}: {}'.format(tier, ', '.join(services)), fg='white')
+            with tempfile.TemporaryDirectory() as tmp_dir, \
+                    ThreadPoolExecutor(max_workers=len(service_tiers) or 1) as executor:
+                futures = [executor.submit(_deploy_tier, api, events, stack, config, services, port, versions,
+                                           old_tasks, timeout, stuck_after, tmp_dir)
+                           for services in service_tiers.values()]
+                rollouts = [rollout for future in futures for rollout in future.result()]
+        else:
+            if not _stack_deploy(stack, compose_files, port):
+                _highlight('docker stack deploy failed', fg='red')
+                sys.exit(1)
+            new_versions, _ = _stack_service_versions(api, stack)
+            rollouts = [ServiceRollout(svc_name, versions.get(svc_name), old_tasks, stuck_after)
+                        for svc_name in sorted(new_versions)]
+            _follow_rollouts(api, events, rollouts, timeout)
+    except DockerApiError as e:
+        _highlight(str(e), fg='red')
+        sys.exit(1)
+    finally:
+        api.close()
+
+    click.echo()
+    click.echo('\n'.join(_format_rollouts(rollouts)))
+    if any(rollout.result not in ('converged', 'unchanged') for rollout in rollouts):
+        sys.exit(1)
+
+
+def click_backup_options(f):
+    """Add the options for finding the mongo container and the S3 storage of its backups to a command"""
+    f = click.option('--port', type=int,
+                     help='The local port of the tunnel to the docker engine of the node running the mongo db. '
+                          'Defaults to the port of the named tunnel, else of DOCKER_HOST, else {}.'
+                          .format(TUNNEL_BASE_PORT))(f)
+    f = click.option('--container', help='The name/id of the container running the mongo db. Defaults to the running '
+                                         'container with the {} volume.'.format(MONGO_DATA_VOLUME))(f)
+    f = click.option('--bucket', required=True, envvar='RIFF_BACKUP_BUCKET',
+                     help='The S3 bucket of the backups (or set RIFF_BACKUP_BUCKET).')(f)
+    f = click.option('--endpoint-url', envvar='RIFF_BACKUP_ENDPOINT_URL',
+                     help='The url of S3 compatible storage (e.g. MinIO) to use instead of AWS S3.')(f)
+    f = click.option('--s3-region', default='us-east-2', show_default=True, help='The region of the S3 bucket.')(f)
+    f = click.option('--part-size', type=click.IntRange(5, 5 * 1024), default=BACKUP_PART_SIZE, show_default=True,
+                     help='The size (MiB) of the parts transferred to and from S3.')(f)
+    f = click.option('--transfers', type=click.IntRange(1, 16), default=BACKUP_TRANSFERS, show_default=True,
+                     help='The number of parts to transfer at once.')(f)
+    f = click.option('--yes', '-y', is_flag=True, help='Don\'t ask for confirmation.')(f)
+    return f
+
+
+@click.command()
+@click_backup_options
+@click.option('--db', 'db_name', default=MONGO_DB_DEFAULT, show_default=True, help='The database to back up.')
+@click.option('--app', default=MONGO_BACKUP_APP, show_default=True, help='The app name used in the archive name.')
+@click.option('--prefix', default='', help='The prefix of the archive\'s key in the bucket (e.g. backups/).')
+@click.option('--compression', type=click.Choice(sorted(BACKUP_EXTENSIONS)), default='gzip', show_default=True,
+              help='How to compress the archive (zstd needs the zstandard package).')
+@click.option('--level', type=int, help='The compression level. Defaults to 6 for gzip, 3 for zstd.')
+@click.option('--threads', type=click.IntRange(1, 64), default=os.cpu_count() or 1, show_default=True,
+              help='The number of threads compressing the archive.')
+@click.argument('name', required=False)
+def mongo_backup(name, port, container, bucket, endpoint_url, s3_region, part_size, transfers, yes,
+                 db_name, app, prefix, compression, level, threads):
+    """Back up the riffdata mongo database to S3
+
+    The mongodump archive is streamed out of the mongo container through the
+    tunnel with the given name (a stack name or ip), compressed in parallel and
+    uploaded in parts while the dump is still running, nothing is written to disk.
+    The archive is named like those of mongo-backup.sh (using DEPLOY_SWARM).
+    """
+    import subprocess
+    from concurrent.futures import ThreadPoolExecutor
+
+    port = _docker_api_port(name, port)
+    compress = _chunk_compressor(compression, level)
+    if container is None:
+        api = DockerApi(port)
+        try:
+            container = _find_mongo_container(api, MONGO_DATA_VOLUME)
+        except DockerApiError as e:
+            _highlight(str(e), fg='red')
+            sys.exit(1)
+        finally:
+            api.close()
+
+    key = _backup_archive_key(prefix, db_name, app, compression)
+    click.echo('The backup will be created using the following:')
+    click.echo('  Mongo container name: {}'.format(container))
+    click.echo('  Archive: s3://{}/{}'.format(bucket, key))
+    if not yes:
+        click.confirm('Continue?', abort=True)
+
+    stats = TransferStats()
+    s3 = _get_client('s3', s3_region, endpoint_url)
+    try:
+        with ThreadPoolExecutor(max_workers=transfers) as executor:
+            upload = MultipartUpload(s3, bucket, key, part_size * 1024 * 1024, transfers, executor, stats)
+            try:
+                with _profile_span('subprocess', 'docker exec mongodump'):
+                    dump = subprocess.Popen(['docker', 'exec', container, 'mongodump', '--db={}'.format(db_name),
+                                             '--archive'],
+                                            stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, env=_docker_env(port))
+                    try:
+                        _stream_mongo_backup(dump, upload, compress, threads, stats)
+                    finally:
+                        dump.stdout.close()
+                        returncode = dump.wait()
+
+                if returncode != 0:
+                    _highlight('mongodump failed (exit code {}), aborting the upload'.format(returncode), fg='red')
+                    sys.exit(1)
+                upload.complete()
+            except BaseException:
+                # don't leave the parts uploaded so far in the bucket (they are charged for until aborted)
+                upload.abort()
+                raise
+    except ClientError as e:
+        _highlight('{code}: {msg}'.format(code=e.response['Error']['Code'], msg=e.response['Error']['Message']), fg='red')
+        sys.exit(1)
+
+    _highlight('Backed up {}'.format(stats.summary()))
+
+
+@click.command()
+@click_backup_options
+@click.option('--from-db', default=MONGO_DB_DEFAULT, show_default=True, help='The database in the archive to restore.')
+@click.option('--to-db', help='The database to restore to. Defaults to the --from-db database.')
+@click.option('--drop', is_flag=True,
+              help='Drop the collections being restored before restoring them. Other collections are not dropped.')
+@click.argument('archive', required=True)
+@click.argument('name', required=False)
+def mongo_restore(archive, name, port, container, bucket, endpoint_url, s3_region, part_size, transfers, yes,
+                  from_db, to_db, drop):
+    """Restore a backup (the ARCHIVE key in the bucket) to the riffdata mongo database
+
+    The archive is downloaded in parts concurrently, decompressed (by its
+    .gz or .zst extension) and streamed into mongorestore in the mongo
+    container through the tunnel with the given name (a stack name or ip).
+    """
+    import gzip
+    import subprocess
+    from concurrent.futures import ThreadPoolExecutor
+
+    to_db = to_db or from_db
+    port = _docker_api_port(name, port)
+    if not archive.endswith(tuple('.' + ext for ext in BACKUP_EXTENSIONS.values())):
+        _highlight('The archive must be a gzip (.gz) or zstd (.zst) compressed mongodump archive', fg='red')
+        sys.exit(1)
+    if container is None:
+        api = DockerApi(port)
+        try:
+            container = _find_mongo_container(api, MONGO_DATA_VOLUME)
+        except DockerApiError as e:
+            _highlight(str(e), fg='red')
+            sys.exit(1)
+        finally:
+            api.close()
+
+    click.echo('The backup archive will be restored using the following:')
+    click.echo('  Mongo container name: {}'.format(container))
+    click.echo('  Archive: s3://{}/{}'.format(bucket, archive))
+    click.echo('  Restore database {} to database {}{}'.format(from_db, to_db, ' (dropping the collections restored)'
+                                                             if drop else ''))
+    if not yes:
+        click.confirm('Continue?', abort=True)
+
+    restore_cmd = ['docker', 'exec', '-i', container, 'mongorestore', '--archive',
+                   '--nsInclude={}.*'.format(from_db), '--nsFrom={}.*'.format(from_db), '--nsTo={}.*'.format(to_db)]
+    if drop:
+        restore_cmd.append('--drop')
+
+    stats = TransferStats()
+    s3 = _get_client('s3', s3_region, endpoint_url)
+    try:
+        size = s3.head_object(Bucket=bucket, Key=archive)['ContentLength']
+        with ThreadPoolExecutor(max_workers=transfers) as executor:
+            reader = RangeReader(s3, bucket, archive, size, part_size * 1024 * 1024, transfers, executor, stats)
+            if archive.endswith('.zst'):
+                archive_stream = _import_zstandard().ZstdDecompressor().stream_reader(reader, read_across_frames=True)
+            else:
+                archive_stream = gzip.GzipFile(fileobj=reader, mode='rb')
+
+            with _profile_span('subprocess', 'docker exec mongorestore'):
+                restore = subprocess.Popen(restore_cmd, stdin=subprocess.PIPE, env=_docker_env(port))
+                try:
+                    while True:
+                        chunk = archive_stream.read(BACKUP_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        stats.add(raw_bytes=len(chunk))
+                        restore.stdin.write(chunk)
+                except BrokenPipeError:
+                    # mongorestore failed, its exit code says so
+                    pass
+                finally:
+                    try:
+                        restore.stdin.close()
+                    except BrokenPipeError:
+                        pass
+                    returncode = restore.wait()
+    except ClientError as e:
+        _highlight('{code}: {msg}'.format(code=e.response['Error']['Code'], msg=e.response['Error']['Message']), fg='red')
+        sys.exit(1)
+
+    if returncode != 0:
+        _highlight('mongorestore failed (exit code {})'.format(returncode), fg='red')
+        sys.exit(1)
+    _highlight('Restored {}'.format(stats.summary()))
+
+
+def _free_local_port():
+    """Get a local port which nothing is using (the OS picks it)"""
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+@click.command()
+@click.option('--name', help='The tunnel (a stack name or ip) to the swarm whose registry the images are copied to. '
+                             'Defaults to the tunnel of DOCKER_HOST.')
+@click.option('--registry', help='The host:port of the registry to copy the images to, instead of the swarm\'s '
+                                 'registry (which is reached by forwarding a local port over the tunnel).')
+@click.option('--compose-file', '-c', 'compose_files', multiple=True, type=click.Path(exists=True, dir_okay=False),
+              help='Copy the images of this compose/stack config file (repeatable) when no images are given. '
+                   'Defaults to the files deploy uses.')
+@click.option('--platform', default=SWARM_PLATFORM, show_default=True,
+              help='The platform of the image to copy when an image is built for several platforms.')
+@click.option('--transfers', type=click.IntRange(1, 32), default=SYNC_TRANSFERS, show_default=True,
+              help='The number of blobs to copy at once.')
+@click.argument('images', nargs=-1)
+def sync_images(name, registry, compose_files, platform, transfers, images):
+    """Copy images to the swarm's private registry
+
+    Only the layers the registry doesn't have are transferred, so the swarm's
+    nodes then only pull the images from the registry next to them. An image
+    is tagged in the registry with its name without its registry, e.g.
+    ghcr.io/rifflearning/riff-docker/riffrtc:2.0 is copied to
+    localhost:5000/rifflearning/riff-docker/riffrtc:2.0, so the riff images
+    can be deployed from the registry with RIFF_IMAGE_REGISTRY=localhost:5000.
+    With no images given, the images of the stack's compose files are copied.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    port = _docker_api_port(name)
+    if not images:
+        if not compose_files and not os.environ.get('DEPLOY_SWARM'):
+            _highlight('Give the images to copy, or set DEPLOY_SWARM to copy the images of the stack', fg='red')
+            sys.exit(1)
+        compose_files = compose_files or STACK_DEPLOY_FILES + ('docker-stack.{}.yml'.format(os.environ['DEPLOY_SWARM']),)
+        # the images to copy are the ones at their source, not in the swarm's registry
+        os.environ.pop('RIFF_IMAGE_REGISTRY', None)
+        config = _load_stack_config(compose_files, port)
+        images = sorted({service['image'] for service in config['services'].values() if 'image' in service})
+
+    tunnel = None
+    if registry is None:
+        tunnels = TunnelRegistry()
+        tunnel = tunnels.find(name) if name is not None else next((t for t in tunnels.tunnels() if t['port'] == port), None)
+        if tunnel is None:
+            _highlight('No tunnel to a swarm is running, give the --name of one or the --registry to use', fg='red')
+            sys.exit(1)
+        if tunnel.get('remote') is None:
+            # not created by this tool (see TunnelRegistry.reconcile) so there is no master connection to forward over
+            _highlight('The tunnel {} has no ssh master connection to forward the registry port over, restart it '
+                       'with the tunnel command or give the --registry to use'.format(tunnel['name']), fg='red')
+            sys.exit(1)
+        local_port = _free_local_port()
+        forward = 'localhost:{}:localhost:{}'.format(local_port, SWARM_REGISTRY_PORT)
+        if _run(_ssh_control_cmd(tunnel['remote'], 'forward', '-L', forward)).returncode != 0:
+            _highlight('Could not forward a local port to the registry of {} over its tunnel'.format(tunnel['name']),
+                       fg='red')
+            sys.exit(1)
+        registry = 'localhost:{}'.format(local_port)
+
+    dest = RegistryClient(registry, credentials=_registry_credentials(registry))
+    try:
+        with ThreadPoolExecutor(max_workers=transfers) as executor:
+            image_sync = ImageSync(dest, executor, platform,
+                                   'localhost:{}'.format(SWARM_REGISTRY_PORT) if tunnel is not None else registry)
+            results = image_sync.sync(list(images))
+    except RegistryError as e:
+        _highlight(str(e), fg='red')
+        sys.exit(1)
+    finally:
+        if tunnel is not None:
+            _run(_ssh_control_cmd(tunnel['remote'], 'cancel', '-L', forward))
+
+    click.echo('\n'.join(_format_image_sync(results)))
+    stats = image_sync.stats
+    elapsed = time.monotonic() - stats.started
+    total_size = sum(result['size'] for result in results)
+    _highlight('Moved {moved} of {total} ({skipped} already in the registry) in {elapsed:.1f}s ({rate}/s)'.format(
+        moved=_format_size(stats.raw_bytes), total=_format_size(total_size),
+        skipped=_format_size(total_size - stats.raw_bytes), elapsed=elapsed,
+        rate=_format_size(stats.raw_bytes / elapsed if elapsed else 0)))
+
+
+@click.command()
+@click.option('--repeat', type=int, default=5, show_default=True,
+              help='The number of times to run each command.')
+@click.option('--budget-ms', type=int, default=STARTUP_BUDGET_MS, show_default=True,
+              help='The time (ms) the local-only commands may add to the python interpreter\'s startup.')
+@click.pass_context
+def bench_startup(ctx, repeat, budget_ms):
+    """Time how long each command takes to start
+
+    Runs every command with --help, and the commands which don't use AWS
+    (docker-host, list-tunnels) as they are, reporting the fastest and median wall clock
+    time of the runs, how much longer than the bare python interpreter that
+    is, and whether boto3 was imported.
+
+    Exits with an error if a local-only command takes longer than the budget
+    more than the interpreter.
+    """
+    # the python interpreter's own startup time is the baseline (empty args) for the commands' times
+    commands = [[]] + [[name, '--help'] for name in sorted(ctx.parent.command.commands)] + list(LOCAL_ONLY_COMMANDS)
+
+    over_budget = False
+    baseline = None
+    click.echo('{:<36} {:>8} {:>8} {:>8}  {}'.format('command', 'min ms', 'med ms', '+python', 'boto3'))
+    for args in commands:
+        times, imports_boto3 = _time_startup(args, repeat)
+        times.sort()
+        fastest, median = times[0], times[len(times) // 2]
+        if baseline is None:
+            baseline = median
+        line = '{:<36} {:>8.1f} {:>8.1f} {:>8.1f}  {}'.format(' '.join(args) or '(python)', fastest, median,
+                                                            median - baseline, 'yes' if imports_boto3 else 'no')
+        if args in LOCAL_ONLY_COMMANDS and median - baseline > budget_ms:
+            over_budget = True
+            _highlight(line, fg='red')
+        else:
+            _highlight(line)
+
+    if over_budget:
+        _highlight('local-only commands take more than {} ms longer to start than python'.format(budget_ms), fg='red')
+        sys.exit(1)
+
+
+@click.command()
+@click.option('--stack', default=DEFAULT_DOCKER_STACK, show_default=True, help='The docker stack to show.')
+@click.option('--port', type=int,
+              help='The local port of the tunnel to the docker engine. Defaults to the port of the named tunnel, '
+                   'else of DOCKER_HOST, else {}.'.format(TUNNEL_BASE_PORT))
+@click.option('--interval', type=float, default=TOP_REFRESH_INTERVAL, show_default=True,
+              help='How often (seconds) to refresh.')
+@click.option('--count', type=int, default=0, help='Stop after this many refreshes. Defaults to refreshing until interrupted.')
+@click.argument('name', required=False)
+def top(name, stack, port, interval, count):
+    """Show the services, tasks and container resource use of a docker stack
+
+    The docker engine api is used directly through the tunnel with the given
+    name (a stack name or ip), reusing keep-alive connections between refreshes.
+    Resource use is only available for the containers on the tunnel's manager.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    port = _docker_api_port(name, port)
+    api = DockerApi(port)
+    refreshes = 0
+    try:
+        with ThreadPoolExecutor(max_workers=DOCKER_API_WORKERS) as executor:
+            stack_top = StackTop(api, stack, executor)
+            while True:
+                start = time.monotonic()
+                snapshot = stack_top.refresh()
+                elapsed = time.monotonic() - start
+                refreshes += 1
+
+                if sys.stdout.isatty():
+                    click.clear()
+                _highlight('{stack} on localhost:{port} at {time} ({requests} requests, took {ms:.0f} ms)'
+                           .format(stack=stack, port=port, time=time.strftime('%H:%M:%S'),
+                                   requests=stack_top.requests, ms=elapsed * 1000), fg='white')
+                if not snapshot:
+                    _highlight('The stack {} has no services'.format(stack), fg='yellow')
+                click.echo('\n'.join(_format_top(snapshot)))
+
+                if count and refreshes >= count:
+                    break
+                stack_top.requests = 0
+                time.sleep(max(0, interval - elapsed))
+    except DockerApiError as e:
+        _highlight(str(e), fg='red')
+        sys.exit(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        api.close()
+
+
+@click.group()
+@click.option('--profile', is_flag=True,
+              help='Profile the command: time every AWS request, subprocess and process scan and write '
+                   'the profile to stderr when it finishes.')
+@click.option('--profile-format', type=click.Choice(['table', 'json', 'chrome']), default='table', show_default=True,
+              help='Write the profile as a summary table, a json summary or a Chrome trace.')
+@click.option('--profile-file', type=click.Path(dir_okay=False, writable=True),
+              help='Write the profile to this file instead of stderr.')
+@click.pass_context
+def cli(ctx, profile, profile_format, profile_file):
+    """Create, manage, and connect to CloudFormation stacks.
+
+    Specifically tailored to use the Docker for AWS CloudFormation template:
+
+    https://editions-us-east-1.s3.amazonaws.com/aws/stable/Docker.tmpl
+
+    Basic usage:
+
+    > create_docker_stack name size
+
+    > ssh_stack_manager name -i path/to/keyfile.pem -u docker
+
+    Use `cloudformation.py tunnel --help` to learn how to open a tunnel to your
+    cloudformation stack to deploy a docker-compose project.
+
+    """
+    global _profiler
+
+    if profile:
+        _profiler = Profiler()
+        ctx.call_on_close(lambda: _write_profile(_profiler, profile_format, profile_file))
+
+cli.add_command(create)
+cli.add_command(delete)
+cli.add_command(status)
+cli.add_command(fleet)
+cli.add_command(wait_for_complete)
+cli.add_command(provision)
+cli.add_command(tunnel)
+cli.add_command(list_tunnels)
+cli.add_command(kill_tunnel)
+cli.add_command(docker_host)
+cli.add_command(start_docker_tunnel)
+cli.add_command(get_stack_dns)
+cli.add_command(get_stack_manager_ips)
+cli.add_command(get_stack_manager_dns)
+cli.add_command(get_stack_manager_ip)
+cli.add_command(top)
+cli.add_command(deploy)
+cli.add_command(mongo_backup)
+cli.add_command(mongo_restore)
+cli.add_command(sync_images)
+cli.add_command(bench_startup)
@@ -0,0 +1,5 @@
+# The command line tools are scripts in bin/, import them from there
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bin'))
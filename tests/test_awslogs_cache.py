@@ -0,0 +1,127 @@
+import os
+import time
+
+import awslogs
+
+
+class StubLogsClient:
+    """A CloudWatch logs client returning the events of a single stream"""
+
+    def __init__(self, events):
+        self.events = events
+        self.calls = 0
+
+    def get_log_events(self, logGroupName, logStreamName, startTime, endTime, startFromHead, nextToken=None):
+        self.calls += 1
+        if nextToken is not None:
+            # a forward token resumes from where the previous request ended
+            startTime = int(nextToken[2:])
+        events = [e for e in self.events if startTime <= e['timestamp'] < endTime]
+        return {'events': events, 'nextForwardToken': 'f/{}'.format(endTime)}
+
+
+def _events(start, count, step=1000):
+    return [{'timestamp': start + n * step, 'ingestionTime': start + n * step, 'message': 'event {}'.format(n)}
+            for n in range(count)]
+
+
+# old enough to be cached
+T0 = int(time.time() * 1000) - 24 * 60 * 60 * 1000
+
+
+def test_cached_events_are_read_from_disk(tmp_path):
+    client = StubLogsClient(_events(T0, 100))
+    cache = awslogs.LogCache(str(tmp_path))
+    events = cache.fetch_stream_events(client, 'group', 'stream', T0, T0 + 100000)
+    assert len(events) == 100
+    cache.save()
+
+    calls = client.calls
+    cache = awslogs.LogCache(str(tmp_path))
+    assert cache.covers('group', 'stream', T0, T0 + 100000)
+    assert [e['message'] for e in cache.fetch_stream_events(client, 'group', 'stream', T0 + 10000, T0 + 20000)] == \
+        ['event {}'.format(n) for n in range(10, 20)]
+    assert client.calls == calls
+
+
+def test_save_evicts_least_recently_used(tmp_path):
+    client = StubLogsClient(_events(T0, 1000))
+    cache = awslogs.LogCache(str(tmp_path))
+    cache.fetch_stream_events(client, 'group', 'old', T0, T0 + 1000000)
+    cache.fetch_stream_events(client, 'group', 'new', T0, T0 + 1000000)
+    old, new = sorted(cache.segments, key=lambda seg: seg['stream'] == 'new')
+    old['accessed'] = new['accessed'] - 60
+    cache.max_bytes = new['size'] + old['size'] // 2
+    cache.save()
+
+    assert [seg['stream'] for seg in awslogs.LogCache(str(tmp_path)).segments] == ['new']
+    assert not os.path.exists(os.path.join(str(tmp_path), 'segments', old['file']))
+    assert os.path.exists(os.path.join(str(tmp_path), 'segments', new['file']))
+
+
+def test_save_merges_segments_saved_by_another_process(tmp_path):
+    client = StubLogsClient(_events(T0, 100))
+    first = awslogs.LogCache(str(tmp_path))
+    second = awslogs.LogCache(str(tmp_path))
+    first.fetch_stream_events(client, 'group', 'a', T0, T0 + 100000)
+    second.fetch_stream_events(client, 'group', 'b', T0, T0 + 100000)
+    first.save()
+    second.save()
+
+    merged = awslogs.LogCache(str(tmp_path))
+    assert sorted(seg['stream'] for seg in merged.segments) == ['a', 'b']
+
+    # segments saved by either process are subject to eviction
+    merged.max_bytes = 0
+    merged.save()
+    assert awslogs.LogCache(str(tmp_path)).segments == []
+    assert not any(files for _, _, files in os.walk(os.path.join(str(tmp_path), 'segments')))
+
+
+def test_save_drops_segments_evicted_by_another_process(tmp_path):
+    client = StubLogsClient(_events(T0, 100))
+    first = awslogs.LogCache(str(tmp_path))
+    first.fetch_stream_events(client, 'group', 'a', T0, T0 + 100000)
+    first.save()
+
+    second = awslogs.LogCache(str(tmp_path))
+    second.max_bytes = 0
+    second.save()
+
+    first.save()
+    assert awslogs.LogCache(str(tmp_path)).segments == []
+
+
+def test_a_corrupt_segment_is_dropped_and_fetched_again(tmp_path):
+    client = StubLogsClient(_events(T0, 100))
+    cache = awslogs.LogCache(str(tmp_path))
+    cache.fetch_stream_events(client, 'group', 'stream', T0, T0 + 100000)
+    cache.save()
+    segment_path = os.path.join(str(tmp_path), 'segments', cache.segments[0]['file'])
+    with open(segment_path, 'r+b') as segment_file:
+        segment_file.truncate(os.path.getsize(segment_path) // 2)
+
+    calls = client.calls
+    cache = awslogs.LogCache(str(tmp_path))
+    events = cache.fetch_stream_events(client, 'group', 'stream', T0, T0 + 100000)
+    assert [e['message'] for e in events] == ['event {}'.format(n) for n in range(100)]
+    assert client.calls > calls
+    assert not os.path.exists(segment_path)
+
+
+def test_blocks_are_indexed_at_the_end_of_the_segment_file(tmp_path):
+    client = StubLogsClient(_events(T0, 100))
+    first = awslogs.LogCache(str(tmp_path))
+    first.fetch_stream_events(client, 'group', 'stream', T0, T0 + 50000)
+    first.save()
+
+    # another process extends the same segment
+    second = awslogs.LogCache(str(tmp_path))
+    second.fetch_stream_events(client, 'group', 'stream', T0, T0 + 100000)
+    first.fetch_stream_events(client, 'group', 'stream', T0, T0 + 100000)
+
+    segment_path = os.path.join(str(tmp_path), 'segments', first.segments[0]['file'])
+    offsets = [block[2] for cache in (first, second) for block in cache.segments[0]['blocks'][1:]]
+    assert len(set(offsets)) == 2 and max(offsets) < os.path.getsize(segment_path)
+    assert [e['message'] for e in first.fetch_stream_events(client, 'group', 'stream', T0, T0 + 100000)] == \
+        ['event {}'.format(n) for n in range(100)]
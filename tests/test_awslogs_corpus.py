@@ -0,0 +1,17 @@
+import collections
+
+import awslogs
+
+
+def test_generated_corpus_is_reproducible():
+    assert awslogs._generate_corpus(500, 3) == awslogs._generate_corpus(500, 3)
+    assert awslogs._generate_corpus(500, 3) != awslogs._generate_corpus(500, 4)
+
+
+def test_generated_corpus_decodes():
+    messages = awslogs._generate_corpus(2000, 1)
+    counts = collections.Counter()
+    decoded = list(awslogs._decode_events(({'message': message} for message in messages), counts))
+    assert counts['totalCnt'] == 2000
+    assert 0.6 < counts['bunyanCnt'] / counts['totalCnt'] < 0.9
+    assert not any('\x1b' in event['message'] for event in decoded if isinstance(event['message'], str))
@@ -0,0 +1,38 @@
+import json
+
+from click.testing import CliRunner
+
+import awslogs
+
+
+def _row(record):
+    return awslogs._export_row({'timestamp': 1618838400000, 'logStreamName': 'pfm-riffrtc/1', 'message': record})
+
+
+def test_export_row_columns():
+    row = _row({'level': 30, 'name': 'riff-rtc', 'pid': '17', 'res': {'statusCode': 200}, 'latency': 12.7,
+                'msg': 'request finished', 'time': '2021-04-19T13:20:00.000Z', 'v': 0, 'room': 'a'})
+    assert (row['level'], row['pid'], row['status_code'], row['latency']) == (30, 17, 200, 12.7)
+    assert json.loads(row['extra']) == {'room': 'a'}
+
+
+def test_export_row_keeps_values_which_are_not_whole_numbers_in_extra():
+    row = _row({'level': 30.0, 'pid': 12.7, 'res': {'statusCode': 'ok'}, 'latency': 3})
+    assert (row['level'], row['pid'], row['status_code'], row['latency']) == (30, None, None, 3.0)
+    assert json.loads(row['extra']) == {'pid': 12.7, 'res': {'statusCode': 'ok'}}
+
+
+def test_internal_value_errors_are_not_usage_errors(monkeypatch):
+    def fail(*args, **kwargs):
+        raise ValueError('an internal error')
+
+    monkeypatch.setattr(awslogs.LogQuery, 'stream_names', fail)
+    result = CliRunner().invoke(awslogs.events, ['--no-cache', '--start', '1h'])
+    assert result.exit_code != 2
+    assert isinstance(result.exception, ValueError)
+
+
+def test_insights_where_errors_are_usage_errors():
+    result = CliRunner().invoke(awslogs.events, ['--backend', 'insights', '--where', 'time < 2021-04-19T13:30'])
+    assert result.exit_code == 2
+    assert 'the time field can\'t be used with Logs Insights' in result.output
@@ -0,0 +1,77 @@
+import itertools
+
+import pytest
+
+import awslogs
+
+
+class StubFollowClient:
+    """A CloudWatch logs client whose filter_log_events returns the events ingested by each poll"""
+
+    def __init__(self, polls):
+        self.polls = iter(polls)
+        self.start_times = []
+
+    def filter_log_events(self, logGroupName, startTime, logStreamNamePrefix=None, nextToken=None, **kwargs):
+        self.start_times.append(startTime)
+        return {'events': [e for e in next(self.polls) if e['timestamp'] >= startTime]}
+
+
+def _event(event_id, timestamp, stream='pfm-riffrtc/1'):
+    return {'eventId': event_id, 'timestamp': timestamp, 'logStreamName': stream, 'message': event_id}
+
+
+@pytest.fixture(autouse=True)
+def no_sleep(monkeypatch):
+    monkeypatch.setattr(awslogs.time, 'sleep', lambda seconds: None)
+
+
+def test_follow_skips_events_seen_in_earlier_polls():
+    polls = [[_event('a', 1000), _event('b', 2000)],
+             [_event('a', 1000), _event('b', 2000), _event('c', 3000)],
+             [],
+             [_event('b', 2000), _event('c', 3000), _event('d', 2500), _event('e', 4000, 'pfm-riffrtc/2')]]
+    client = StubFollowClient(polls)
+    new_streams = []
+    followed = awslogs._follow_events(client, 'group', 1000, log_stream_prefix='pfm-riffrtc',
+                                      on_new_stream=new_streams.append)
+
+    assert [e['eventId'] for e in itertools.islice(followed, 5)] == ['a', 'b', 'c', 'd', 'e']
+    assert new_streams == ['pfm-riffrtc/1', 'pfm-riffrtc/2']
+
+
+def test_follow_polls_overlap_the_newest_event():
+    newest = 10 * awslogs.FOLLOW_OVERLAP_MS
+    late = newest - awslogs.FOLLOW_OVERLAP_MS // 2
+    polls = [[_event('a', newest)], [_event('a', newest), _event('late', late)], [_event('b', newest + 1)]]
+    client = StubFollowClient(polls)
+    followed = awslogs._follow_events(client, 'group', 0)
+
+    assert [e['eventId'] for e in itertools.islice(followed, 3)] == ['a', 'late', 'b']
+    assert client.start_times == [0, newest - awslogs.FOLLOW_OVERLAP_MS, newest - awslogs.FOLLOW_OVERLAP_MS]
+
+
+def test_follow_skips_events_before_since():
+    client = StubFollowClient([[_event('a', 500), _event('b', 1500)]])
+    # a stream's events may be returned from before the startTime asked for
+    client.filter_log_events = lambda **kwargs: {'events': [_event('a', 500), _event('b', 1500)]}
+    followed = awslogs._follow_events(client, 'group', 1000)
+    assert next(followed)['eventId'] == 'b'
+
+
+def test_follow_polls_named_streams_in_chunks():
+    names = ['pfm-riffrtc/{}'.format(n) for n in range(250)]
+    requested = []
+
+    def filter_log_events(logStreamNames, startTime, **kwargs):
+        assert len(logStreamNames) <= awslogs.MAX_FILTER_STREAMS
+        requested.append(logStreamNames)
+        return {'events': [_event('e{}'.format(len(requested)), 1000 + len(requested), logStreamNames[-1])]}
+
+    client = StubFollowClient([])
+    client.filter_log_events = filter_log_events
+    followed = awslogs._follow_events(client, 'group', 1000, log_stream_names=names)
+
+    assert [e['logStreamName'] for e in itertools.islice(followed, 3)] == \
+        ['pfm-riffrtc/99', 'pfm-riffrtc/199', 'pfm-riffrtc/249']
+    assert [name for chunk in requested for name in chunk] == names
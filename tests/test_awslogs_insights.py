@@ -0,0 +1,77 @@
+from datetime import datetime, timezone
+
+import pytest
+
+import awslogs
+
+
+class StubInsightsClient:
+    """A CloudWatch logs client answering Logs Insights queries from a list of events"""
+
+    def __init__(self, events):
+        self.events = events
+        self.queries = {}
+
+    def start_query(self, logGroupName, startTime, endTime, queryString, limit):
+        query_id = str(len(self.queries))
+        rows = [e for e in self.events if startTime * 1000 <= e['timestamp'] < endTime * 1000][:limit]
+        self.queries[query_id] = (queryString, rows)
+        return {'queryId': query_id}
+
+    def get_query_results(self, queryId):
+        rows = self.queries[queryId][1]
+        return {'status': 'Complete',
+                'results': [[{'field': '@timestamp',
+                              'value': datetime.fromtimestamp(e['timestamp'] / 1000, timezone.utc).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]},
+                             {'field': '@message', 'value': e['message']},
+                             {'field': '@logStream', 'value': 'pfm-riffrtc/1'}]
+                            for e in rows]}
+
+
+@pytest.fixture(autouse=True)
+def no_sleep(monkeypatch):
+    monkeypatch.setattr(awslogs.time, 'sleep', lambda seconds: None)
+
+
+def test_where_insights_filter():
+    tree = awslogs._parse_where('level >= warn and (res.statusCode = 500 or name ~ "^riff/") and not route != x')
+    assert awslogs._where_insights_filter(tree) == \
+        '((level >= 40 and (res.statusCode = 500 or name like /^riff\\//)) and not route != "x")'
+
+
+def test_where_insights_filter_rejects_time():
+    with pytest.raises(ValueError):
+        awslogs._where_insights_filter(awslogs._parse_where('time < 2021-04-19T13:30'))
+
+
+def test_insights_events_split_full_slices(monkeypatch):
+    monkeypatch.setattr(awslogs, 'INSIGHTS_MAX_ROWS', 10)
+    start = 1618838400000
+    events = [{'timestamp': start + n * 250, 'message': 'event {}'.format(n)} for n in range(100)]
+    client = StubInsightsClient(events)
+
+    found = list(awslogs._insights_events(client, 'group', 'pfm-riffrtc', None, None, start, start + 25000))
+    assert [e['message'] for e in found] == [e['message'] for e in events]
+    assert all('filter @logStream like /^pfm\\-riffrtc/' in query for query, _ in client.queries.values())
+
+
+class FullInsightsClient(StubInsightsClient):
+    """A Logs Insights client whose every query returns the maximum number of rows"""
+
+    def start_query(self, logGroupName, startTime, endTime, queryString, limit):
+        query_id = str(len(self.queries))
+        rows = [{'timestamp': startTime * 1000, 'message': 'event'}] * limit
+        self.queries[query_id] = (queryString, rows)
+        return {'queryId': query_id}
+
+
+@pytest.mark.parametrize('width', [1000, 1500, 1999, 2000, 7300])
+def test_insights_slices_always_at_the_maximum_stop_splitting(monkeypatch, capsys, width):
+    monkeypatch.setattr(awslogs, 'INSIGHTS_MAX_ROWS', 3)
+    start = 1618838400000
+    client = FullInsightsClient([])
+
+    events = awslogs._insights_slice_events(client, 'group', 'fields @message', start, start + width)
+    assert len(client.queries) == 1 + 2 * (len(client.queries) // 2)
+    assert len(events) == 3 * (len(client.queries) + 1) // 2
+    assert 'only 3 of them are included' in capsys.readouterr().err
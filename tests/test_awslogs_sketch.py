@@ -0,0 +1,53 @@
+import random
+
+import pytest
+
+import awslogs
+
+
+def _true_quantile(values, q):
+    return sorted(values)[int(q * (len(values) - 1))]
+
+
+@pytest.mark.parametrize('relative_accuracy', [0.01, 0.05])
+@pytest.mark.parametrize('distribution', ['lognormal', 'uniform', 'pareto'])
+def test_quantiles_are_within_the_relative_accuracy(distribution, relative_accuracy):
+    rng = random.Random(7)
+    generate = {'lognormal': lambda: rng.lognormvariate(3, 1.5),
+                'uniform': lambda: rng.uniform(0.5, 5000),
+                'pareto': lambda: rng.paretovariate(1.2)}[distribution]
+    values = [generate() for _ in range(20000)]
+    sketch = awslogs.LatencySketch(relative_accuracy)
+    for value in values:
+        sketch.add(value)
+
+    for q in (0, 0.01, 0.25, 0.5, 0.9, 0.95, 0.99, 0.999, 1):
+        expected = _true_quantile(values, q)
+        assert abs(sketch.quantile(q) - expected) <= relative_accuracy * expected * (1 + 1e-9), q
+
+
+def test_merged_sketches_equal_a_sketch_of_all_values():
+    rng = random.Random(11)
+    values = [rng.expovariate(1 / 200) for _ in range(5000)]
+    whole = awslogs.LatencySketch()
+    parts = [awslogs.LatencySketch() for _ in range(4)]
+    for n, value in enumerate(values):
+        whole.add(value)
+        parts[n % 4].add(value)
+    merged = awslogs.LatencySketch()
+    for part in parts:
+        merged.merge(part)
+
+    assert merged.count == whole.count
+    assert merged.max == whole.max
+    for q in (0.5, 0.9, 0.99):
+        assert merged.quantile(q) == whole.quantile(q)
+
+
+def test_zero_and_empty_sketches():
+    sketch = awslogs.LatencySketch()
+    assert sketch.quantile(0.5) is None
+    for value in (0, 0, 0, 10):
+        sketch.add(value)
+    assert sketch.quantile(0.5) == 0
+    assert sketch.quantile(1) == pytest.approx(10, rel=0.01)
@@ -0,0 +1,46 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import awslogs
+
+
+class StubStreamsClient:
+    """A CloudWatch logs client whose log group gets a new stream each time its streams are described"""
+
+    def __init__(self):
+        self.describes = 0
+        self.lock = threading.Lock()
+
+    def describe_log_streams(self, logGroupName, logStreamNamePrefix):
+        with self.lock:
+            self.describes += 1
+            count = self.describes
+        time.sleep(0.01)
+        return {'logStreams': [{'logStreamName': '{}/{}'.format(logStreamNamePrefix, n),
+                                'firstEventTimestamp': 1000, 'lastEventTimestamp': 2000}
+                               for n in range(count)]}
+
+
+def test_streams_are_described_again_for_windows_ending_after_they_were(tmp_path):
+    client = StubStreamsClient()
+    index = awslogs.StreamIndex(str(tmp_path))
+    described = int(time.time() * 1000)
+    assert len(index.streams(client, 'group', 'pfm-riffrtc', described - 60000)) == 1
+    assert len(index.streams(client, 'group', 'pfm-riffrtc', described - 60000)) == 1
+    assert len(index.streams(client, 'group', 'pfm-riffrtc', described + 60000)) == 2
+    assert len(index.streams(client, 'group', 'pfm-riffrtc')) == 3
+    assert client.describes == 3
+
+
+def test_streams_can_be_looked_up_by_several_threads(tmp_path):
+    client = StubStreamsClient()
+    index = awslogs.StreamIndex(str(tmp_path))
+    past = int(time.time() * 1000) - 60000
+    prefixes = ['pfm-riffrtc', 'pfm-web', 'pfm-signalmaster', 'pfm-riffdata'] * 4
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lambda prefix: index.streams(client, 'group', prefix, past), prefixes))
+
+    assert client.describes == 4
+    assert all(results[n] == results[n % 4] for n in range(len(prefixes)))
+    assert sorted(awslogs.StreamIndex(str(tmp_path)).entries) == sorted('group/' + prefix for prefix in set(prefixes))
@@ -0,0 +1,102 @@
+import json
+import re
+
+import pytest
+
+import awslogs
+
+
+RECORDS = [
+    {'level': 30, 'name': 'riffdata', 'res': {'statusCode': 200}, 'latency': 12, 'status': 500},
+    {'level': 50, 'name': 'riffrtc', 'res': {'statusCode': 503}, 'latency': 900.5, 'status': '500'},
+    {'level': 40, 'name': 'spa', 'res': {'statusCode': 404}, 'code': 500, 'a': 1.5},
+    {'level': 20, 'name': '500', 'code': '500', 'a': '1.5', 'status': 'ok'},
+    {'level': 30, 'route_handler': 'spaIndex', 'res': {'statusCode': 500}},
+    {'name': 'no level'},
+    {'level': 40, 'response-time': 250.5},
+]
+
+EXPRESSIONS = [
+    'level >= warn',
+    'level = 30 and name = riffdata',
+    'res.statusCode >= 500 or level >= error',
+    'status = 500',
+    'code = "500"',
+    'name = 500',
+    'a = 1.5',
+    'latency > 100',
+    'not name = spa',
+    'name ~ "^riff" and level < 40',
+    'route_handler = spaIndex and (res.statusCode >= 500 or level >= warn)',
+    'status != 500',
+    'response-time > 100',
+    'response-time > 100 and level >= warn',
+]
+
+
+def _cloudwatch_match(pattern, record):
+    """Evaluate a JSON filter pattern the way CloudWatch does: numbers only equal numbers, strings strings"""
+    expression = pattern.strip()[1:-1]
+
+    def comparison(match):
+        field, op, literal = match.groups()
+        value = record
+        for key in field.split('.'):
+            value = value.get(key) if isinstance(value, dict) else None
+        literal = json.loads(literal)
+        if isinstance(literal, str):
+            ok = isinstance(value, str) and {'=': value == literal, '!=': value != literal}[op]
+        else:
+            ok = isinstance(value, (int, float)) and not isinstance(value, bool) and {
+                '=': value == literal, '!=': value != literal, '<': value < literal, '<=': value <= literal,
+                '>': value > literal, '>=': value >= literal}[op]
+        return ' {} '.format(ok)
+
+    expression = re.sub(r'\(\$\.([\w.]+) (=|!=|<=|>=|<|>) ("[^"]*"|[-\d.]+)\)', comparison, expression)
+    return eval(expression.replace('&&', 'and').replace('||', 'or'))
+
+
+def test_parse_where_precedence():
+    tree = awslogs._parse_where('a = 1 or b = x and not c != "y z"')
+    assert tree == ('or', ('cmp', 'a', '=', 1),
+                    ('and', ('cmp', 'b', '=', 'x'), ('not', ('cmp', 'c', '!=', 'y z'))))
+
+
+@pytest.mark.parametrize('expression', ['a =', 'a = 1 and', '(a = 1', 'a = 1)', 'a ? 1', '= 1'])
+def test_parse_where_errors(expression):
+    with pytest.raises(ValueError):
+        awslogs._parse_where(expression)
+
+
+def test_compile_where():
+    matches = awslogs._compile_where(awslogs._parse_where('level >= warn and res.statusCode != 404'))
+    assert [matches(record) for record in RECORDS] == [False, True, False, False, False, False, False]
+    assert not matches('a text message')
+
+
+def test_compile_where_numbers_match_numeric_strings():
+    matches = awslogs._compile_where(awslogs._parse_where('status = 500'))
+    assert [matches(record) for record in RECORDS] == [True, True, False, False, False, False, False]
+
+
+@pytest.mark.parametrize('expression', EXPRESSIONS)
+def test_filter_pattern_selects_a_superset(expression):
+    tree = awslogs._parse_where(expression)
+    matches = awslogs._compile_where(tree)
+    pattern = awslogs._where_filter_pattern(tree)
+    for record in RECORDS:
+        if matches(record):
+            assert pattern is None or _cloudwatch_match(pattern, record), (pattern, record)
+
+
+def test_filter_pattern_pushes_down_known_numeric_fields():
+    assert awslogs._where_filter_pattern(awslogs._parse_where('level >= warn')) == '{ ($.level >= 40) }'
+    assert awslogs._where_filter_pattern(awslogs._parse_where('status = 500')) == \
+        '{ (($.status = 500) || ($.status = "500")) }'
+    assert awslogs._where_filter_pattern(awslogs._parse_where('status > 500')) is None
+
+
+def test_filter_pattern_only_pushes_down_identifier_fields():
+    assert awslogs._where_filter_pattern(awslogs._parse_where('response-time > 100')) is None
+    assert awslogs._where_filter_pattern(awslogs._parse_where('response-time > 100 and res.responseTime > 100')) == \
+        '{ ($.res.responseTime > 100) }'
@@ -0,0 +1,84 @@
+import io
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import docker_swarm
+
+
+class StubS3:
+    """An S3 client holding one object, whose upload of a part may fail"""
+
+    def __init__(self, data=b'', fail_part=None):
+        self.data = data
+        self.fail_part = fail_part
+        self.parts = {}
+        self.completed = None
+        self.aborted = False
+        self.lock = threading.Lock()
+
+    def create_multipart_upload(self, Bucket, Key):
+        return {'UploadId': 'upload-1'}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        time.sleep(0.001)
+        if PartNumber == self.fail_part:
+            raise IOError('part {} failed'.format(PartNumber))
+        with self.lock:
+            self.parts[PartNumber] = Body
+        return {'ETag': '"{}"'.format(PartNumber)}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self.completed = b''.join(self.parts[part['PartNumber']] for part in MultipartUpload['Parts'])
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.aborted = True
+
+    def get_object(self, Bucket, Key, Range):
+        start, end = map(int, Range[len('bytes='):].split('-'))
+        return {'Body': io.BytesIO(self.data[start:end + 1])}
+
+
+def test_upload_counts_every_part():
+    s3 = StubS3()
+    stats = docker_swarm.TransferStats()
+    data = bytes(range(256)) * 400
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        upload = docker_swarm.MultipartUpload(s3, 'bucket', 'key', 1000, 8, executor, stats)
+        for n in range(0, len(data), 333):
+            upload.write(data[n:n + 333])
+        upload.complete()
+
+    assert s3.completed == data
+    assert stats.compressed_bytes == len(data)
+    assert stats.buffered == 0 and stats.peak_buffered <= 9 * 1000 + 333
+
+
+def test_a_failed_part_fails_the_upload_while_writing():
+    s3 = StubS3(fail_part=2)
+    stats = docker_swarm.TransferStats()
+    written = 0
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        upload = docker_swarm.MultipartUpload(s3, 'bucket', 'key', 100, 2, executor, stats)
+        with pytest.raises(IOError, match='part 2 failed'):
+            for _ in range(1000):
+                upload.write(b'x' * 100)
+                written += 1
+        upload.abort()
+
+    assert written < 10
+    assert s3.aborted and s3.completed is None
+
+
+def test_range_reader_reads_the_object_in_order():
+    data = bytes(range(256)) * 100
+    s3 = StubS3(data)
+    stats = docker_swarm.TransferStats()
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        reader = docker_swarm.RangeReader(s3, 'bucket', 'key', len(data), 1000, 4, executor, stats)
+        read = b''.join(iter(lambda: reader.read(777), b''))
+
+    assert read == data
+    assert stats.compressed_bytes == len(data) and stats.buffered == 0
@@ -0,0 +1,134 @@
+import pytest
+
+import docker_swarm
+
+
+class StubServiceApi:
+    """A docker engine api with a single service whose spec and tasks a test changes"""
+
+    def __init__(self, version=2, replicas=2, update_state='completed'):
+        self.service = {'Spec': {'Mode': {'Replicated': {'Replicas': replicas}}}, 'Version': {'Index': version},
+                        'UpdateStatus': {'State': update_state}}
+        self.tasks = []
+
+    def add_task(self, task_id, state, desired='running', err=None):
+        self.tasks.append({'ID': task_id, 'DesiredState': desired, 'Status': {'State': state, 'Err': err}})
+
+    def get(self, path, params=None):
+        if path == '/tasks':
+            return self.tasks
+        return self.service
+
+
+def test_rollout_converges_once_the_desired_tasks_run():
+    api = StubServiceApi(update_state='updating')
+    api.add_task('old', 'shutdown', desired='shutdown')
+    api.add_task('new1', 'running')
+    api.add_task('new2', 'starting')
+    rollout = docker_swarm.ServiceRollout('pfm-stk_pfm-web', 1, {'old'})
+    assert rollout.check(api, now=rollout.started + 1) == []
+    assert not rollout.done
+
+    api.service['UpdateStatus']['State'] = 'completed'
+    api.tasks[2]['Status']['State'] = 'running'
+    rollout.check(api, now=rollout.started + 5)
+    assert rollout.result == 'converged'
+    assert rollout.elapsed() == pytest.approx(5)
+
+
+def test_rollout_waits_for_swarm_to_start_updating_a_changed_service():
+    # right after the deploy the service's spec has changed but swarm still
+    # reports its previous update as completed with the old tasks running
+    api = StubServiceApi(replicas=1)
+    api.service['Spec']['TaskTemplate'] = {'ContainerSpec': {'Image': 'pfm-web:2'}}
+    api.service['PreviousSpec'] = {'TaskTemplate': {'ContainerSpec': {'Image': 'pfm-web:1'}}}
+    api.add_task('old', 'running')
+    rollout = docker_swarm.ServiceRollout('pfm-stk_pfm-web', 1, {'old'})
+    rollout.check(api)
+    assert not rollout.done
+
+    api.tasks[0].update(DesiredState='shutdown')
+    api.add_task('new', 'running')
+    rollout.check(api)
+    assert rollout.result == 'converged'
+
+
+def test_rollout_of_a_spec_change_which_keeps_the_tasks():
+    api = StubServiceApi(replicas=1)
+    api.service['Spec']['TaskTemplate'] = {'ContainerSpec': {'Image': 'pfm-web:1'}}
+    api.service['PreviousSpec'] = {'TaskTemplate': {'ContainerSpec': {'Image': 'pfm-web:1'}}}
+    api.add_task('old', 'running')
+    rollout = docker_swarm.ServiceRollout('pfm-stk_pfm-web', 1, {'old'})
+    rollout.check(api)
+    assert rollout.result == 'converged'
+
+
+def test_rollout_of_an_unchanged_service():
+    api = StubServiceApi(version=1, replicas=1)
+    api.add_task('t1', 'running')
+    rollout = docker_swarm.ServiceRollout('pfm-stk_pfm-web', 1, {'t1'})
+    rollout.check(api)
+    assert rollout.result == 'unchanged'
+
+
+def test_rollout_fails_after_too_many_new_task_failures():
+    api = StubServiceApi(update_state='updating')
+    api.add_task('old-failure', 'failed', desired='shutdown', err='from an earlier deploy')
+    rollout = docker_swarm.ServiceRollout('pfm-stk_pfm-web', 1, {'old-failure'})
+    messages = []
+    for n in range(docker_swarm.DEPLOY_MAX_TASK_FAILURES):
+        api.add_task('new{}'.format(n), 'failed', desired='shutdown', err='exit 1')
+        messages.extend(rollout.check(api))
+
+    assert rollout.result == 'failed'
+    assert rollout.failed_tasks == ['new{}'.format(n) for n in range(docker_swarm.DEPLOY_MAX_TASK_FAILURES)]
+    assert messages[0] == 'task new0 failed: exit 1'
+    assert messages[-1] == '{} new tasks have failed'.format(docker_swarm.DEPLOY_MAX_TASK_FAILURES)
+
+
+def test_rollout_fails_when_the_update_is_rolled_back():
+    api = StubServiceApi(update_state='rollback_started')
+    api.service['UpdateStatus']['Message'] = 'update rolled back due to failure'
+    rollout = docker_swarm.ServiceRollout('pfm-stk_pfm-web', 1, set())
+    assert rollout.check(api) == ['update rollback_started: update rolled back due to failure']
+    assert rollout.result == 'failed'
+
+
+def test_rollout_is_reported_stuck_once():
+    api = StubServiceApi(update_state='updating')
+    api.add_task('new1', 'pending', err='no suitable node')
+    rollout = docker_swarm.ServiceRollout('pfm-stk_pfm-web', 1, set(), stuck_after=60)
+    assert rollout.check(api, now=rollout.started + 1) == []
+    messages = rollout.check(api, now=rollout.started + 61)
+    assert messages == ['stuck for 60s with 0/2 tasks running, waiting on: pending (no suitable node)']
+    assert rollout.stuck and not rollout.done
+    assert rollout.check(api, now=rollout.started + 120) == []
+
+
+@pytest.mark.parametrize('failing, result', [('pfm-riffrtc', 'failed'), ('pfm-web', 'timed out')])
+def test_deploy_tier_skips_the_services_after_a_failure(monkeypatch, tmp_path, failing, result):
+    deployed = []
+
+    def stack_deploy(stack, compose_files, port):
+        deployed.append(compose_files[0])
+        return not compose_files[0].endswith('pfm-riffrtc.json')
+
+    def follow_rollouts(api, events, rollouts, timeout):
+        for rollout in rollouts:
+            rollout.finish('timed out' if rollout.name.endswith(failing) else 'converged', rollout.started + 1)
+
+    monkeypatch.setattr(docker_swarm, '_stack_deploy', stack_deploy)
+    monkeypatch.setattr(docker_swarm, '_follow_rollouts', follow_rollouts)
+    services = ['pfm-web', 'pfm-riffrtc', 'pfm-signalmaster', 'pfm-redis']
+    config = {'version': '3.7', 'services': {name: {'image': name} for name in services}}
+    if failing == 'pfm-web':
+        services = ['pfm-web', 'pfm-signalmaster', 'pfm-redis']
+
+    rollouts = docker_swarm._deploy_tier(None, None, 'pfm-stk', config, services, 2374, {}, set(), 60, 30, str(tmp_path))
+
+    results = [(rollout.name, rollout.result) for rollout in rollouts]
+    failed_at = services.index(failing)
+    assert results == ([('pfm-stk_' + name, 'converged') for name in services[:failed_at]]
+                       + [('pfm-stk_' + failing, result)]
+                       + [('pfm-stk_' + name, 'skipped') for name in services[failed_at + 1:]])
+    assert len(deployed) == failed_at + 1
@@ -0,0 +1,108 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import docker_swarm
+
+
+class StubAwsClients:
+    """The cloudformation, autoscaling and ec2 clients of a stack whose manager's ip changes on each lookup"""
+
+    def __init__(self, ips):
+        self.ips = iter(ips)
+        self.calls = []
+
+    def __call__(self, service, region, endpoint_url=None):
+        return self
+
+    def describe_stack_resource(self, StackName, LogicalResourceId):
+        self.calls.append('describe_stack_resource')
+        return {'StackResourceDetail': {'PhysicalResourceId': '{}-ManagerAsg'.format(StackName)}}
+
+    def describe_auto_scaling_groups(self, AutoScalingGroupNames):
+        self.calls.append('describe_auto_scaling_groups')
+        return {'AutoScalingGroups': [{'Instances': [{'InstanceId': 'i-1', 'LifecycleState': 'InService'}]}]}
+
+    def describe_instances(self, InstanceIds):
+        self.calls.append('describe_instances')
+        return {'Reservations': [{'Instances': [{'InstanceId': 'i-1', 'PublicIpAddress': next(self.ips),
+                                                 'PublicDnsName': 'ec2.example.com'}]}]}
+
+
+@pytest.fixture
+def aws(monkeypatch):
+    clients = StubAwsClients(['10.0.0.1', '10.0.0.2'])
+    monkeypatch.setattr(docker_swarm, '_get_client', clients)
+    monkeypatch.setattr(docker_swarm, '_aws_responses', {})
+    return clients
+
+
+def test_lookups_reuse_the_commands_responses(aws, tmp_path):
+    inventory = docker_swarm.StackInventory(cache_dir=str(tmp_path))
+    assert inventory.manager_instances('stk', 'us-east-2')[0]['ip'] == '10.0.0.1'
+    inventory.invalidate('stk', 'us-east-2')
+    assert inventory.manager_instances('stk', 'us-east-2')[0]['ip'] == '10.0.0.1'
+    assert len(aws.calls) == 3
+
+
+def test_refresh_makes_the_requests_again(aws, tmp_path):
+    inventory = docker_swarm.StackInventory(cache_dir=str(tmp_path))
+    assert inventory.manager_instances('stk', 'us-east-2')[0]['ip'] == '10.0.0.1'
+    assert inventory.manager_instances('stk', 'us-east-2', refresh=True)[0]['ip'] == '10.0.0.2'
+    assert len(aws.calls) == 6
+
+    # the refreshed responses are the ones reused
+    assert docker_swarm.StackInventory(cache_dir=str(tmp_path), ttl=0).manager_instances('stk', 'us-east-2')[0]['ip'] == '10.0.0.2'
+    assert len(aws.calls) == 6
+
+
+def test_inventories_keep_each_others_entries(aws, tmp_path):
+    # e.g. the threads of provision, each looking up its own stack
+    first = docker_swarm.StackInventory(cache_dir=str(tmp_path))
+    second = docker_swarm.StackInventory(cache_dir=str(tmp_path))
+    first.manager_instances('stk1', 'us-east-2')
+    second.manager_instances('stk2', 'us-east-2')
+    first.set_manager_ranking('stk1', 'us-east-2', ['10.0.0.1'])
+    calls = len(aws.calls)
+
+    inventory = docker_swarm.StackInventory(cache_dir=str(tmp_path))
+    assert set(inventory.entries) == {'us-east-2/stk1', 'us-east-2/stk2'}
+    assert inventory.manager_ranking('stk1', 'us-east-2') == ['10.0.0.1']
+    inventory.manager_instances('stk2', 'us-east-2')
+    assert len(aws.calls) == calls
+
+
+def test_provisioned_stacks_connect_their_tunnels_concurrently(tmp_path, monkeypatch):
+    registry_class = docker_swarm.TunnelRegistry
+    monkeypatch.setattr(docker_swarm, 'TunnelRegistry', lambda: registry_class(cache_dir=str(tmp_path)))
+    monkeypatch.setattr(docker_swarm, '_create_swarm_stack', lambda *args: None)
+    monkeypatch.setattr(docker_swarm, '_wait_for_stack_operation', lambda *args: 'CREATE_COMPLETE')
+    monkeypatch.setattr(docker_swarm, '_describe_stack', lambda *args, **kwargs: {})
+    monkeypatch.setattr(docker_swarm, '_get_stack_output', lambda *args: 'dns.example.com')
+    monkeypatch.setattr(docker_swarm, '_get_stack_manager_instances',
+                        lambda stack_name, region, refresh=False: [{'id': 'i-1', 'ip': stack_name, 'dns': ''}])
+    monkeypatch.setattr(docker_swarm, '_is_port_in_use', lambda port: False)
+
+    # each stack's ssh connection only completes once the other stack is connecting too
+    connecting = threading.Barrier(2, timeout=5)
+
+    def open_tunnel(remote_ip, key_name, port, name, accept_new_host_key=False):
+        connecting.wait()
+        return os.getpid()
+
+    monkeypatch.setattr(docker_swarm, '_open_tunnel', open_tunnel)
+
+    specs = [{'name': name, 'region': 'us-east-2', 'key': 'key', 'key_file': None, 'manager_count': 1,
+              'manager_type': 't2.micro', 'worker_count': 0, 'worker_type': 't2.micro', 'tunnel': True}
+             for name in ('stk1', 'stk2')]
+    tunnel_lock = threading.Lock()
+    reserved_ports = set()
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        results = list(executor.map(lambda spec: docker_swarm._provision_stack(spec, tunnel_lock, reserved_ports), specs))
+
+    assert all('error' not in result for result in results)
+    assert len({result['docker_host'] for result in results}) == 2
+    assert sorted(tunnel['name'] for tunnel in registry_class(cache_dir=str(tmp_path)).tunnels()) == ['stk1', 'stk2']
+    assert not reserved_ports
@@ -0,0 +1,21 @@
+import os
+import subprocess
+import sys
+
+BIN_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bin')
+
+
+def test_local_only_commands_do_not_import_aws():
+    code = ('import sys; sys.argv = ["docker-swarm.py", "list-tunnels"]; import docker_swarm\n'
+            'try:\n    docker_swarm.cli(obj={})\nexcept SystemExit:\n    pass\n'
+            'assert "boto3" not in sys.modules and "botocore" not in sys.modules')
+    result = subprocess.run([sys.executable, '-c', code], cwd=BIN_DIR, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    assert result.returncode == 0, result.stderr
+
+
+def test_script_runs_the_module_commands():
+    result = subprocess.run([sys.executable, os.path.join(BIN_DIR, 'docker-swarm.py'), '--help'],
+                            stdout=subprocess.PIPE, universal_newlines=True)
+    assert result.returncode == 0
+    assert 'sync-images' in result.stdout and 'bench-startup' in result.stdout
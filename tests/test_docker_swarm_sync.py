@@ -0,0 +1,226 @@
+import hashlib
+import io
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import docker_swarm
+
+MANIFEST_TYPE = 'application/vnd.docker.distribution.manifest.v2+json'
+INDEX_TYPE = 'application/vnd.docker.distribution.manifest.list.v2+json'
+
+
+def _blob(content):
+    return {'digest': 'sha256:' + hashlib.sha256(content).hexdigest(), 'size': len(content)}
+
+
+class FakeRegistry:
+    """An in memory registry with the methods of RegistryClient used by ImageSync"""
+
+    def __init__(self, host):
+        self.host = host
+        self.blobs = {}
+        self.manifests = {}
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def add_image(self, repo, tag, layers, media_type=MANIFEST_TYPE):
+        config = json.dumps({'layers': layers}).encode()
+        blobs = [config] + [layer.encode() for layer in layers]
+        for content in blobs:
+            self.blobs[(repo, _blob(content)['digest'])] = content
+        manifest = {'mediaType': media_type, 'config': _blob(config), 'layers': [_blob(b) for b in blobs[1:]]}
+        self.manifests[(repo, tag)] = (manifest, media_type, json.dumps(manifest).encode())
+        return manifest
+
+    def _log(self, *request):
+        with self._lock:
+            self.requests.append(request)
+
+    def get_manifest(self, repo, reference):
+        self._log('get_manifest', repo, reference)
+        return self.manifests[(repo, reference)]
+
+    def put_manifest(self, repo, tag, media_type, raw):
+        self._log('put_manifest', repo, tag)
+        manifest = json.loads(raw)
+        assert all((repo, blob['digest']) in self.blobs for blob in [manifest['config']] + manifest['layers'])
+        self.manifests[(repo, tag)] = (manifest, media_type, raw)
+
+    def has_blob(self, repo, digest):
+        return (repo, digest) in self.blobs
+
+    def get_blob(self, repo, digest):
+        self._log('get_blob', repo, digest)
+        return io.BytesIO(self.blobs[(repo, digest)])
+
+    def mount_blob(self, repo, digest, from_repo):
+        self._log('mount_blob', repo, digest)
+        if (from_repo, digest) not in self.blobs:
+            return False
+        self.blobs[(repo, digest)] = self.blobs[(from_repo, digest)]
+        return True
+
+    def put_blob(self, repo, digest, stream, size):
+        self._log('put_blob', repo, digest)
+        content = stream.read()
+        assert len(content) == size and 'sha256:' + hashlib.sha256(content).hexdigest() == digest
+        self.blobs[(repo, digest)] = content
+
+
+@pytest.fixture
+def registries():
+    source = FakeRegistry('ghcr.io')
+    source.add_image('rifflearning/riff-docker/riffrtc', '2.0', ['base layer', 'node modules', 'riffrtc app'])
+    source.add_image('rifflearning/riff-docker/pfm-web', '2.0', ['base layer', 'nginx', 'pfm-web app'])
+    return source, FakeRegistry('localhost:41234')
+
+
+def _sync(source, dest, images, platform=docker_swarm.SWARM_PLATFORM):
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        image_sync = docker_swarm.ImageSync(dest, executor, platform, 'localhost:5000')
+        image_sync._sources[source.host] = source
+        return image_sync, image_sync.sync(images)
+
+
+IMAGES = ['ghcr.io/rifflearning/riff-docker/riffrtc:2.0', 'ghcr.io/rifflearning/riff-docker/pfm-web:2.0']
+
+
+def test_shared_blobs_are_transferred_once_and_mounted(registries):
+    source, dest = registries
+    image_sync, results = _sync(source, dest, IMAGES)
+
+    assert [(r['name'], r['blobs'], r.get('transferred', 0), r.get('mounted', 0)) for r in results] == [
+        ('localhost:5000/rifflearning/riff-docker/riffrtc:2.0', 4, 4, 0),
+        ('localhost:5000/rifflearning/riff-docker/pfm-web:2.0', 4, 3, 1)]
+    base = _blob(b'base layer')['digest']
+    assert sum(1 for request in dest.requests if request[0] == 'put_blob' and request[2] == base) == 1
+    assert image_sync.stats.raw_bytes == sum(len(content) for content in source.blobs.values()) - len(b'base layer')
+    assert ('rifflearning/riff-docker/pfm-web', '2.0') in dest.manifests
+
+
+def test_blobs_the_registry_has_are_skipped(registries):
+    source, dest = registries
+    _sync(source, dest, IMAGES)
+    source.add_image('rifflearning/riff-docker/riffrtc', '2.1', ['base layer', 'node modules', 'riffrtc app 2.1'])
+    dest.requests = []
+
+    image_sync, results = _sync(source, dest, IMAGES + ['ghcr.io/rifflearning/riff-docker/riffrtc:2.1'])
+    assert [(r.get('present', 0), r.get('transferred', 0)) for r in results] == [(4, 0), (4, 0), (2, 2)]
+    assert image_sync.stats.raw_bytes == len(source.blobs[('rifflearning/riff-docker/riffrtc',
+                                                           _blob(b'riffrtc app 2.1')['digest'])]) + \
+        len(json.dumps({'layers': ['base layer', 'node modules', 'riffrtc app 2.1']}).encode())
+    assert not any(request[0] == 'mount_blob' for request in dest.requests)
+
+
+def test_the_platforms_image_of_an_index_is_copied(registries):
+    source, dest = registries
+    amd64 = source.add_image('library/redis', 'sha256:amd64', ['redis amd64'])
+    source.add_image('library/redis', 'sha256:arm64', ['redis arm64'])
+    index = {'mediaType': INDEX_TYPE,
+             'manifests': [{'digest': 'sha256:arm64', 'platform': {'os': 'linux', 'architecture': 'arm64'}},
+                           {'digest': 'sha256:amd64', 'platform': {'os': 'linux', 'architecture': 'amd64'}}]}
+    source.manifests[('library/redis', '6')] = (index, INDEX_TYPE, json.dumps(index).encode())
+    source.host = docker_swarm.DOCKER_HUB_REGISTRY
+
+    _, results = _sync(source, dest, ['redis:6'], platform='linux/amd64')
+    assert results[0]['name'] == 'localhost:5000/redis:6'
+    assert dest.manifests[('redis', '6')][0] == amd64
+
+    with pytest.raises(docker_swarm.RegistryError, match='has no linux/s390x image'):
+        _sync(source, dest, ['redis:6'], platform='linux/s390x')
+
+
+@pytest.mark.parametrize('image, parsed', [
+    ('ghcr.io/rifflearning/riff-docker/riffrtc:2.0', ('ghcr.io', 'rifflearning/riff-docker/riffrtc', '2.0',
+                                                      'rifflearning/riff-docker/riffrtc')),
+    ('node:16', (docker_swarm.DOCKER_HUB_REGISTRY, 'library/node', '16', 'node')),
+    ('bitnami/redis', (docker_swarm.DOCKER_HUB_REGISTRY, 'bitnami/redis', 'latest', 'bitnami/redis')),
+    ('localhost:5000/riffrtc', ('localhost:5000', 'riffrtc', 'latest', 'riffrtc')),
+])
+def test_parse_image(image, parsed):
+    assert docker_swarm._parse_image(image) == parsed
+
+
+class StubTunnelRegistry:
+    tunnel = None
+
+    def find(self, name):
+        return self.tunnel
+
+    def tunnels(self):
+        return [self.tunnel]
+
+
+class StubImageSync:
+    def __init__(self, dest, executor, platform, dest_name):
+        self.stats = docker_swarm.TransferStats()
+
+    def sync(self, images):
+        return []
+
+
+@pytest.mark.parametrize('remote', ['docker@18.191.218.147', None])
+def test_sync_images_forwards_over_the_tunnels_master_connection(monkeypatch, remote):
+    from click.testing import CliRunner
+
+    StubTunnelRegistry.tunnel = {'name': 'stagingswarm', 'port': 2375, 'ip': '18.191.218.147', 'remote': remote}
+    ssh_cmds = []
+    monkeypatch.setattr(docker_swarm, 'TunnelRegistry', StubTunnelRegistry)
+    monkeypatch.setattr(docker_swarm, 'ImageSync', StubImageSync)
+    monkeypatch.setattr(docker_swarm, '_registry_credentials', lambda host: None)
+    monkeypatch.setattr(docker_swarm, '_run', lambda cmd, **kwargs: ssh_cmds.append(cmd) or
+                        type('Completed', (), {'returncode': 0})())
+
+    result = CliRunner().invoke(docker_swarm.sync_images, ['--name', 'stagingswarm', 'redis:6'])
+    if remote is None:
+        assert result.exit_code == 1
+        assert 'has no ssh master connection' in result.output
+        assert ssh_cmds == []
+    else:
+        assert result.exit_code == 0, result.output
+        assert [(cmd[cmd.index('-O') + 1], cmd[-1]) for cmd in ssh_cmds] == [('forward', remote), ('cancel', remote)]
+
+
+class ReconnectingTunnelRegistry(StubTunnelRegistry):
+    removed = []
+
+    def remove(self, port):
+        self.removed.append(port)
+
+
+@pytest.mark.parametrize('master', ['running', 'hung'])
+def test_reconnecting_a_tunnel_keeps_a_running_master_connection(monkeypatch, master):
+    import subprocess
+
+    remote = 'docker@18.191.218.147'
+    ReconnectingTunnelRegistry.tunnel = {'name': 'stagingswarm', 'port': 2375, 'pid': 4242, 'ip': '18.191.218.147',
+                                         'remote': remote}
+    ReconnectingTunnelRegistry.removed = []
+    ssh_cmds = []
+    killed = []
+
+    def run(cmd, timeout=None, **kwargs):
+        ssh_cmds.append(cmd[cmd.index('-O') + 1])
+        if cmd[cmd.index('-O') + 1] == 'check':
+            assert timeout == docker_swarm.SSH_MASTER_CHECK_TIMEOUT
+            if master == 'hung':
+                raise subprocess.TimeoutExpired(cmd, timeout)
+        return type('Completed', (), {'returncode': 0, 'stderr': 'Master running (pid=4242)'})()
+
+    monkeypatch.setattr(docker_swarm, 'TunnelRegistry', ReconnectingTunnelRegistry)
+    monkeypatch.setattr(docker_swarm, '_run', run)
+    monkeypatch.setattr(docker_swarm, '_kill', killed.extend)
+    monkeypatch.setattr(docker_swarm, '_get_stack_manager_instances', lambda *args, **kwargs: [])
+
+    assert docker_swarm._reconnect_tunnel('stagingswarm', 'us-east-2', 2375, 'docker', None, '18.191.218.147') is None
+    assert ReconnectingTunnelRegistry.removed == [2375]
+    if master == 'running':
+        # the master connection may be carrying other forwards (e.g. sync-images' registry forward)
+        assert ssh_cmds == ['check', 'cancel']
+        assert killed == []
+    else:
+        assert ssh_cmds == ['check']
+        assert killed == [4242]
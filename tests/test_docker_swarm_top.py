@@ -0,0 +1,108 @@
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+import docker_swarm
+
+
+def _stats(total_usage, system_usage, rx_bytes, tx_bytes, usage=200 * 2 ** 20):
+    return {'cpu_stats': {'cpu_usage': {'total_usage': total_usage}, 'system_cpu_usage': system_usage, 'online_cpus': 2},
+            'memory_stats': {'usage': usage, 'limit': 2 ** 30, 'stats': {'inactive_file': 50 * 2 ** 20}},
+            'networks': {'eth0': {'rx_bytes': rx_bytes, 'tx_bytes': tx_bytes}}}
+
+
+class StubDockerApi:
+    """A docker engine api whose responses are looked up by path, the container stats change on each request"""
+
+    def __init__(self):
+        self.responses = {
+            '/services': [{'ID': 's1', 'Spec': {'Name': 'pfm-stk_pfm-web', 'Mode': {'Replicated': {'Replicas': 2}}}},
+                          {'ID': 's2', 'Spec': {'Name': 'pfm-stk_pfm-redis', 'Mode': {'Global': {}}}}],
+            '/containers/json': [{'Id': 'c1', 'State': 'running', 'Labels': {'com.docker.swarm.task.id': 't1'}}],
+            '/tasks': [{'ID': 't1', 'ServiceID': 's1', 'Slot': 1, 'NodeID': 'n1', 'Status': {'State': 'running'}},
+                       {'ID': 't2', 'ServiceID': 's1', 'Slot': 2, 'NodeID': 'n2',
+                        'Status': {'State': 'rejected', 'Err': 'no suitable node'}},
+                       {'ID': 't3', 'ServiceID': 's2', 'NodeID': 'n2', 'Status': {'State': 'running'}}],
+            '/nodes': [{'ID': 'n1', 'Description': {'Hostname': 'manager1'}},
+                       {'ID': 'n2', 'Description': {'Hostname': 'worker1'}}],
+        }
+        self.stats = iter([_stats(1000, 100000, 0, 0), _stats(21000, 200000, 4096, 2048)])
+        self.paths = []
+
+    def get(self, path, params=None):
+        self.paths.append(path)
+        if path == '/containers/c1/stats':
+            return next(self.stats)
+        return self.responses[path]
+
+
+@pytest.fixture
+def executor():
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        yield executor
+
+
+def test_refresh_snapshot(executor, monkeypatch):
+    api = StubDockerApi()
+    top = docker_swarm.StackTop(api, 'pfm-stk', executor)
+    clock = iter([100.0, 102.0])
+    monkeypatch.setattr(docker_swarm.time, 'monotonic', lambda: next(clock))
+
+    first = top.refresh()
+    assert [(svc['name'], svc['running'], svc['desired']) for svc in first] == \
+        [('pfm-stk_pfm-redis', 1, 1), ('pfm-stk_pfm-web', 1, 2)]
+    web_task = first[1]['tasks'][0]
+    assert (web_task['node'], web_task['local'], web_task['mem'], web_task['cpu_pct']) == ('manager1', True, 150 * 2 ** 20, None)
+    assert first[1]['tasks'][1]['error'] == 'no suitable node'
+
+    # the nodes are known so they aren't looked up again, the rates are over the time since the last refresh
+    second = top.refresh()
+    assert api.paths.count('/nodes') == 1
+    web_task = second[1]['tasks'][0]
+    assert web_task['cpu_pct'] == pytest.approx(40.0)
+    assert (web_task['rx_rate'], web_task['tx_rate']) == (2048, 1024)
+
+
+def test_format_top(executor):
+    lines = docker_swarm._format_top(docker_swarm.StackTop(StubDockerApi(), 'pfm-stk', executor).refresh())
+    assert lines[0].split() == ['service/task', 'replicas', 'state', 'node', 'cpu', '%', 'mem', '/', 'limit',
+                                'net', 'rx/s', 'net', 'tx/s']
+    assert '150.0MiB / 1.0GiB' in lines[4]
+    assert lines[6].strip() == 'no suitable node'
+
+
+class _EngineHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.clients.add(self.client_address)
+        status, body = (200, {'ID': 'abc'}) if self.path.startswith('/info') else (404, {'message': 'no such service'})
+        body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_docker_api_reuses_its_connection():
+    server = HTTPServer(('localhost', 0), _EngineHandler)
+    server.clients = set()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    api = docker_swarm.DockerApi(server.server_address[1])
+    try:
+        for _ in range(3):
+            assert api.get('/info', {'filters': {'label': ['x']}}) == {'ID': 'abc'}
+        with pytest.raises(docker_swarm.DockerApiError, match='404: no such service'):
+            api.get('/services/nope')
+        assert len(server.clients) == 1
+    finally:
+        api.close()
+        server.shutdown()
+        server.server_close()